@@ -1,24 +1,36 @@
 import asyncio
 import socket
 import os
-import json
 import sys
-import httpx
 import signal
+import time
+import traceback
+from collections import deque
 from typing import Optional
+import httpx
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from rag_router import router as rag_router
 from fastchat_openai_api import chat_completion
 from pydantic import BaseModel
 from diffusion_worker import generate_image
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 import tempfile
 import uuid
 from tts_wrapper import generate_audio
 from vts import vts_router
 from story_orchestrator import app as story_graph_app
 from dynamic_registry import register as dyn_register, get as dyn_get, remove as dyn_remove
+import dynamic_registry
+import autoscaler
+import worker_client
+import worker_transport
+import scheduler
+from response_cache import cache as response_cache
+import single_flight
+import blob_store
+import cancellation
 
 from huggingface_hub import model_info
 
@@ -41,6 +53,9 @@ app.include_router(rag_router)
 app.include_router(vts_router)
 
 model_worker_procs = []
+_health_task = None
+_autoscale_task = None
+_eviction_task = None
 
 # Allow frontend to talk to us
 app.add_middleware(
@@ -54,17 +69,49 @@ app.add_middleware(
 MODEL_WORKERS = {
     "meta-llama/Llama-3.2-1B-Instruct": {
         "port": 21002,
-        "script": "model_worker.py"
+        "script": "model_worker.py",
+        "max_concurrency": 8,   # per replica; continuous batching, matches LLAMA_MAX_BATCH_SIZE
+        "max_queue": 16,
+        "replicas": int(os.environ.get("LLAMA_REPLICAS", "1")),  # extra replicas get free ports
+        "max_replicas": None,   # autoscaling ceiling; None -> AUTOSCALE_MAX_REPLICAS
+        # Worker process env defaults (the gateway's own environment wins).
+        # Speculative decoding: set LLAMA_DRAFT_MODEL or LLAMA_SELF_DRAFT_LAYERS.
+        "env": {
+            "LLAMA_INFERENCE_PROFILE": "fp32",   # fp32 | bf16 | int8 (CPU)
+            "LLAMA_SELF_DRAFT_LAYERS": "0",
+            "LLAMA_NUM_DRAFT_TOKENS": "4",
+            "LLAMA_SPECULATIVE": "0",
+        },
     },
     "mlx-community/Qwen2-VL-2B-Instruct-4bit": {
         "port": 21003,
-        "script": "model_worker_qwen.py"
+        "script": "model_worker_qwen.py",
+        "max_concurrency": 1,
+        "max_queue": 8,
+        "replicas": int(os.environ.get("QWEN_REPLICAS", "1")),
     }
 }
 
+# Seconds between /health probes of every worker replica
+REPLICA_HEALTH_INTERVAL = float(os.environ.get("REPLICA_HEALTH_INTERVAL", "10"))
+
+# Dynamic MLX workers: unload after this many idle seconds (0 = never), and keep
+# their total RSS under this budget by unloading least-recently-used ones (0 = no budget)
+DYN_IDLE_TTL = float(os.environ.get("DYN_IDLE_TTL", "1800"))
+DYN_MEMORY_BUDGET_MB = float(os.environ.get("DYN_MEMORY_BUDGET_MB", "0"))
+DYN_EVICT_INTERVAL = float(os.environ.get("DYN_EVICT_INTERVAL", "30"))
+_evictions = deque(maxlen=100)
+
+# Pre-warmed dynamic MLX workers (imports done, no model) claimed by /mlx/load
+DYN_SPARE_WORKERS = int(os.environ.get("DYN_SPARE_WORKERS", "0"))  # opt-in: a spare holds RAM and needs mlx
+_spare_workers = []  # [{"port", "proc", "ready", "timings"}]
+_load_timings = deque(maxlen=50)
+
 class MLXLoadRequest(BaseModel):
     hf_model_id: str
     max_new_tokens: Optional[int] = 512
+    replicas: Optional[int] = 1
+    max_replicas: Optional[int] = None  # autoscaling ceiling; None -> AUTOSCALE_MAX_REPLICAS
 
 class MLXUnloadRequest(BaseModel):
     hf_model_id: str
@@ -72,10 +119,11 @@ class MLXUnloadRequest(BaseModel):
 class StoryRequest(BaseModel):
     # Orchestration inputs
     narrative: str
-    image: str | None = None                      # data URL or http(s) URL
+    image: str | None = None                      # data URL, blob:<sha256> ref or http(s) URL
     rag_docs: list[str] | None = None             # local file paths
     rag_index_name: str | None = None
     build_index: bool = False
+    image_quality: str | None = None              # low | medium | high | full (visual-token budget)
 
     # Fine-tune options (optional)
     finetune: bool = False
@@ -93,7 +141,7 @@ class StoryRequest(BaseModel):
 
 class DiffusionInput(BaseModel):
     prompt: str
-    image: str | None = None  # base64 string if present
+    image: str | None = None  # base64 data URL or blob:<sha256> ref, if present
 
 class FineTuneRequest(BaseModel):
     base_model: str                  # e.g. "meta-llama/Llama-3.2-1B-Instruct"
@@ -116,60 +164,167 @@ def is_port_open(host: str, port: int) -> bool:
     
 def find_free_port(start=21100, end=21200):
     host = "127.0.0.1"
+    # includes replicas still starting up and spare workers
+    reserved = dynamic_registry.used_ports() | {s["port"] for s in _spare_workers}
     for p in range(start, end):
-        if not is_port_open(host, p):
+        if p not in reserved and not is_port_open(host, p):
             return p
     raise HTTPException(status_code=503, detail="No free ports available for dynamic MLX worker.")
 
-async def wait_for_port(port: int, retries: int = None, delay: float = 2) -> bool:
-    if retries is not None:
-        for attempt in range(retries):
-            if is_port_open("localhost", port):
-                print(f"✅ Worker is running on port {port}")
-                return True
-            print(f"⏳ Waiting for worker on port {port}... (attempt {attempt+1}/{retries})")
-            await asyncio.sleep(delay)
+async def is_worker_healthy(port: int) -> bool:
+    """GET /health over the worker's transport (Unix socket or TCP)."""
+    try:
+        r = await worker_client.get_pool(port).get("/health", timeout=2.0)
+        return r.status_code == 200 and bool(r.json().get("ok"))
+    except Exception:
         return False
-    else:
-        attempt = 0
-        while True:
-            if is_port_open("localhost", port):
-                print(f"✅ Worker is running on port {port}")
-                return True
-            print(f"⏳ Waiting for worker on port {port}... (attempt {attempt+1}/∞)")
-            attempt += 1
 
-            try:
-                await asyncio.sleep(delay)
-            except asyncio.CancelledError:
-                print("❌ Cancelled during wait_for_port")
-                return False
+async def wait_for_health(port: int, retries: int = None, delay: float = 2) -> bool:
+    """Waits until the worker reports ready on /health (workers answer only once their model is loaded)."""
+    attempt = 0
+    while retries is None or attempt < retries:
+        if await is_worker_healthy(port):
+            print(f"✅ Worker is ready on port {port}")
+            return True
+        print(f"⏳ Waiting for worker on port {port}... (attempt {attempt+1}/{retries or '∞'})")
+        attempt += 1
+
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            print("❌ Cancelled during wait_for_health")
+            return False
+    return False
 
 
-async def launch_worker_and_wait(script: str, port: int):
+async def launch_worker_and_wait(script: str, port: int, env: dict | None = None, model_name: str | None = None):
     proc = await asyncio.create_subprocess_exec(
         "python3", script,
-        cwd=os.path.dirname(os.path.abspath(__file__))
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**(env or {}), **os.environ, "WORKER_PORT": str(port), **worker_client.use_socket(port)},
     )
     model_worker_procs.append(proc)
 
     try:
-        success = await asyncio.wait_for(wait_for_port(port), timeout=60)
+        success = await asyncio.wait_for(wait_for_health(port), timeout=60)
     except asyncio.TimeoutError:
         print(f"❌ Timeout: {script} did not start on port {port} in time")
         proc.terminate()
         await proc.wait()
-        return
+        if model_name:
+            dynamic_registry.remove_replica(model_name, port)
+        return False
     except asyncio.CancelledError:
         print("⛔ Startup cancelled during worker wait!")
         proc.terminate()
         await proc.wait()
-        return
+        return False
 
     if success:
-        print(f"✅ {script} is ready.")
+        print(f"✅ {script} is ready on port {port}.")
+        if model_name:
+            dynamic_registry.mark_ready(model_name, port, proc.pid)
     else:
         print(f"❌ {script} failed to start.")
+    return success
+
+
+async def _replica_health_loop():
+    """Ejects replicas that fail /health and lets them back in once they pass."""
+    while True:
+        await asyncio.sleep(REPLICA_HEALTH_INTERVAL)
+        for model_id in dynamic_registry.all_models():
+            for replica in dynamic_registry.replicas(model_id):
+                if not replica.ready:
+                    continue
+                try:
+                    r = await worker_client.get_pool(replica.port).get("/health", timeout=2.0)
+                    ok = r.status_code == 200
+                except Exception:
+                    ok = False
+                dynamic_registry.set_health(replica, ok)
+
+
+async def _spawn_replica(model_id: str) -> int | None:
+    """Starts one more replica of a static or dynamic model; returns its port once ready."""
+    meta = dyn_get(model_id)
+    if meta is None:
+        return None
+    port = find_free_port()
+    if meta["static"]:
+        cfg = MODEL_WORKERS[model_id]
+        dyn_register(model_id, port, None, ready=False, static=True)
+        if await launch_worker_and_wait(cfg["script"], port, cfg.get("env"), model_id):
+            return port
+        dynamic_registry.remove_replica(model_id, port)
+        return None
+    dyn_register(model_id, port, None, ready=False)
+    try:
+        claimed = await _claim_spare(model_id)
+        if claimed is not None:
+            dynamic_registry.remove_replica(model_id, port)
+            port, proc, _ = claimed
+            dyn_register(model_id, port, proc.pid, ready=False)
+            asyncio.create_task(_replenish_spares())
+        else:
+            proc, _ = await _spawn_dynamic_replica(model_id, port)
+    except Exception as e:
+        print(f"❌ Failed to start replica of {model_id}: {getattr(e, 'detail', e)}")
+        dynamic_registry.remove_replica(model_id, port)
+        return None
+    dynamic_registry.mark_ready(model_id, port, proc.pid)
+    return port
+
+
+async def _retire_replica(model_id: str, replica):
+    """Stops routing to a replica, lets in-flight requests finish, then stops its process."""
+    replica.ready = False
+    while replica.outstanding:
+        await asyncio.sleep(0.5)
+    dynamic_registry.remove_replica(model_id, replica.port)
+    await worker_client.close_pool(replica.port)
+    proc = next((p for p in model_worker_procs if p.pid == replica.pid), None)
+    if proc is not None:
+        model_worker_procs.remove(proc)
+        proc.terminate()
+    elif replica.pid is not None:
+        try:
+            os.kill(replica.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+async def _scale(model_id: str, action: str, replica, reason: str):
+    policy = autoscaler.get(model_id)
+    before = len(dynamic_registry.replicas(model_id))
+    if action == "up":
+        policy.starting += 1
+        policy.last_scale_up = time.monotonic()
+        try:
+            port = await _spawn_replica(model_id)
+        finally:
+            policy.starting -= 1
+        after = len([r for r in dynamic_registry.replicas(model_id) if r.ready])
+        autoscaler.record(model_id, "scale_up" if port else "scale_up_failed", before, after, reason, port)
+    else:
+        policy.stopping += 1
+        try:
+            await _retire_replica(model_id, replica)
+        finally:
+            policy.stopping -= 1
+        autoscaler.record(model_id, "scale_down", before, len(dynamic_registry.replicas(model_id)), reason, replica.port)
+    autoscaler.apply_capacity(model_id)
+
+
+async def _autoscale_loop():
+    """Adds replicas for saturated models and retires idle ones (see autoscaler.py)."""
+    while True:
+        await asyncio.sleep(autoscaler.INTERVAL)
+        for model_id in autoscaler.policies():
+            decision = autoscaler.decide(model_id)
+            if decision is not None:
+                # spawning can take minutes; don't hold up the other models
+                asyncio.create_task(_scale(model_id, *decision))
 
 
 
@@ -177,21 +332,56 @@ async def launch_worker_and_wait(script: str, port: int):
 async def startup_event():
     print("🚀 Starting API server and launching model workers if needed...")
     for model_name, cfg in MODEL_WORKERS.items():
-        port = cfg["port"]
+        replicas = max(1, int(cfg.get("replicas", 1)))
+        scheduler.configure(
+            model_name,
+            max_concurrency=cfg["max_concurrency"] * replicas if cfg.get("max_concurrency") else None,
+            max_queue=cfg.get("max_queue"),
+            max_queue_wait=cfg.get("max_queue_wait"),
+        )
+        autoscaler.configure(
+            model_name, min_replicas=replicas, max_replicas=cfg.get("max_replicas"),
+            per_replica_concurrency=cfg.get("max_concurrency") or scheduler.DEFAULT_MAX_CONCURRENCY,
+        )
         script = cfg["script"]
 
-        if not is_port_open("localhost", port):
-            print(f"🔁 Launching {script}...")
-
+        for i in range(replicas):
+            # first replica keeps the configured port; the rest get free ones
+            port = cfg["port"] if i == 0 else find_free_port()
+            if is_port_open("localhost", port):
+                # started by hand: keep talking TCP to it
+                print(f"✅ {script} already running on port {port}")
+                dyn_register(model_name, port, None, ready=True, static=True)
+                continue
+            worker_client.use_socket(port)
+            if await is_worker_healthy(port):
+                print(f"✅ {script} already running on {worker_transport.socket_path(port)}")
+                dyn_register(model_name, port, None, ready=True, static=True)
+                continue
+
+            print(f"🔁 Launching {script} on port {port} (replica {i + 1}/{replicas})...")
+            dyn_register(model_name, port, None, ready=False, static=True)
             # launch in background to prevent blocking startup
-            asyncio.create_task(launch_worker_and_wait(script, port))
-        else:
-            print(f"✅ {script} already running on port {port}")
+            asyncio.create_task(launch_worker_and_wait(script, port, cfg.get("env"), model_name))
+
+    await worker_client.startup(dynamic_registry.used_ports())
+    global _health_task, _autoscale_task, _eviction_task
+    _health_task = asyncio.create_task(_replica_health_loop())
+    _autoscale_task = asyncio.create_task(_autoscale_loop())
+    _eviction_task = asyncio.create_task(_dynamic_eviction_loop())
+    dynamic_registry.set_reloader(_reload_dynamic)
+    asyncio.create_task(_replenish_spares())
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     print("🛑 Shutting down model workers...")
+    for task in (_health_task, _autoscale_task, _eviction_task):
+        if task is not None:
+            task.cancel()
+    for spare in _spare_workers:
+        if spare["proc"] is not None and spare["proc"].returncode is None:
+            spare["proc"].terminate()
     for proc in model_worker_procs:
         proc.terminate()
         try:
@@ -200,22 +390,140 @@ async def shutdown_event():
         except asyncio.TimeoutError:
             print("⚠️ Worker did not terminate in time, killing...")
             proc.kill()
+    await worker_client.shutdown()
+
+@app.get("/admin/worker_pools")
+def worker_pools():
+    """Per-worker HTTP pool counters (requests, in-flight, connections)."""
+    return {"pools": worker_client.stats()}
+
+@app.get("/admin/replicas")
+def replicas():
+    """Per-model worker replicas: outstanding requests, totals, errors, health/ejection."""
+    return {"models": dynamic_registry.stats()}
+
+@app.get("/admin/dynamic_workers")
+def dynamic_workers():
+    """Dynamic MLX workers: last access and RSS per replica, memory budget, evicted models."""
+    dynamic_registry.sample_rss()
+    models = {m: st for m, st in dynamic_registry.stats().items() if not st["static"]}
+    return {
+        "idle_ttl_s": DYN_IDLE_TTL,
+        "memory_budget_mb": DYN_MEMORY_BUDGET_MB,
+        "total_rss_mb": round(sum(st["rss_mb"] for st in models.values()), 1),
+        "models": models,
+        "evicted": list(dynamic_registry.evicted()),
+        "recent_evictions": list(_evictions),
+    }
+
+@app.get("/admin/spare_workers")
+def spare_workers():
+    """Pre-warmed dynamic MLX workers and per-phase timings of recent /mlx/load calls."""
+    return {
+        "target": DYN_SPARE_WORKERS,
+        "spares": [
+            {"port": s["port"], "ready": s["ready"], "timings": s["timings"]}
+            for s in _spare_workers
+        ],
+        "recent_loads": list(_load_timings),
+    }
+
+
+@app.get("/admin/cancellations")
+def cancellation_stats():
+    """Upstream generations cancelled after client disconnects, and tokens that saved."""
+    return cancellation.stats()
+
+
+@app.get("/admin/blobs")
+def blob_stats():
+    return blob_store.store.stats()
+
+
+@app.get("/admin/autoscaler")
+def autoscaler_stats():
+    """Replica limits per model, replicas starting/stopping, and recent scaling events."""
+    return autoscaler.stats()
+
+@app.get("/admin/response_cache")
+def response_cache_stats():
+    """Exact-match completion cache: entries, bytes, hits/misses, evictions."""
+    return response_cache.stats()
+
+@app.get("/admin/single_flight")
+def single_flight_stats():
+    """In-flight shared generations and per-model upstream vs. coalesced request counts."""
+    return single_flight.stats()
+
+@app.delete("/admin/response_cache")
+def response_cache_clear():
+    response_cache.clear()
+    return {"status": "cleared"}
+
+@app.get("/admin/schedulers")
+def schedulers():
+    """Per-model admission stats: in-flight, queue depth, wait times, rejections."""
+    return {"models": scheduler.stats()}
 
 @app.post("/v1/chat/completions")
 async def chat_endpoint(request: Request):
     print("📥 Received /v1/chat/completions POST request")
-    body_bytes = await request.body()
     try:
-        body_json = json.loads(body_bytes)
+        # request.json() is cached on the request, so chat_completion doesn't parse it again
+        body_json = await request.json()
         print("📦 Request body JSON:")
         for k, v in body_json.items():
-            print(f"  - {k}: {v}")
+            print(f"  - {k}: {_redact_images(v)}")
     except Exception as e:
+        body_bytes = await request.body()
         print(f"⚠️ Failed to parse body: {e}")
-        print(f"Raw body: {body_bytes.decode('utf-8', errors='replace')}")    
+        print(f"Raw body: {body_bytes[:2000].decode('utf-8', errors='replace')}")
     return await chat_completion(request)
 
 
+def _redact_images(value):
+    """Replaces data URLs with a short placeholder for logging."""
+    if isinstance(value, str) and value.startswith("data:"):
+        return f"<{value[:value.find(',')]} {len(value)} chars>"
+    if isinstance(value, list):
+        return [_redact_images(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _redact_images(v) for k, v in value.items()}
+    return value
+
+
+@app.post("/blobs")
+async def upload_blob(request: Request):
+    """
+    Stores an image (raw body, or JSON {"data_url": "data:image/...;base64,..."})
+    in the content-addressed blob store. Send the returned ref (blob:<sha256>)
+    as the image_url in chat messages instead of re-sending the image each turn.
+    """
+    if request.headers.get("content-type", "").startswith("application/json"):
+        data_url = (await request.json()).get("data_url")
+        if not data_url or ";base64," not in data_url[:100]:
+            raise HTTPException(status_code=400, detail="Expected {'data_url': 'data:<mime>;base64,...'}")
+        ref = blob_store.store.put_data_url(data_url)
+    else:
+        body = await request.body()
+        if not body:
+            raise HTTPException(status_code=400, detail="Empty upload")
+        ref = blob_store.store.put(body)
+    data = blob_store.store.get(ref)
+    return {"ref": ref, "sha256": blob_store.digest_of(ref), "bytes": len(data), "mime": blob_store.sniff_mime(data)}
+
+
+@app.get("/blobs/{digest}")
+def get_blob(digest: str):
+    try:
+        data = blob_store.store.get(digest)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except blob_store.BlobNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    return Response(content=data, media_type=blob_store.sniff_mime(data))
+
+
 @app.post("/finetune")
 async def finetune(req: FineTuneRequest):
     print(f"🛠️ Starting fine-tuning with dataset: {req.dataset_name}, adapter: {req.adapter_name}")
@@ -299,7 +607,7 @@ async def orchestrate_story(req: StoryRequest):
     """
     init_state = {
         "narrative": req.narrative,
-        "image": req.image,
+        "image": blob_store.store.ingest(req.image),  # carried through the graph as a blob ref
         "rag_docs": req.rag_docs or [],
         "rag_index_name": req.rag_index_name,
         "build_index": req.build_index,
@@ -313,6 +621,7 @@ async def orchestrate_story(req: StoryRequest):
         "lora_dropout": req.lora_dropout,
         "num_illustrations": req.num_illustrations,
         "illustration_prompt_hint": req.illustration_prompt_hint,
+        "image_quality": req.image_quality,
     }
 
     result = await story_graph_app.ainvoke(init_state)
@@ -339,23 +648,105 @@ async def mlx_load(req: MLXLoadRequest):
     # If already loaded, return existing port
     existing = dyn_get(hf_id)
     if existing:
-        return {"status": "already_loaded", "model": hf_id, "port": existing["port"]}
+        return {
+            "status": "already_loaded", "model": hf_id, "port": existing["port"],
+            "ports": [r.port for r in existing["replicas"]],
+        }
 
+    started = time.perf_counter()
     # Validate HF model ID quickly (does it exist? is it public?)
     try:
         info = await _model_info_async(hf_id)
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Cannot resolve HF model '{hf_id}': {e}")
+    validate_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    ports, replica_timings = await _load_dynamic(hf_id, {
+        "max_new_tokens": req.max_new_tokens,
+        "replicas": req.replicas,
+        "max_replicas": req.max_replicas,
+    })
+    # make room if this load pushed us over the memory budget
+    asyncio.create_task(_evict_dynamic_workers(keep=hf_id))
+
+    timings = {
+        "validate_ms": validate_ms,
+        "replicas": replica_timings,
+        "total_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    _load_timings.append({"time": time.time(), "model": hf_id, **timings})
+    print(f"⏱️ Loaded {hf_id} in {timings['total_ms']:.0f}ms: {replica_timings}")
+    return {"status": "loaded", "model": hf_id, "port": ports[0], "ports": ports, "timings": timings}
 
-    port = find_free_port()
 
+async def _load_dynamic(hf_id: str, params: dict) -> tuple[list, list]:
+    """Starts params["replicas"] dynamic workers for hf_id (all-or-nothing), claiming
+    pre-warmed spares first; returns their ports and per-replica phase timings.
+    Also used to transparently reload a model that was evicted."""
+    n = max(1, int(params.get("replicas") or 1))
+
+    async def _start_one():
+        port = find_free_port()
+        # reserve the port (not routable until ready) so the next replica picks another
+        dyn_register(hf_id, port, None, ready=False)
+        try:
+            claimed = await _claim_spare(hf_id)
+        except BaseException:
+            dynamic_registry.remove_replica(hf_id, port)
+            raise
+        if claimed is not None:
+            dynamic_registry.remove_replica(hf_id, port)
+            port, proc, timings = claimed
+            dyn_register(hf_id, port, proc.pid, ready=False)
+            return port, proc, timings
+        try:
+            proc, timings = await _spawn_dynamic_replica(hf_id, port)
+        except BaseException:
+            dynamic_registry.remove_replica(hf_id, port)
+            raise
+        return port, proc, timings
+
+    results = await asyncio.gather(*(_start_one() for _ in range(n)), return_exceptions=True)
+    asyncio.create_task(_replenish_spares())
+    failed = next((r for r in results if isinstance(r, BaseException)), None)
+    if failed is not None:
+        # all-or-nothing: stop the replicas that did come up
+        for result in results:
+            if isinstance(result, BaseException):
+                continue
+            port, proc, _ = result
+            dynamic_registry.remove_replica(hf_id, port)
+            if proc.returncode is None:
+                proc.terminate()
+            await worker_client.close_pool(port)
+        raise failed
+
+    # Store in registry
+    for port, proc, _ in results:
+        dynamic_registry.mark_ready(hf_id, port, proc.pid)
+    dynamic_registry.set_load_params(hf_id, params)
+    autoscaler.configure(
+        hf_id, min_replicas=n, max_replicas=params.get("max_replicas"),
+        per_replica_concurrency=scheduler.DEFAULT_MAX_CONCURRENCY,
+    )
+    autoscaler.apply_capacity(hf_id)
+    return [port for port, _, _ in results], [{"port": port, **timings} for port, _, timings in results]
+
+
+async def _spawn_dynamic_replica(hf_id: str | None, port: int, spare: bool = False):
+    """Starts a dynamic MLX worker and waits until it is ready; returns (proc, timings).
+    A spare worker (hf_id None) is ready once its imports are done and it answers /health."""
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    started = time.perf_counter()
 
     # --- spawn worker ---
     env = os.environ.copy()
-    env["DYN_MLX_MODEL_ID"] = hf_id
+    env["DYN_MLX_MODEL_ID"] = hf_id or ""
     env["DYN_MLX_PORT"] = str(port)
     env["DYN_MLX_STANDALONE"] = "1"
+    if spare:
+        env["DYN_MLX_SPARE"] = "1"
+    env.update(worker_client.use_socket(port))
 
     proc = await asyncio.create_subprocess_exec(
         sys.executable, "-u", os.path.join(BASE_DIR, "dynamic_mlx_worker.py"),
@@ -363,64 +754,194 @@ async def mlx_load(req: MLXLoadRequest):
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
+    timings = {"source": "spare" if spare else "cold", "spawn_ms": round((time.perf_counter() - started) * 1000, 1)}
 
     async def _wait_ready_or_fail():
         # poll health while also checking for early process exit
-        health_url = f"http://127.0.0.1:{port}/health"
+        pool = worker_client.get_pool(port)
         start = asyncio.get_event_loop().time()
         timeout_s = 300.0
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            while True:
-                # if process died, surface stderr immediately
-                rc = proc.returncode
-                if rc is not None:
-                    try:
-                        err = await asyncio.wait_for(proc.stderr.read(16384), timeout=1.0)
-                    except Exception:
-                        err = b""
-                    msg = err.decode(errors="ignore") or f"Worker exited with code {rc}"
-                    raise HTTPException(status_code=500, detail=f"Failed to start dynamic MLX worker. {msg}")
-
-                # check health
+        while True:
+            # if process died, surface stderr immediately
+            rc = proc.returncode
+            if rc is not None:
                 try:
-                    r = await client.get(health_url)
-                    if r.status_code == 200 and r.json().get("ok"):
-                        return
+                    err = await asyncio.wait_for(proc.stderr.read(16384), timeout=1.0)
                 except Exception:
-                    pass
-
-                if asyncio.get_event_loop().time() - start > timeout_s:
-                    # read some stderr for debugging
-                    try:
-                        err = await asyncio.wait_for(proc.stderr.read(16384), timeout=1.0)
-                    except Exception:
-                        err = b""
-                    msg = err.decode(errors="ignore")
-                    raise HTTPException(status_code=504, detail=f"Dynamic MLX worker timed out. {msg[-1200:]}")
+                    err = b""
+                msg = err.decode(errors="ignore") or f"Worker exited with code {rc}"
+                await worker_client.close_pool(port)
+                raise HTTPException(status_code=500, detail=f"Failed to start dynamic MLX worker. {msg}")
 
-                await asyncio.sleep(0.5)
-
-    await _wait_ready_or_fail()
+            # check health
+            try:
+                r = await pool.get("/health", timeout=5.0)
+                body = r.json() if r.status_code == 200 else {}
+                if body.get("ok") or (spare and body.get("spare")):
+                    # worker-side phases: interpreter + imports, model load
+                    timings.update(body.get("timings") or {})
+                    return
+            except Exception:
+                pass
+
+            if asyncio.get_event_loop().time() - start > timeout_s:
+                # read some stderr for debugging
+                try:
+                    err = await asyncio.wait_for(proc.stderr.read(16384), timeout=1.0)
+                except Exception:
+                    err = b""
+                msg = err.decode(errors="ignore")
+                await worker_client.close_pool(port)
+                raise HTTPException(status_code=504, detail=f"Dynamic MLX worker timed out. {msg[-1200:]}")
 
-    # Store in registry
-    dyn_register(hf_id, port, proc.pid)
+            await asyncio.sleep(0.5)
 
-    return {"status": "loaded", "model": hf_id, "port": port}
+    try:
+        await _wait_ready_or_fail()
+    except BaseException:
+        if proc.returncode is None:
+            proc.terminate()
+        raise
+    timings["ready_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return proc, timings
+
+
+async def _replenish_spares():
+    """Tops the spare pool back up to DYN_SPARE_WORKERS pre-warmed workers."""
+    while len(_spare_workers) < DYN_SPARE_WORKERS:
+        try:
+            port = find_free_port()
+        except HTTPException:
+            return
+        spare = {"port": port, "proc": None, "ready": False, "timings": {}}
+        _spare_workers.append(spare)
+        try:
+            spare["proc"], spare["timings"] = await _spawn_dynamic_replica(None, port, spare=True)
+        except Exception as e:
+            print(f"❌ Failed to start spare MLX worker on port {port}: {getattr(e, 'detail', e)}")
+            _spare_workers.remove(spare)
+            return
+        spare["ready"] = True
+        print(f"🔥 Spare MLX worker ready on port {port} ({spare['timings'].get('ready_ms', 0):.0f}ms)")
+
+
+async def _claim_spare(hf_id: str):
+    """Loads hf_id into a ready spare worker; returns (port, proc, timings), or None if
+    there is no usable spare (the caller then spawns a cold worker)."""
+    while True:
+        spare = next((s for s in _spare_workers if s["ready"]), None)
+        if spare is None:
+            return None
+        _spare_workers.remove(spare)
+        port, proc = spare["port"], spare["proc"]
+        if proc.returncode is not None:
+            await worker_client.close_pool(port)
+            continue
+        started = time.perf_counter()
+        try:
+            r = await worker_client.get_pool(port).post("/load", json={"model_id": hf_id}, timeout=300.0)
+            r.raise_for_status()
+        except Exception as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 500:
+                # the model itself failed to load; a cold spawn would fail the same way
+                proc.terminate()
+                await worker_client.close_pool(port)
+                raise HTTPException(status_code=500, detail=f"Failed to load {hf_id} into spare MLX worker. {e.response.text[-1200:]}")
+            print(f"⚠️ Spare MLX worker on port {port} unusable ({e}); spawning a cold worker")
+            proc.terminate()
+            await worker_client.close_pool(port)
+            continue
+        timings = {
+            "source": "spare",
+            "claim_ms": round((time.perf_counter() - started) * 1000, 1),
+            "load_ms": (r.json().get("timings") or {}).get("load_ms"),
+            "spare_warmup_ms": spare["timings"].get("ready_ms"),
+        }
+        timings["ready_ms"] = timings["claim_ms"]
+        return port, proc, timings
 
 
 @app.delete("/mlx/unload")
 async def mlx_unload(req: MLXUnloadRequest):
     hf_id = req.hf_model_id.strip()
     meta = dyn_get(hf_id)
-    if not meta:
+    dynamic_registry.forget_evicted(hf_id)  # an explicit unload also cancels a pending reload
+    if not meta or meta["static"]:  # static workers live for the app's lifetime
         return {"status": "not_loaded", "model": hf_id}
 
-    pid = meta["pid"]
+    await _unload_dynamic(hf_id, meta)
+    return {"status": "unloaded", "model": hf_id}
+
+
+async def _unload_dynamic(hf_id: str, meta: dict):
     dyn_remove(hf_id)
+    scheduler.remove(hf_id)
+    autoscaler.remove(hf_id)
+    for replica in meta["replicas"]:
+        await worker_client.close_pool(replica.port)
+        if replica.pid is None:
+            continue
+        try:
+            os.kill(replica.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
 
-    try:
-        os.kill(pid, signal.SIGTERM)
-    except ProcessLookupError:
-        pass
 
-    return {"status": "unloaded", "model": hf_id}
+async def _evict_dynamic_workers(keep: str | None = None):
+    """
+    Unloads dynamic models idle longer than DYN_IDLE_TTL, then least-recently
+    used ones until total dynamic worker RSS fits DYN_MEMORY_BUDGET_MB. Busy
+    models (outstanding or queued requests) are never evicted. Evicted models
+    reload on their next chat request.
+    """
+    await run_in_threadpool(dynamic_registry.sample_rss)  # may shell out to `ps`
+    now = time.monotonic()
+
+    def _busy(model_id: str) -> bool:
+        sched = scheduler.get(model_id)
+        return bool(sched.queue_depth() or sched.in_flight) or dynamic_registry.last_used(model_id) >= now
+
+    candidates = []
+    for model_id, meta in dynamic_registry.all_models().items():
+        if meta["static"] or model_id == keep:
+            continue
+        if not all(r.ready for r in meta["replicas"]) or _busy(model_id):
+            continue
+        candidates.append((dynamic_registry.last_used(model_id), model_id, meta))
+    candidates.sort(key=lambda c: c[0])
+
+    def _total_mb():
+        return sum(
+            dynamic_registry.rss_bytes(m) for m, meta in dynamic_registry.all_models().items() if not meta["static"]
+        ) / 1024 / 1024
+
+    for last, model_id, meta in candidates:
+        idle_s = now - last
+        if DYN_IDLE_TTL > 0 and idle_s > DYN_IDLE_TTL:
+            reason = f"idle {idle_s:.0f}s > {DYN_IDLE_TTL:.0f}s"
+        elif DYN_MEMORY_BUDGET_MB > 0 and _total_mb() > DYN_MEMORY_BUDGET_MB:
+            reason = f"dynamic workers use {_total_mb():.0f}MB > {DYN_MEMORY_BUDGET_MB:.0f}MB budget"
+        else:
+            continue
+        # each unload awaits: re-check that nothing was admitted, reloaded or unloaded meanwhile
+        if dyn_get(model_id) is not meta or _busy(model_id):
+            continue
+        print(f"🧹 Evicting dynamic model {model_id} ({reason}, {dynamic_registry.rss_bytes(model_id) / 1024 / 1024:.0f}MB)")
+        dynamic_registry.mark_evicted(model_id, meta.get("load") or {})
+        await _unload_dynamic(model_id, meta)
+        _evictions.append({"time": time.time(), "model": model_id, "reason": reason})
+
+
+async def _dynamic_eviction_loop():
+    while True:
+        await asyncio.sleep(DYN_EVICT_INTERVAL)
+        try:
+            await _evict_dynamic_workers()
+        except Exception:
+            print("❌ ERROR in dynamic worker eviction:")
+            traceback.print_exc()
+
+
+async def _reload_dynamic(hf_id: str, params: dict):
+    await _load_dynamic(hf_id, params)
+    asyncio.create_task(_evict_dynamic_workers(keep=hf_id))
@@ -0,0 +1,161 @@
+# autoscaler.py
+"""
+Queue-depth / latency driven replica autoscaling policy.
+
+Every AUTOSCALE_INTERVAL seconds api.py asks decide() what to do for each
+model with a policy:
+
+- scale up (one replica at a time, at most max_replicas) when every slot is
+  busy and either the queue holds AUTOSCALE_QUEUE_DEPTH or more requests per
+  ready replica, or the p95 queue wait over the last minute exceeds
+  AUTOSCALE_MAX_WAIT_MS; no more often than AUTOSCALE_UP_COOLDOWN;
+- scale down (never below min_replicas, never the model's first replica)
+  when a replica has had nothing outstanding for AUTOSCALE_IDLE_SECONDS and
+  nothing is queued.
+
+Scaling events are kept in a bounded log for GET /admin/autoscaler.
+"""
+import os
+import time
+import threading
+from collections import deque
+
+import scheduler
+import dynamic_registry
+
+INTERVAL = float(os.environ.get("AUTOSCALE_INTERVAL", "5"))
+QUEUE_DEPTH = int(os.environ.get("AUTOSCALE_QUEUE_DEPTH", "4"))
+MAX_WAIT_MS = float(os.environ.get("AUTOSCALE_MAX_WAIT_MS", "2000"))
+UP_COOLDOWN = float(os.environ.get("AUTOSCALE_UP_COOLDOWN", "30"))
+IDLE_SECONDS = float(os.environ.get("AUTOSCALE_IDLE_SECONDS", "300"))
+DEFAULT_MAX_REPLICAS = int(os.environ.get("AUTOSCALE_MAX_REPLICAS", "1"))
+WAIT_WINDOW_S = 60.0
+
+
+class ScalePolicy:
+    def __init__(self, model: str, min_replicas: int, max_replicas: int, per_replica_concurrency: int):
+        self.model = model
+        self.min_replicas = max(1, min_replicas)
+        self.max_replicas = max(self.min_replicas, max_replicas)
+        self.per_replica_concurrency = max(1, per_replica_concurrency)
+        self.starting = 0
+        self.stopping = 0
+        self.last_scale_up = 0.0
+
+    def stats(self) -> dict:
+        ready = [r for r in dynamic_registry.replicas(self.model) if r.ready]
+        return {
+            "min_replicas": self.min_replicas,
+            "max_replicas": self.max_replicas,
+            "ready_replicas": len(ready),
+            "starting": self.starting,
+            "stopping": self.stopping,
+            "per_replica_concurrency": self.per_replica_concurrency,
+        }
+
+
+# Model ID -> ScalePolicy
+_POLICIES: dict[str, ScalePolicy] = {}
+_EVENTS: deque = deque(maxlen=200)
+_LOCK = threading.RLock()
+
+
+def configure(model: str, min_replicas: int, max_replicas: int | None, per_replica_concurrency: int) -> ScalePolicy:
+    with _LOCK:
+        policy = ScalePolicy(
+            model, min_replicas,
+            max_replicas if max_replicas is not None else max(min_replicas, DEFAULT_MAX_REPLICAS),
+            per_replica_concurrency,
+        )
+        prev = _POLICIES.get(model)
+        if prev is not None:
+            policy.starting, policy.stopping, policy.last_scale_up = prev.starting, prev.stopping, prev.last_scale_up
+        _POLICIES[model] = policy
+        return policy
+
+
+def get(model: str) -> ScalePolicy | None:
+    with _LOCK:
+        return _POLICIES.get(model)
+
+
+def policies() -> dict:
+    with _LOCK:
+        return dict(_POLICIES)
+
+
+def remove(model: str):
+    with _LOCK:
+        _POLICIES.pop(model, None)
+
+
+def apply_capacity(model: str):
+    """Sizes the model's admission limit to its ready replicas."""
+    policy = get(model)
+    if policy is None:
+        return
+    ready = sum(1 for r in dynamic_registry.replicas(model) if r.ready)
+    scheduler.configure(model, max_concurrency=policy.per_replica_concurrency * max(1, ready))
+
+
+def decide(model: str):
+    """Returns ("up", None, reason), ("down", replica, reason) or None."""
+    policy = get(model)
+    if policy is None:
+        return None
+    reps = dynamic_registry.replicas(model)
+    ready = [r for r in reps if r.ready]
+    if not ready or policy.starting or policy.stopping:
+        return None  # still settling from the last change
+    sched = scheduler.get(model)
+    depth = sched.queue_depth()
+    now = time.monotonic()
+
+    if len(reps) < policy.max_replicas and now - policy.last_scale_up >= UP_COOLDOWN:
+        saturated = sched.in_flight >= sched.max_concurrency
+        p95 = sched.recent_wait_p95(WAIT_WINDOW_S)
+        if saturated and depth >= QUEUE_DEPTH * len(ready):
+            return "up", None, f"queue depth {depth} with {len(ready)} replica(s)"
+        if saturated and p95 is not None and p95 * 1000 > MAX_WAIT_MS:
+            return "up", None, f"p95 queue wait {p95 * 1000:.0f}ms > {MAX_WAIT_MS:.0f}ms"
+
+    if len(ready) > policy.min_replicas and not depth:
+        idle = [
+            r for r in ready[1:]
+            if not r.outstanding and now - r.last_used >= IDLE_SECONDS
+        ]
+        if idle:
+            replica = min(idle, key=lambda r: r.last_used)
+            return "down", replica, f"replica on port {replica.port} idle for {now - replica.last_used:.0f}s"
+    return None
+
+
+def record(model: str, action: str, replicas_before: int, replicas_after: int, reason: str, port: int | None = None):
+    event = {
+        "time": time.time(),
+        "model": model,
+        "action": action,
+        "port": port,
+        "replicas_before": replicas_before,
+        "replicas_after": replicas_after,
+        "reason": reason,
+    }
+    icon = {"scale_up": "📈", "scale_down": "📉"}.get(action, "⚠️")
+    print(f"{icon} Autoscaler {action} {model}: {replicas_before} → {replicas_after} replicas ({reason})")
+    with _LOCK:
+        _EVENTS.append(event)
+
+
+def stats() -> dict:
+    with _LOCK:
+        return {
+            "config": {
+                "interval_s": INTERVAL,
+                "queue_depth_per_replica": QUEUE_DEPTH,
+                "max_wait_ms": MAX_WAIT_MS,
+                "up_cooldown_s": UP_COOLDOWN,
+                "idle_seconds": IDLE_SECONDS,
+            },
+            "models": {model: p.stats() for model, p in _POLICIES.items()},
+            "events": list(_EVENTS),
+        }
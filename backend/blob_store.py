@@ -0,0 +1,290 @@
+# blob_store.py
+"""
+Content-addressed local store for images and other binary blobs.
+
+A blob is stored once under its sha256 in BLOB_DIR and referenced as
+"blob:<sha256>" in chat messages and worker payloads instead of a
+multi-megabyte data:...;base64 URL. Workers on the same host open the file
+directly from the shared directory (no base64 decode, no copy over HTTP).
+
+Two tiers:
+- memory: recently used blobs, LRU under BLOB_MEMORY_MB
+- disk:   every blob, LRU (by last access) under BLOB_DISK_MB
+
+Only the gateway writes and evicts; workers just read by path.
+
+Remote http(s) image URLs are fetched by the gateway asynchronously
+(ingest_async) and stored like uploads; the URL -> ref mapping is cached for
+BLOB_URL_TTL seconds and concurrent fetches of one URL share a download.
+"""
+import os
+import time
+import base64
+import asyncio
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+BLOB_DIR = os.environ.get("BLOB_DIR", os.path.join(tempfile.gettempdir(), "blob_store"))
+MEMORY_MB = float(os.environ.get("BLOB_MEMORY_MB", "64"))
+DISK_MB = float(os.environ.get("BLOB_DISK_MB", "2048"))
+URL_TTL = float(os.environ.get("BLOB_URL_TTL", "3600"))
+URL_CACHE_SIZE = int(os.environ.get("BLOB_URL_CACHE_SIZE", "1024"))
+MAX_FETCH_MB = float(os.environ.get("BLOB_MAX_FETCH_MB", "20"))
+FETCH_TIMEOUT = float(os.environ.get("BLOB_FETCH_TIMEOUT", "30"))
+
+REF_PREFIX = "blob:"
+
+_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+class BlobNotFound(KeyError):
+    pass
+
+
+def sniff_mime(data: bytes) -> str:
+    for magic, mime in _MAGIC:
+        if data.startswith(magic):
+            return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def is_ref(value) -> bool:
+    return isinstance(value, str) and value.startswith(REF_PREFIX)
+
+
+def ref(digest: str) -> str:
+    return REF_PREFIX + digest
+
+
+def digest_of(value: str) -> str:
+    """The sha256 of a "blob:<sha256>" reference (or a bare digest)."""
+    digest = value[len(REF_PREFIX):] if is_ref(value) else value
+    if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+        raise ValueError(f"Not a blob reference: {value[:80]!r}")
+    return digest
+
+
+def path(value: str) -> str:
+    """On-disk path of a blob reference (digest-sharded)."""
+    digest = digest_of(value)
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+def open_path(value: str) -> str:
+    """Like path(), but raises BlobNotFound if the blob was evicted or never stored."""
+    p = path(value)
+    if not os.path.exists(p):
+        raise BlobNotFound(f"Blob {digest_of(value)[:12]}… not found (expired or never uploaded); upload the image again")
+    return p
+
+
+class BlobStore:
+    def __init__(self, root: str, memory_bytes: int, disk_bytes: int):
+        self.root = root
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_used = 0
+        self._disk: OrderedDict[str, int] | None = None  # digest -> size, LRU order; scanned lazily
+        self._disk_used = 0
+        self._lock = threading.RLock()
+        self._urls: OrderedDict[str, tuple[float, str]] = OrderedDict()  # url -> (expires, ref)
+        self._fetches: dict[str, asyncio.Task] = {}
+        self._http = None
+        # counters
+        self.puts = 0
+        self.dedup_hits = 0
+        self.memory_hits = 0
+        self.disk_reads = 0
+        self.evictions = 0
+        self.url_hits = 0
+        self.url_fetches = 0
+        self.url_fetch_ms = 0.0
+
+    def _scan(self):
+        """Builds the disk index from BLOB_DIR (oldest access first)."""
+        if self._disk is not None:
+            return
+        entries = []
+        if os.path.isdir(self.root):
+            for shard in os.listdir(self.root):
+                shard_dir = os.path.join(self.root, shard)
+                if not os.path.isdir(shard_dir):
+                    continue
+                for name in os.listdir(shard_dir):
+                    if name.endswith(".tmp"):
+                        continue
+                    st = os.stat(os.path.join(shard_dir, name))
+                    entries.append((st.st_atime, name, st.st_size))
+        entries.sort()
+        self._disk = OrderedDict((name, size) for _, name, size in entries)
+        self._disk_used = sum(size for _, _, size in entries)
+
+    def put(self, data: bytes) -> str:
+        """Stores data (if new) and returns its "blob:<sha256>" reference."""
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._scan()
+            self.puts += 1
+            if digest in self._disk and os.path.exists(path(digest)):
+                self.dedup_hits += 1
+                self._disk.move_to_end(digest)
+            else:
+                p = path(digest)
+                os.makedirs(os.path.dirname(p), exist_ok=True)
+                tmp = f"{p}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, p)  # atomic: readers never see a partial blob
+                self._disk_used += len(data) - self._disk.pop(digest, 0)
+                self._disk[digest] = len(data)
+                self._evict_disk()
+            self._remember(digest, data)
+        return ref(digest)
+
+    def put_data_url(self, url: str) -> str:
+        """Stores the payload of a data:...;base64 URL; returns its reference."""
+        _, encoded = url.split(",", 1)
+        return self.put(base64.b64decode(encoded))
+
+    def ingest(self, value):
+        """Turns a data URL into a blob reference; anything else is returned unchanged."""
+        if isinstance(value, str) and value.startswith("data:") and ";base64," in value[:100]:
+            return self.put_data_url(value)
+        return value
+
+    async def ingest_async(self, value):
+        """Like ingest(), but also downloads http(s) URLs (cached by URL) into the store."""
+        if not (isinstance(value, str) and value.startswith(("http://", "https://"))):
+            return self.ingest(value)
+        with self._lock:
+            entry = self._urls.get(value)
+            if entry is not None and entry[0] > time.monotonic() and os.path.exists(path(entry[1])):
+                self._urls.move_to_end(value)
+                self.url_hits += 1
+                self._touch(digest_of(entry[1]))
+                return entry[1]
+        task = self._fetches.get(value)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(value))
+            self._fetches[value] = task
+            task.add_done_callback(lambda _t: self._fetches.pop(value, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, url: str) -> str:
+        import httpx
+
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=FETCH_TIMEOUT, follow_redirects=True)
+        start = time.perf_counter()
+        limit = int(MAX_FETCH_MB * 1024 * 1024)
+        chunks, size = [], 0
+        async with self._http.stream("GET", url) as r:
+            r.raise_for_status()
+            async for chunk in r.aiter_bytes():
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError(f"Image at {url[:80]} exceeds {MAX_FETCH_MB:.0f}MB")
+                chunks.append(chunk)
+        ref_ = self.put(b"".join(chunks))
+        with self._lock:
+            self.url_fetches += 1
+            self.url_fetch_ms += (time.perf_counter() - start) * 1000
+            self._urls[url] = (time.monotonic() + URL_TTL, ref_)
+            self._urls.move_to_end(url)
+            while len(self._urls) > URL_CACHE_SIZE:
+                self._urls.popitem(last=False)
+        return ref_
+
+    def get(self, value: str) -> bytes:
+        digest = digest_of(value)
+        with self._lock:
+            data = self._memory.get(digest)
+            if data is not None:
+                self._memory.move_to_end(digest)
+                self.memory_hits += 1
+                self._touch(digest)
+                return data
+        try:
+            with open(path(digest), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise BlobNotFound(f"Blob {digest[:12]}… not found (expired or never uploaded); upload the image again")
+        with self._lock:
+            self.disk_reads += 1
+            self._remember(digest, data)
+            self._touch(digest)
+        return data
+
+    def touch(self, value: str):
+        """Marks a blob as used (e.g. referenced by a new request) so it is evicted last."""
+        with self._lock:
+            self._touch(digest_of(value))
+
+    def _touch(self, digest: str):
+        self._scan()
+        if digest in self._disk:
+            self._disk.move_to_end(digest)
+
+    def to_data_url(self, value: str) -> str:
+        data = self.get(value)
+        return f"data:{sniff_mime(data)};base64,{base64.b64encode(data).decode('utf-8')}"
+
+    def _remember(self, digest: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        if digest in self._memory:
+            self._memory.move_to_end(digest)
+            return
+        self._memory[digest] = data
+        self._memory_used += len(data)
+        while self._memory_used > self.memory_bytes and self._memory:
+            _, old = self._memory.popitem(last=False)
+            self._memory_used -= len(old)
+
+    def _evict_disk(self):
+        while self._disk_used > self.disk_bytes and len(self._disk) > 1:
+            digest, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            self.evictions += 1
+            old = self._memory.pop(digest, None)
+            if old is not None:
+                self._memory_used -= len(old)
+            try:
+                os.remove(path(digest))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._scan()
+            return {
+                "dir": self.root,
+                "blobs": len(self._disk),
+                "disk_bytes": self._disk_used,
+                "disk_budget_bytes": self.disk_bytes,
+                "memory_blobs": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "memory_budget_bytes": self.memory_bytes,
+                "puts": self.puts,
+                "dedup_hits": self.dedup_hits,
+                "memory_hits": self.memory_hits,
+                "disk_reads": self.disk_reads,
+                "evictions": self.evictions,
+                "urls_cached": len(self._urls),
+                "url_hits": self.url_hits,
+                "url_fetches": self.url_fetches,
+                "url_fetch_ms_avg": round(self.url_fetch_ms / self.url_fetches, 1) if self.url_fetches else None,
+            }
+
+
+store = BlobStore(BLOB_DIR, int(MEMORY_MB * 1024 * 1024), int(DISK_MB * 1024 * 1024))
@@ -0,0 +1,127 @@
+# cancellation.py
+"""
+Propagates client disconnects from the gateway into worker generation.
+
+Gateway side: every upstream worker call carries a "request_id". When the
+client disconnects (or every subscriber of a coalesced stream is gone) the
+gateway closes the upstream request and POSTs /worker_cancel
+{"request_id": ...} to that replica.
+
+Worker side: CancelRegistry maps request IDs to the in-flight generation
+(anything with cancel(), generated and max_new_tokens). Decode loops check
+the flag between steps and free the slot right away; the tokens that were
+not generated are counted as saved.
+"""
+import uuid
+import asyncio
+import threading
+from collections import defaultdict
+
+DISCONNECT_POLL_S = 0.5
+CANCEL_TIMEOUT_S = 2.0
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+# --------------------------
+# Worker side
+# --------------------------
+class CancelToken:
+    """Cancellation flag for one generation loop; the loop bumps generated per step."""
+
+    def __init__(self, max_new_tokens: int):
+        self.max_new_tokens = max_new_tokens
+        self.generated = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class CancelRegistry:
+    def __init__(self):
+        self._active: dict[str, object] = {}
+        self._lock = threading.RLock()
+        # counters
+        self.cancelled = 0
+        self.tokens_saved = 0
+
+    def register(self, request_id: str | None, job) -> str:
+        """Tracks job under request_id (a fresh ID if none); returns the ID."""
+        request_id = request_id or uuid.uuid4().hex
+        with self._lock:
+            self._active[request_id] = job
+        return request_id
+
+    def done(self, request_id: str):
+        with self._lock:
+            self._active.pop(request_id, None)
+
+    def cancel(self, request_id: str) -> dict:
+        """Flags the job to stop; returns how many tokens that saves (0 if already finished)."""
+        with self._lock:
+            job = self._active.pop(request_id, None)
+            if job is None:
+                return {"cancelled": False, "tokens_saved": 0}
+            job.cancel()
+            saved = max(0, job.max_new_tokens - job.generated)
+            self.cancelled += 1
+            self.tokens_saved += saved
+        return {"cancelled": True, "generated_tokens": job.generated, "tokens_saved": saved}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"active": len(self._active), "cancelled": self.cancelled, "tokens_saved": self.tokens_saved}
+
+
+# --------------------------
+# Gateway side
+# --------------------------
+_LOCK = threading.RLock()
+_STATS: dict[str, dict] = defaultdict(lambda: {"cancelled": 0, "tokens_saved": 0, "cancel_errors": 0})
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+async def cancel_upstream(pool, model: str, request_id: str):
+    """Tells the worker behind pool to stop generating request_id."""
+    try:
+        r = await pool.post("/worker_cancel", json={"request_id": request_id}, timeout=CANCEL_TIMEOUT_S)
+        body = r.json() if r.status_code == 200 else {}
+    except Exception as e:
+        print(f"⚠️ Could not cancel {model} request {request_id[:8]}: {e!r}")
+        with _LOCK:
+            _STATS[model]["cancel_errors"] += 1
+        return
+    with _LOCK:
+        _STATS[model]["cancelled"] += 1
+        _STATS[model]["tokens_saved"] += int(body.get("tokens_saved") or 0)
+    print(f"✂️ Cancelled {model} request {request_id[:8]} (saved ~{body.get('tokens_saved', 0)} tokens)")
+
+
+def schedule_cancel(pool, model: str, request_id: str):
+    """cancel_upstream in the background (callable from a cancelled task's cleanup)."""
+    asyncio.ensure_future(cancel_upstream(pool, model, request_id))
+
+
+async def wait_or_disconnect(task: asyncio.Future, disconnected):
+    """
+    Awaits task without cancelling it, polling disconnected() (e.g.
+    Request.is_disconnected) meanwhile; raises ClientDisconnected if the
+    client went away first. The caller decides whether to cancel task.
+    """
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_S)
+        if done:
+            return task.result()
+        if await disconnected():
+            raise ClientDisconnected()
+
+
+def stats() -> dict:
+    with _LOCK:
+        return {model: dict(s) for model, s in _STATS.items()}
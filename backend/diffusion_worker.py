@@ -5,6 +5,8 @@ import base64
 import uuid
 import os
 
+import blob_store
+
 TXT2IMG_SCRIPT = "/Users/sourena/Downloads/chat-app/mlx-examples/stable_diffusion/txt2image.py"
 IMG2IMG_SCRIPT = "/Users/sourena/Downloads/chat-app/mlx-examples/stable_diffusion/image2image.py"
 
@@ -12,11 +14,8 @@ async def generate_image(prompt: str, init_image: str | None = None) -> str:
     output_path = f"/tmp/{uuid.uuid4().hex}.png"
 
     if init_image:
-        # Save base64 input image to temp file
-        init_image_path = f"/tmp/{uuid.uuid4().hex}_input.png"
-        with open(init_image_path, "wb") as f:
-            header, encoded = init_image.split(",", 1)
-            f.write(base64.b64decode(encoded))
+        # Input image comes from the blob store (data URLs and remote URLs are stored once, by content hash)
+        init_image_path = blob_store.open_path(await blob_store.store.ingest_async(init_image))
 
         command = [
             "python", IMG2IMG_SCRIPT,
@@ -1,15 +1,21 @@
 # dynamic_mlx_worker.py
+import time
+_PROCESS_START = time.time()  # before the heavy imports, for spawn-phase timings
+
 import os
 import sys
+import json
+import threading
 import traceback
 
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-import uvicorn
 
-# mlx_lm API is (model, tokenizer) = load(...); generate(model, tokenizer, ...)
-from mlx_lm import load, generate
+from cancellation import CancelRegistry, CancelToken
+
+# mlx_lm API is (model, tokenizer) = load(...); stream_generate(model, tokenizer, ...)
+from mlx_lm import load, stream_generate
 import re
 
 DEFAULT_STOPS = ["### User:", "### System:", "<|eot_id|>", "</s>", "<|endoftext|>"]
@@ -29,6 +35,12 @@ except Exception:
 MODEL_ID = os.environ.get("DYN_MLX_MODEL_ID", "")
 PORT = int(os.environ.get("DYN_MLX_PORT", "21100"))
 STANDALONE = os.environ.get("DYN_MLX_STANDALONE") == "1"
+# Spare (pre-warmed) worker: imports done, waits for POST /load
+SPARE = os.environ.get("DYN_MLX_SPARE") == "1"
+
+# Spawn-to-ready phases reported to the gateway via /health and /load
+_timings = {"imports_ms": round((time.time() - _PROCESS_START) * 1000, 1)}
+_load_lock = threading.Lock()
 
 app = FastAPI()
 
@@ -36,53 +48,108 @@ app = FastAPI()
 _mlx_model = None
 _tokenizer = None
 
+class LoadRequest(BaseModel):
+    model_id: str
+    if _MODEL_CONFIG:
+        locals().update(_MODEL_CONFIG)
+
 class GenRequest(BaseModel):
     prompt: str
     max_new_tokens: int | None = 64
     temperature: float | None = 0.7
     top_p: float | None = 0.95
     stop: list[str] | None = None
+    request_id: str | None = None  # set by the gateway, for /worker_cancel
+    if _MODEL_CONFIG:
+        locals().update(_MODEL_CONFIG)
+
+class CancelRequest(BaseModel):
+    request_id: str
     if _MODEL_CONFIG:
         locals().update(_MODEL_CONFIG)
 
-def _safe_generate(model, tokenizer, prompt, *, max_new_tokens, temperature, top_p, stop):
+# In-flight generations by request_id
+cancels = CancelRegistry()
+
+def _generation_kwargs(*, max_new_tokens, temperature, top_p):
     # Build kwargs using the most compatible names
     kwargs = {"max_tokens": int(max_new_tokens or 64)}
     if temperature is not None:
         kwargs["temperature"] = float(temperature)
     if top_p is not None:
         kwargs["top_p"] = float(top_p)
-    if stop:
-        kwargs["stop"] = list(stop)
+    return kwargs
 
-    # Try, and if an unexpected kwarg is rejected, drop it and retry
+def _drop_rejected_kwarg(e: TypeError, kwargs: dict) -> bool:
+    # If an unexpected kwarg is rejected, drop it so the caller can retry
+    m = re.search(r"unexpected keyword argument '([^']+)'", str(e))
+    if not m or m.group(1) not in kwargs:
+        return False
+    kwargs.pop(m.group(1), None)
+    return True
+
+def _safe_stream_generate(model, tokenizer, prompt, *, max_new_tokens, temperature, top_p):
+    """Yields text deltas. stream_generate forwards kwargs lazily, so a rejected
+    kwarg only surfaces on the first next(); retry from there."""
+    kwargs = _generation_kwargs(max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p)
     while True:
+        gen = stream_generate(model, tokenizer, prompt, **kwargs)
         try:
-            return generate(model, tokenizer, prompt, **kwargs)
+            first = next(gen)
+        except StopIteration:
+            return
         except TypeError as e:
-            msg = str(e)
-            m = re.search(r"unexpected keyword argument '([^']+)'", msg)
-            if not m:
+            if not _drop_rejected_kwarg(e, kwargs):
                 raise
-            bad = m.group(1)
-            if bad in kwargs:
-                kwargs.pop(bad, None)
-                # Retry without the offending kwarg
-                continue
-            # If the offending arg name isn't in kwargs, just re-raise
-            raise
+            continue
+        break
+    # older mlx_lm versions yield plain strings
+    yield getattr(first, "text", first)
+    for chunk in gen:
+        yield getattr(chunk, "text", chunk)
 
 
 @app.get("/health")
 def health():
     ok = _mlx_model is not None
-    return {"ok": ok, "model_id": MODEL_ID}
+    return {
+        "ok": ok, "model_id": MODEL_ID, "spare": SPARE and not ok, "timings": _timings,
+        "cancellation": cancels.stats(),
+    }
+
+@app.post("/worker_cancel")
+def worker_cancel(req: CancelRequest):
+    """Stops a request's decode loop before its next token."""
+    return cancels.cancel(req.request_id)
+
+def _load_model(model_id: str):
+    global _mlx_model, _tokenizer, MODEL_ID
+    start = time.perf_counter()
+    # trust_remote_code helps for custom tokenizers/config
+    _mlx_model, _tokenizer = load(model_id, tokenizer_config={"trust_remote_code": True})
+    MODEL_ID = model_id
+    _timings["load_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+@app.post("/load")
+def load_model(req: LoadRequest):
+    """Loads a model into a spare worker. One model per process."""
+    with _load_lock:
+        if _mlx_model is not None:
+            if req.model_id == MODEL_ID:
+                return {"ok": True, "model_id": MODEL_ID, "timings": _timings}
+            return JSONResponse(status_code=409, content={"error": f"Worker already serves '{MODEL_ID}'"})
+        try:
+            _load_model(req.model_id)
+        except Exception as e:
+            traceback.print_exc()
+            return JSONResponse(status_code=500, content={"error": repr(e)})
+    return {"ok": True, "model_id": MODEL_ID, "timings": _timings}
 
 @app.on_event("startup")
 def _startup():
-    global _mlx_model, _tokenizer
-    if not STANDALONE:
-        # Imported somewhere? Don’t try to load.
+    _timings["startup_ms"] = round((time.time() - _PROCESS_START) * 1000, 1)
+    if not STANDALONE or SPARE:
+        # Imported somewhere, or a spare waiting for POST /load
         return
     if not MODEL_ID:
         # Fail fast, so parent process can read stderr.
@@ -90,8 +157,7 @@ def _startup():
         sys.exit(1)
 
     try:
-        # trust_remote_code helps for custom tokenizers/config
-        _mlx_model, _tokenizer = load(MODEL_ID, tokenizer_config={"trust_remote_code": True})
+        _load_model(MODEL_ID)
     except Exception as e:
         traceback.print_exc()
         # Fail fast so /mlx/load can capture stderr
@@ -99,29 +165,117 @@ def _startup():
 
 DEFAULT_STOPS = ["### User:", "### System:", "<|eot_id|>", "</s>", "<|endoftext|>"]
 
-@app.post("/generate")
-def generate_text(req: GenRequest):
-    if _mlx_model is None:
-        return JSONResponse(status_code=503, content={"error": "Model not loaded"})
+def _generate_events(req: GenRequest):
+    """
+    Yields {"text": "<delta>"} per decoded piece, then a final event with
+    finish_reason, usage and timings (or {"error": ...}). Stop strings are
+    applied here, between tokens, since stream_generate has no stop support:
+    decoding halts as soon as one appears. A cancelled request (POST
+    /worker_cancel, or the consumer closing the stream) stops the same way.
+    """
+    token = CancelToken(req.max_new_tokens or 64)
+    request_id = cancels.register(req.request_id, token)
+    finished = False
+    try:
+        for event in _decode_events(req, token):
+            finished = finished or "finish_reason" in event or "error" in event
+            yield event
+    finally:
+        if not finished:
+            cancels.cancel(request_id)  # the client went away mid-stream
+        cancels.done(request_id)
+
+def _decode_events(req: GenRequest, token: CancelToken):
+    # empty strings would match at position 0 (as in llama_engine.Sequence)
+    stops = [s for s in (req.stop or []) if s] or DEFAULT_STOPS
+    holdback = max(len(s) for s in stops) - 1
+    max_new_tokens = req.max_new_tokens or 64
+
+    start = time.perf_counter()
+    ttft = None
+    completion_tokens = 0
+    pending = ""
+    finish_reason = None
     try:
-        text = _safe_generate(
+        for delta in _safe_stream_generate(
             _mlx_model,
             _tokenizer,
             req.prompt,
-            max_new_tokens=req.max_new_tokens or 64,
+            max_new_tokens=max_new_tokens,
             temperature=req.temperature,
             top_p=req.top_p,
-            stop=(req.stop or DEFAULT_STOPS),
-        )
-        return {"text": text, "usage": {}}
+        ):
+            completion_tokens += 1
+            token.generated = completion_tokens
+            if token.cancelled:
+                finish_reason = "cancelled"
+                break
+            pending += delta or ""
+            hits = [pending.find(s) for s in stops if s in pending]
+            if hits:
+                pending = pending[:min(hits)]
+                finish_reason = "stop"
+            # hold back a possible partial stop string until the next piece arrives
+            cut = len(pending) if finish_reason else max(0, len(pending) - holdback)
+            out, pending = pending[:cut], pending[cut:]
+            if out:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                yield {"text": out}
+            if finish_reason:
+                break
+        if pending and not finish_reason:
+            yield {"text": pending}
     except Exception as e:
-        import traceback
         traceback.print_exc()
-        return JSONResponse(status_code=500, content={"error": f"{type(e).__name__}: {e}"})
+        yield {"error": f"{type(e).__name__}: {e}"}
+        return
+
+    if finish_reason is None:
+        finish_reason = "length" if completion_tokens >= max_new_tokens else "stop"
+    total = time.perf_counter() - start
+    yield {
+        "text": "",
+        "finish_reason": finish_reason,
+        "usage": {"completion_tokens": completion_tokens},
+        "timings": {
+            "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+            "total_ms": round(total * 1000, 1),
+        },
+    }
+
+@app.post("/generate")
+def generate_text(req: GenRequest):
+    if _mlx_model is None:
+        return JSONResponse(status_code=503, content={"error": "Model not loaded"})
+    text, final = "", {}
+    for event in _generate_events(req):
+        if "error" in event:
+            return JSONResponse(status_code=500, content=event)
+        text += event["text"]
+        if "finish_reason" in event:
+            final = event
+    return {
+        "text": text,
+        "finish_reason": final.get("finish_reason"),
+        "usage": final.get("usage", {}),
+        "timings": final.get("timings", {}),
+    }
 
 @app.post("/worker_generate")
 def worker_generate(req: GenRequest):
     return generate_text(req)
 
+@app.post("/worker_generate_stream")
+def worker_generate_stream(req: GenRequest):
+    """Same as /worker_generate, streamed as newline-delimited JSON events."""
+    if _mlx_model is None:
+        return JSONResponse(status_code=503, content={"error": "Model not loaded"})
+    return StreamingResponse(
+        (json.dumps(event) + "\n" for event in _generate_events(req)),
+        media_type="application/x-ndjson",
+    )
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    from worker_transport import serve
+    serve(app, PORT)
@@ -1,13 +1,101 @@
 # dynamic_registry.py
+"""
+Model ID -> worker replicas, for static (MODEL_WORKERS) and dynamic MLX models.
+
+Each model can run N replica processes. Requests are routed to the ready,
+non-ejected replica with the fewest outstanding requests. A replica is
+ejected for REPLICA_EJECT_SECONDS after REPLICA_EJECT_FAILURES consecutive
+failed requests or a failed health check, and rejoins once it recovers.
+
+Replicas also record last access and resident memory, so api.py can unload
+idle / least-recently-used dynamic models; an unloaded model is remembered
+and reloaded transparently by ensure_loaded() on its next request.
+"""
+import os
+import time
+import asyncio
 import threading
+import subprocess
+
+try:
+    import psutil
+except ImportError:  # fall back to `ps`
+    psutil = None
+
+EJECT_FAILURES = int(os.environ.get("REPLICA_EJECT_FAILURES", "3"))
+EJECT_SECONDS = float(os.environ.get("REPLICA_EJECT_SECONDS", "30"))
+
+
+class Replica:
+    def __init__(self, model_id: str, port: int, pid: int | None = None, ready: bool = True):
+        self.model_id = model_id
+        self.port = port
+        self.pid = pid
+        self.ready = ready
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.last_used = time.monotonic()
+        self.last_access = time.time()
+        self.rss_bytes: int | None = None
 
-# Model ID -> {"port": int, "pid": int}
+    def routable(self, now: float) -> bool:
+        return self.ready and self.ejected_until <= now
+
+    def eject(self, reason: str):
+        if self.ejected_until <= time.monotonic():
+            self.ejections += 1
+            print(f"🚫 Ejecting {self.model_id} replica on port {self.port} for {EJECT_SECONDS:.0f}s: {reason}")
+        self.ejected_until = time.monotonic() + EJECT_SECONDS
+
+    def stats(self) -> dict:
+        return {
+            "port": self.port,
+            "pid": self.pid,
+            "ready": self.ready,
+            "ejected": self.ejected_until > time.monotonic(),
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections": self.ejections,
+            "idle_s": round(time.monotonic() - self.last_used, 1) if not self.outstanding else 0.0,
+            "last_access": self.last_access,
+            "rss_mb": round(self.rss_bytes / 1024 / 1024, 1) if self.rss_bytes is not None else None,
+        }
+
+
+# Model ID -> {"port": int, "pid": int, "static": bool, "replicas": [Replica], "load": dict}
+# ("port"/"pid" are the first replica's, for callers that only need one;
+#  "load" holds the /mlx/load params used to reload an evicted model)
 _REGISTRY = {}
 _LOCK = threading.RLock()
 
-def register(model_id: str, port: int, pid: int):
+# Model ID -> load params of dynamic models unloaded by eviction
+_EVICTED = {}
+_RELOADER = None
+_RELOADS: dict[str, asyncio.Task] = {}
+
+def register(model_id: str, port: int, pid: int | None, ready: bool = True, static: bool = False) -> Replica:
+    """Adds a replica for model_id (creating the entry if needed)."""
     with _LOCK:
-        _REGISTRY[model_id] = {"port": port, "pid": pid}
+        entry = _REGISTRY.setdefault(model_id, {"port": port, "pid": pid, "static": static, "replicas": [], "load": {}})
+        replica = next((r for r in entry["replicas"] if r.port == port), None)
+        if replica is None:
+            replica = Replica(model_id, port, pid, ready)
+            entry["replicas"].append(replica)
+        else:
+            replica.pid, replica.ready = pid, ready
+        return replica
+
+def set_load_params(model_id: str, params: dict):
+    with _LOCK:
+        if model_id in _REGISTRY:
+            _REGISTRY[model_id]["load"] = dict(params)
+        _EVICTED.pop(model_id, None)
 
 def get(model_id: str):
     with _LOCK:
@@ -19,4 +107,151 @@ def all_models():
 
 def remove(model_id: str):
     with _LOCK:
-        _REGISTRY.pop(model_id, None)
+        return _REGISTRY.pop(model_id, None)
+
+def remove_replica(model_id: str, port: int):
+    with _LOCK:
+        entry = _REGISTRY.get(model_id)
+        if not entry:
+            return
+        entry["replicas"] = [r for r in entry["replicas"] if r.port != port]
+        if not entry["replicas"]:
+            _REGISTRY.pop(model_id, None)
+        else:
+            entry["port"], entry["pid"] = entry["replicas"][0].port, entry["replicas"][0].pid
+
+def replicas(model_id: str) -> list:
+    with _LOCK:
+        entry = _REGISTRY.get(model_id)
+        return list(entry["replicas"]) if entry else []
+
+def used_ports() -> set:
+    with _LOCK:
+        return {r.port for entry in _REGISTRY.values() for r in entry["replicas"]}
+
+def mark_ready(model_id: str, port: int, pid: int | None = None):
+    with _LOCK:
+        for r in replicas(model_id):
+            if r.port == port:
+                r.ready = True
+                if pid is not None:
+                    r.pid = pid
+
+# --------------------------
+# Routing
+# --------------------------
+def acquire(model_id: str) -> Replica | None:
+    """Picks the least-loaded routable replica and counts the request against it.
+    If every replica is ejected, falls back to the least-loaded ready one."""
+    with _LOCK:
+        ready = [r for r in replicas(model_id) if r.ready]
+        if not ready:
+            return None
+        now = time.monotonic()
+        candidates = [r for r in ready if r.routable(now)] or ready
+        replica = min(candidates, key=lambda r: (r.outstanding, r.requests))
+        replica.outstanding += 1
+        replica.requests += 1
+        replica.last_used = time.monotonic()
+        replica.last_access = time.time()
+        return replica
+
+def release(replica: Replica | None, ok: bool = True):
+    if replica is None:
+        return
+    with _LOCK:
+        replica.outstanding = max(0, replica.outstanding - 1)
+        replica.last_used = time.monotonic()
+        if ok:
+            replica.consecutive_failures = 0
+            return
+        replica.errors += 1
+        replica.consecutive_failures += 1
+        if replica.consecutive_failures >= EJECT_FAILURES:
+            replica.eject(f"{replica.consecutive_failures} consecutive failures")
+
+def set_health(replica: Replica, ok: bool):
+    with _LOCK:
+        if ok:
+            if replica.ejected_until > time.monotonic():
+                print(f"✅ {replica.model_id} replica on port {replica.port} is healthy again")
+            replica.ejected_until = 0.0
+            replica.consecutive_failures = 0
+        else:
+            replica.eject("health check failed")
+
+def last_used(model_id: str) -> float:
+    """Monotonic time of the model's most recent request start/finish (busy models count as now)."""
+    reps = replicas(model_id)
+    if any(r.outstanding for r in reps):
+        return time.monotonic()
+    return max((r.last_used for r in reps), default=0.0)
+
+def rss_bytes(model_id: str) -> int:
+    return sum(r.rss_bytes or 0 for r in replicas(model_id))
+
+def sample_rss():
+    """Refreshes rss_bytes for every replica with a known pid."""
+    for entry in all_models().values():
+        for r in list(entry["replicas"]):
+            if r.pid is not None:
+                r.rss_bytes = _process_rss(r.pid)
+
+def _process_rss(pid: int) -> int | None:
+    try:
+        if psutil is not None:
+            return psutil.Process(pid).memory_info().rss
+        out = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True, timeout=2)
+        return int(out.stdout.strip()) * 1024 if out.stdout.strip() else None
+    except Exception:
+        return None
+
+# --------------------------
+# Eviction / transparent reload
+# --------------------------
+def mark_evicted(model_id: str, load_params: dict):
+    with _LOCK:
+        _EVICTED[model_id] = dict(load_params)
+
+def forget_evicted(model_id: str):
+    with _LOCK:
+        _EVICTED.pop(model_id, None)
+
+def evicted() -> dict:
+    with _LOCK:
+        return dict(_EVICTED)
+
+def set_reloader(fn):
+    """fn(model_id, load_params) is an async callable that loads the model again."""
+    global _RELOADER
+    _RELOADER = fn
+
+async def ensure_loaded(model_id: str):
+    """Returns the model's entry, reloading it first if it was evicted; None if unknown."""
+    entry = get(model_id)
+    if entry is not None:
+        return entry
+    with _LOCK:
+        params = _EVICTED.get(model_id)
+    if params is None or _RELOADER is None:
+        return None
+    task = _RELOADS.get(model_id)
+    if task is None:
+        print(f"♻️ Reloading evicted model {model_id}")
+        task = asyncio.ensure_future(_RELOADER(model_id, params))
+        _RELOADS[model_id] = task
+        task.add_done_callback(lambda _t: _RELOADS.pop(model_id, None))
+    await asyncio.shield(task)
+    return get(model_id)
+
+def stats() -> dict:
+    with _LOCK:
+        return {
+            model_id: {
+                "static": entry["static"],
+                "replicas": [r.stats() for r in entry["replicas"]],
+                "outstanding": sum(r.outstanding for r in entry["replicas"]),
+                "rss_mb": round(sum(r.rss_bytes or 0 for r in entry["replicas"]) / 1024 / 1024, 1),
+            }
+            for model_id, entry in _REGISTRY.items()
+        }
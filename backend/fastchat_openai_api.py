@@ -1,10 +1,22 @@
-import httpx
 from fastapi import Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import traceback
+import asyncio
+import json
+import time
+import uuid
 import re
 
-from dynamic_registry import get as get_dynamic_port  # ← NEW
+from dynamic_registry import ensure_loaded as get_dynamic_port  # reloads evicted dynamic models
+import worker_client
+import scheduler
+from scheduler import AdmissionRejected
+from response_cache import cache as response_cache
+import single_flight
+import blob_store
+import httpx
+import cancellation
+from cancellation import ClientDisconnected
 
 # Port mapping for each supported static model
 MODEL_PORTS = {
@@ -55,7 +67,159 @@ def _clean_dynamic_output(s: str) -> str:
         cleaned = cleaned[: cleaned[:-40].find(tail) + len(tail)]
     return cleaned.strip()
 
+def _normalize_stop(stop) -> list:
+    """OpenAI allows "stop" as one string or a list; workers get a list of non-empty strings."""
+    if isinstance(stop, str):
+        stop = [stop]
+    if not isinstance(stop, (list, tuple)):
+        return []
+    # an empty stop would match at position 0 and end generation immediately
+    return [s for s in stop if isinstance(s, str) and s]
+
+def _sse(data) -> str:
+    return f"data: {json.dumps(data) if not isinstance(data, str) else data}\n\n"
+
+def _chunker(model_name: str):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+
+    def _chunk(delta: dict, finish_reason=None, **extra):
+        body = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model_name,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        body.update(extra)
+        return _sse(body)
+
+    return _chunk
+
+async def _relay_stream(port: int, worker_payload: dict, model_name: str, started: float,
+                        on_done=None, on_result=None):
+    """
+    Relays the worker's NDJSON /worker_generate_stream events as OpenAI
+    chat.completion.chunk SSE events. Time-to-first-token and total latency
+    are measured from when the gateway received the request and reported in
+    the final chunk under "timings". on_result gets the completed worker
+    result ({"text", "finish_reason", "usage"}) if the stream finished cleanly.
+    The least-loaded replica of model_name is used, else port. If the stream
+    is abandoned (client disconnect), the worker is told to stop generating.
+    """
+    _chunk = _chunker(model_name)
+    try:
+        async for event in _relay_stream_events(port, worker_payload, model_name, started, _chunk, on_result):
+            yield event
+    finally:
+        if on_done is not None:
+            on_done()
+
+async def _replay_stream(result: dict, model_name: str, started: float):
+    """Streams a cached worker result in the same SSE shape as _relay_stream."""
+    _chunk = _chunker(model_name)
+    yield _chunk({"role": "assistant"})
+    if result.get("text"):
+        yield _chunk({"content": result["text"]})
+    total_ms = round((time.perf_counter() - started) * 1000, 1)
+    yield _chunk(
+        {}, finish_reason=result.get("finish_reason") or "stop", usage=result.get("usage", {}),
+        timings={"ttft_ms": total_ms, "total_ms": total_ms, "cache": "hit"},
+    )
+    yield _sse("[DONE]")
+
+async def _relay_stream_events(port: int, worker_payload: dict, model_name: str, started: float, _chunk,
+                               on_result=None):
+    yield _chunk({"role": "assistant"})
+
+    ttft = None
+    text = ""
+    finish_reason = "stop"
+    usage, worker_timings = {}, {}
+    request_id = cancellation.new_request_id()
+    try:
+        async with worker_client.route(model_name, port) as lease, \
+                lease.pool.stream("POST", "/worker_generate_stream", json={**worker_payload, "request_id": request_id}) as response:
+            model_url = f"{lease.pool.base_url}/worker_generate_stream"
+            if response.status_code >= 400:
+                if response.status_code >= 500:
+                    lease.fail()
+                err = (await response.aread()).decode("utf-8", errors="replace")
+                print(f"❌ Worker error {response.status_code} from {model_url}: {err}")
+                yield _sse({"error": err})
+                yield _sse("[DONE]")
+                return
+
+            finished = False
+            try:
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if "error" in event:
+                        finished = True
+                        print(f"❌ Worker stream error from {model_url}: {event['error']}")
+                        yield _sse({"error": event["error"]})
+                        yield _sse("[DONE]")
+                        return
+                    if event.get("text"):
+                        if ttft is None:
+                            ttft = time.perf_counter() - started
+                        text += event["text"]
+                        yield _chunk({"content": event["text"]})
+                    if event.get("finish_reason"):
+                        finished = True
+                        finish_reason = event["finish_reason"]
+                        usage = event.get("usage", {})
+                        worker_timings = event.get("timings", {})
+            finally:
+                if not finished:
+                    # client went away (or the relay failed) mid-generation
+                    cancellation.schedule_cancel(lease.pool, model_name, request_id)
+    except Exception as e:
+        print("❌ ERROR relaying stream from model worker:")
+        traceback.print_exc()
+        yield _sse({"error": repr(e)})
+        yield _sse("[DONE]")
+        return
+
+    total = time.perf_counter() - started
+    timings = {
+        "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+        "total_ms": round(total * 1000, 1),
+        "worker": worker_timings,
+    }
+    print(f"⏱️ {model_name} stream: ttft={timings['ttft_ms']}ms total={timings['total_ms']}ms")
+    if on_result is not None:
+        on_result({"text": text, "finish_reason": finish_reason, "usage": usage})
+    yield _chunk({}, finish_reason=finish_reason, usage=usage, timings=timings)
+    yield _sse("[DONE]")
+
+def _completion_response(result: dict, dynamic: bool, model_name: str, started: float,
+                         queued_s: float, cache: str | None = None) -> JSONResponse:
+    text = result.get("text", "")
+    if dynamic:
+        text = _clean_dynamic_output(text)
+
+    total = time.perf_counter() - started
+    print(f"⏱️ {model_name}: total={total * 1000:.1f}ms")
+    timings = {"queue_ms": round(queued_s * 1000, 1), "total_ms": round(total * 1000, 1)}
+    if cache:
+        timings["cache"] = cache
+    return JSONResponse({
+        "id": "chatcmpl-custom-001",
+        "object": "chat.completion",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": text},
+            "finish_reason": result.get("finish_reason") or "stop",
+        }],
+        "usage": result.get("usage", {}),
+        "timings": timings,
+    })
+
 async def chat_completion(request: Request):
+    started = time.perf_counter()
     try:
         payload = await request.json()
         model_name = payload.get("model", "meta-llama/Llama-3.2-1B-Instruct")
@@ -63,12 +227,14 @@ async def chat_completion(request: Request):
         temperature = payload.get("temperature", 0.7)
         top_p = payload.get("top_p", 0.95)
         frequency_penalty = payload.get("frequency_penalty", 0.0)
-        stop = payload.get("stop", []) or []
+        stop = _normalize_stop(payload.get("stop"))
 
         # ---------- Resolve target worker port ----------
+        # (the fallback when the model has no registered replicas; see worker_client.route)
         port = MODEL_PORTS.get(model_name)
+        dynamic = port is None
         if port is None:
-            dyn = get_dynamic_port(model_name)  # dynamic MLX worker?
+            dyn = await get_dynamic_port(model_name)  # dynamic MLX worker?
             if dyn is not None:
                 port = dyn["port"]
 
@@ -146,7 +312,7 @@ async def chat_completion(request: Request):
             "temperature": float(temperature) if temperature is not None else 0.7,
             "top_p": float(top_p) if top_p is not None else 0.95,
             "frequency_penalty": float(frequency_penalty) if frequency_penalty is not None else 0.0,
-            "stop": stop or [],
+            "stop": stop,
             "max_new_tokens": int(payload.get("max_tokens", 512)),
         }            
 
@@ -157,8 +323,13 @@ async def chat_completion(request: Request):
             prompt = build_llama3_prompt(messages)
             # Ensure we stop generation when the model emits end-of-turn
             if "<|eot_id|>" not in stop:
-                stop = list(stop) + ["<|eot_id|>"]
+                stop = stop + ["<|eot_id|>"]
             worker_payload["prompt"] = prompt
+            # Optional speculative decoding (worker falls back to normal decoding if it has no draft model)
+            if payload.get("speculative") is not None:
+                worker_payload["speculative"] = bool(payload["speculative"])
+            if payload.get("num_draft_tokens"):
+                worker_payload["num_draft_tokens"] = int(payload["num_draft_tokens"])
 
         elif model_name == "mlx-community/Qwen2-VL-2B-Instruct-4bit":
             # Keep your existing Qwen-VL behavior (multimodal)
@@ -171,6 +342,24 @@ async def chat_completion(request: Request):
                         if item.get("type") == "image_url":
                             worker_payload["image"] = item["image_url"]
                             break
+            # Pass images to the worker as blob refs; it reads the bytes from the shared store
+            image = worker_payload.get("image")
+            if isinstance(image, dict):  # OpenAI style {"url": ...}
+                image = image.get("url")
+            # (remote URLs are downloaded here asynchronously, cached by URL)
+            try:
+                image = await blob_store.store.ingest_async(image)
+                if blob_store.is_ref(image):
+                    blob_store.open_path(image)
+                    blob_store.store.touch(image)
+            except (ValueError, blob_store.BlobNotFound, httpx.HTTPError) as e:
+                return JSONResponse(status_code=400, content={"error": f"Cannot load image: {e.args[0] if e.args else e}"})
+            if image is not None:
+                worker_payload["image"] = image
+            # Visual-token budget: a quality tier or an explicit token / pixel cap
+            for key in ("image_quality", "max_image_tokens", "max_image_pixels"):
+                if payload.get(key) is not None:
+                    worker_payload[key] = payload[key]
 
         else:
             # Dynamic MLX worker (generic text-only)
@@ -192,18 +381,82 @@ async def chat_completion(request: Request):
                 "User:", "System:", "Assistant:",
                 "<|eot_id|>", "</s>", "<|endoftext|>"
             ]
-            incoming = stop or []
-            worker_payload["stop"] = list(dict.fromkeys([*incoming, *default_stops]))
+            stop = list(dict.fromkeys([*stop, *default_stops]))
 
 
-        # add stop (possibly updated for llama)
+        # add stop (possibly updated for llama / dynamic defaults); workers halt
+        # decoding as soon as one of these appears
         worker_payload["stop"] = stop
 
+        # ---------- Response cache ----------
+        use_cache = response_cache.enabled_for(worker_payload, payload.get("cache"))
+        cached = response_cache.get(model_name, worker_payload) if use_cache else None
+        if cached is not None:
+            print(f"💾 {model_name}: response cache hit")
+            if payload.get("stream"):
+                return StreamingResponse(_replay_stream(cached, model_name, started), media_type="text/event-stream")
+            return _completion_response(cached, dynamic, model_name, started, queued_s=0.0, cache="hit")
+
+        def _store(result: dict):
+            if use_cache and result.get("finish_reason") not in ("error", "cancelled"):
+                response_cache.put(model_name, worker_payload, result)
+
+        # Identical requests already in flight share one upstream generation
+        # ("cache": false opts out of both caching and coalescing)
+        coalesce = payload.get("cache") is not False
+        sched = scheduler.get(model_name)
+
+        # ---------- Stream from worker ----------
+        # Dynamic output cleaning needs the full text, so streamed replies rely on
+        # the worker's stop strings instead.
+        if payload.get("stream"):
+            flight, leader = single_flight.open_stream(model_name, worker_payload) if coalesce else (None, True)
+            if not leader:
+                print(f"🔗 {model_name}: joined an identical in-flight stream")
+                return StreamingResponse(flight.subscribe(), media_type="text/event-stream")
+
+            # ---------- Admission control ----------
+            try:
+                queued_s = await sched.acquire()
+            except BaseException as e:
+                if flight is not None:
+                    await flight.abort(_sse({"error": getattr(e, "detail", repr(e))}), _sse("[DONE]"))
+                raise
+            admitted_at = time.perf_counter()
+            released = False
+
+            def _release():
+                nonlocal released
+                if not released:
+                    released = True
+                    sched.release(time.perf_counter() - admitted_at)
+
+            events = _relay_stream(port, worker_payload, model_name, started, on_done=_release, on_result=_store)
+            if flight is None:
+                return StreamingResponse(events, media_type="text/event-stream")
+            flight.start(events)
+            return StreamingResponse(flight.subscribe(), media_type="text/event-stream")
+
         # ---------- Call worker ----------
-        timeout = httpx.Timeout(60.0)
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            model_url = f"http://localhost:{port}/worker_generate"
-            response = await client.post(model_url, json=worker_payload)
+        async def _call_worker():
+            queued_s = await sched.acquire()
+            admitted_at = time.perf_counter()
+            try:
+                async with worker_client.route(model_name, port) as lease:
+                    model_url = f"{lease.pool.base_url}/worker_generate"
+                    request_id = cancellation.new_request_id()
+                    try:
+                        response = await lease.pool.post(
+                            "/worker_generate", json={**worker_payload, "request_id": request_id},
+                        )
+                    except asyncio.CancelledError:
+                        # every waiting client disconnected
+                        cancellation.schedule_cancel(lease.pool, model_name, request_id)
+                        raise
+                    if response.status_code >= 500:
+                        lease.fail()
+            finally:
+                sched.release(time.perf_counter() - admitted_at)
 
             # If worker failed, surface its error body (JSON or text) instead of raising blindly
             if response.status_code >= 400:
@@ -213,24 +466,35 @@ async def chat_completion(request: Request):
                     err_body = {"raw": response.text}
                 # Log for server console visibility
                 print(f"❌ Worker error {response.status_code} from {model_url}: {err_body}")
-                return JSONResponse(status_code=500, content={"error": err_body})
+                return queued_s, None, err_body
 
             result = response.json()
-            text = result.get("text", "")
-            if port not in MODEL_PORTS.values():  # i.e., dynamic
-                text = _clean_dynamic_output(text)
-
-        return JSONResponse({
-            "id": "chatcmpl-custom-001",
-            "object": "chat.completion",
-            "choices": [{
-                "index": 0,
-                "message": {"role": "assistant", "content": text},
-                "finish_reason": "stop",
-            }],
-            "usage": result.get("usage", {}),
-        })
+            _store(result)
+            return queued_s, result, None
 
+        if coalesce:
+            queued_s, result, err_body = await single_flight.run(
+                model_name, worker_payload, _call_worker, disconnected=request.is_disconnected,
+            )
+        else:
+            task = asyncio.ensure_future(_call_worker())
+            try:
+                queued_s, result, err_body = await cancellation.wait_or_disconnect(task, request.is_disconnected)
+            finally:
+                if not task.done():
+                    task.cancel()
+        if err_body is not None:
+            return JSONResponse(status_code=500, content={"error": err_body})
+        return _completion_response(result, dynamic, model_name, started, queued_s=queued_s, cache="miss" if use_cache else None)
+
+
+    except ClientDisconnected:
+        print(f"🔌 Client disconnected; abandoned its {payload.get('model')} request")
+        return JSONResponse(status_code=499, content={"error": "Client disconnected"})
+
+    except AdmissionRejected as e:
+        print(f"🚦 {e.detail} (HTTP {e.status_code}, Retry-After {e.headers['Retry-After']}s)")
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail}, headers=e.headers)
 
     except Exception as e:
         print("❌ ERROR forwarding to model worker:")
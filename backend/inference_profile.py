@@ -0,0 +1,168 @@
+# inference_profile.py
+"""
+Inference profiles for the Llama worker (model_worker.py):
+
+- fp32: full precision (the original behaviour)
+- bf16: bfloat16 weights, about half the memory of fp32
+- int8: fp32 load, then dynamic int8 quantization of the MLP and LM-head
+  linears (CPU only). Attention projections stay in float so LoRA adapters,
+  which target q/k/v/o_proj, still attach.
+
+Quality / speed check against fp32 on a fixed prompt set:
+
+    python inference_profile.py --profile int8
+"""
+import time
+import argparse
+import logging
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+logger = logging.getLogger(__name__)
+
+PROFILES = ("fp32", "bf16", "int8")
+
+# Linear layers quantized by the int8 profile (name suffixes)
+INT8_LINEARS = ("gate_proj", "up_proj", "down_proj", "lm_head")
+
+CHECK_PROMPTS = [
+    "Explain what a hash map is in two sentences.",
+    "Write a haiku about autumn rain.",
+    "What is the capital of Australia, and why is it not Sydney?",
+    "List three tips for writing readable Python code.",
+    "Summarize the plot of Romeo and Juliet in one paragraph.",
+    "Convert 72 degrees Fahrenheit to Celsius and show the formula.",
+    "Give a short definition of photosynthesis for a ten-year-old.",
+    "Suggest a name for a coffee shop run by robots.",
+]
+
+
+def resolve_device(profile: str, device: str) -> str:
+    if profile == "int8" and device != "cpu":
+        logger.warning(f"⚠️ int8 dynamic quantization runs on CPU only; ignoring device '{device}'")
+        return "cpu"
+    return device
+
+
+def load_model(model_name: str, profile: str = "fp32", device: str = "cpu"):
+    """Loads model_name for the given profile; returns (model, device)."""
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown inference profile '{profile}'. Expected one of {PROFILES}.")
+    device = resolve_device(profile, device)
+    dtype = torch.bfloat16 if profile == "bf16" else torch.float32
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype).to(device).eval()
+    if profile == "int8":
+        qconfig = torch.ao.quantization.default_dynamic_qconfig
+        spec = {
+            name: qconfig for name, module in model.named_modules()
+            if isinstance(module, torch.nn.Linear) and name.split(".")[-1] in INT8_LINEARS
+        }
+        torch.ao.quantization.quantize_dynamic(model, qconfig_spec=spec, dtype=torch.qint8, inplace=True)
+    return model, device
+
+
+def model_bytes(model) -> int:
+    """Parameter bytes, counting packed int8 weights of dynamically quantized linears."""
+    total = sum(p.numel() * p.element_size() for p in model.parameters())
+    for module in model.modules():
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(module, "weight"):
+            w = module.weight()
+            total += w.numel() * w.element_size()
+    return total
+
+
+def _generate(model, tokenizer, device: str, prompt: str, max_new_tokens: int):
+    ids = tokenizer(prompt, return_tensors="pt").to(device)
+    start = time.perf_counter()
+    with torch.inference_mode():
+        out = model.generate(
+            **ids, max_new_tokens=max_new_tokens, do_sample=False,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+    elapsed = time.perf_counter() - start
+    return out[0, ids["input_ids"].shape[1]:].tolist(), elapsed
+
+
+def _agreement(reference: list, candidate: list) -> float:
+    """Fraction of reference tokens matched before the first divergence."""
+    n = 0
+    for a, b in zip(reference, candidate):
+        if a != b:
+            break
+        n += 1
+    return n / len(reference) if reference else 1.0
+
+
+def check_profile(model_name: str, profile: str, device: str = "cpu",
+                  prompts: list | None = None, max_new_tokens: int = 64) -> dict:
+    """
+    Greedy-decodes the prompt set with fp32 and with profile, and reports
+    tokens/sec for each, the speedup, exact-match rate and mean prefix
+    agreement of the outputs, plus weight memory.
+    """
+    prompts = prompts or CHECK_PROMPTS
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    def _run(p):
+        model, dev = load_model(model_name, p, device)
+        outputs, tokens, seconds = [], 0, 0.0
+        _generate(model, tokenizer, dev, prompts[0], 4)  # warm-up
+        for prompt in prompts:
+            ids, elapsed = _generate(model, tokenizer, dev, prompt, max_new_tokens)
+            outputs.append(ids)
+            tokens += len(ids)
+            seconds += elapsed
+        result = {
+            "profile": p,
+            "device": dev,
+            "weights_mb": round(model_bytes(model) / 1024 / 1024, 1),
+            "tokens_per_s": round(tokens / seconds, 2) if seconds else None,
+        }
+        del model
+        return result, outputs
+
+    baseline, ref_outputs = _run("fp32")
+    candidate, outputs = _run(profile)
+    exact = sum(a == b for a, b in zip(ref_outputs, outputs))
+    return {
+        "model": model_name,
+        "prompts": len(prompts),
+        "max_new_tokens": max_new_tokens,
+        "fp32": baseline,
+        profile: candidate,
+        "speedup": (
+            round(candidate["tokens_per_s"] / baseline["tokens_per_s"], 2)
+            if baseline["tokens_per_s"] and candidate["tokens_per_s"] else None
+        ),
+        "exact_match_rate": round(exact / len(prompts), 3),
+        "mean_prefix_agreement": round(sum(map(_agreement, ref_outputs, outputs)) / len(prompts), 3),
+        "samples": [
+            {
+                "prompt": prompt,
+                "fp32": tokenizer.decode(a, skip_special_tokens=True),
+                profile: tokenizer.decode(b, skip_special_tokens=True),
+            }
+            for prompt, a, b in list(zip(prompts, ref_outputs, outputs))[:3]
+        ],
+    }
+
+
+if __name__ == "__main__":
+    import json
+
+    p = argparse.ArgumentParser(description="Compare an inference profile against fp32.")
+    p.add_argument("--model", default="meta-llama/Llama-3.2-1B-Instruct")
+    p.add_argument("--profile", choices=PROFILES, default="int8")
+    p.add_argument("--device", default="cpu")
+    p.add_argument("--max_new_tokens", type=int, default=64)
+    p.add_argument("--prompts_file", help="Optional text file, one prompt per line")
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    prompts = None
+    if args.prompts_file:
+        with open(args.prompts_file, "r", encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    print(json.dumps(check_profile(args.model, args.profile, args.device, prompts, args.max_new_tokens), indent=2))
@@ -0,0 +1,883 @@
+# llama_engine.py
+"""
+Continuous-batching decode loop for the Llama worker (model_worker.py).
+
+Handlers submit Sequences; a single background thread owns the model. Between
+decode steps it prefills newly arrived sequences and merges them into the
+running batch (left-padded KV cache), and drops sequences the moment they hit
+EOS, a stop sequence or max_new_tokens. Each sequence keeps its own sampling params, and
+results are pushed back to the handler's event loop as they are decoded.
+Sequences that ask for speculative decoding are decoded outside the batch,
+one draft-and-verify round each per loop iteration.
+"""
+import os
+import time
+import queue
+import copy
+import asyncio
+import logging
+import threading
+import traceback
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+
+# --------------------------
+# ✅ KV cache helpers
+# --------------------------
+def cache_to_tuples(cache):
+    """Returns the cache as a tuple of per-layer (key, value) tensors [B, H, T, D]."""
+    if isinstance(cache, (tuple, list)):
+        return tuple(cache)
+    if hasattr(cache, "layers"):  # transformers >= 4.56
+        return tuple((layer.keys, layer.values) for layer in cache.layers)
+    return cache.to_legacy_cache()
+
+
+def tuples_to_cache(kv):
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(kv)
+    return DynamicCache(kv)
+
+
+def _left_pad(t: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    n = length - t.shape[dim]
+    if n <= 0:
+        return t
+    pad = [0, 0] * (t.dim() - 1 - dim) + [n, 0]
+    return F.pad(t, pad)
+
+
+def _kv_bytes(kv) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+
+# --------------------------
+# ✅ Prefix KV cache
+# --------------------------
+@dataclass
+class _PrefixEntry:
+    tokens: list
+    kv: tuple
+    nbytes: int
+    hashes: list
+
+
+class PrefixCache:
+    """
+    LRU cache of prompt-prefix KV tensors under a memory budget.
+
+    Prompts are split into fixed-size token blocks and each block boundary is
+    keyed by a chained hash (namespace, block_1, ..., block_n), so one stored
+    prompt serves every shorter prefix of it too, e.g. a shared system prompt
+    or the earlier turns of a conversation.
+    """
+
+    def __init__(self, budget_bytes: int, block_size: int = 32):
+        self.budget_bytes = budget_bytes
+        self.block_size = block_size
+        self._entries: OrderedDict[int, _PrefixEntry] = OrderedDict()
+        self._index: dict[int, tuple[int, int]] = {}  # block hash -> (entry id, prefix length)
+        self._next_id = 0
+        self.bytes = 0
+        # counters
+        self.lookups = 0
+        self.hits = 0
+        self.tokens_saved = 0
+        self.evictions = 0
+
+    def _block_hashes(self, namespace, ids: list) -> list[tuple[int, int]]:
+        h = hash(namespace)
+        out = []
+        for end in range(self.block_size, len(ids) + 1, self.block_size):
+            h = hash((h, tuple(ids[end - self.block_size:end])))
+            out.append((end, h))
+        return out
+
+    def lookup(self, namespace, ids: list):
+        """Returns (n_cached_tokens, kv) for the longest cached prefix, or (0, None)."""
+        self.lookups += 1
+        for end, h in reversed(self._block_hashes(namespace, ids)):
+            if end >= len(ids):
+                continue  # leave at least one token to prefill for the next-token logits
+            hit = self._index.get(h)
+            entry = self._entries.get(hit[0]) if hit else None
+            if entry is None or entry.tokens[:end] != ids[:end]:
+                continue
+            self._entries.move_to_end(hit[0])
+            self.hits += 1
+            self.tokens_saved += end
+            return end, tuple((k[:, :, :end], v[:, :, :end]) for k, v in entry.kv)
+        return 0, None
+
+    def insert(self, namespace, ids: list, cache):
+        hashes = self._block_hashes(namespace, ids)
+        if not hashes:
+            return
+        hit = self._index.get(hashes[-1][1])
+        if hit and hit[0] in self._entries and hit[1] == hashes[-1][0]:
+            self._entries.move_to_end(hit[0])
+            return
+        n = hashes[-1][0]
+        kv = tuple((k[:, :, :n].clone(), v[:, :, :n].clone()) for k, v in cache_to_tuples(cache))
+        nbytes = _kv_bytes(kv)
+        if nbytes > self.budget_bytes:
+            return
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = _PrefixEntry(list(ids[:n]), kv, nbytes, [h for _, h in hashes])
+        for end, h in hashes:
+            self._index[h] = (entry_id, end)
+        self.bytes += nbytes
+        while self.bytes > self.budget_bytes and self._entries:
+            old_id, old = self._entries.popitem(last=False)
+            for h in old.hashes:
+                if self._index.get(h, (None,))[0] == old_id:
+                    del self._index[h]
+            self.bytes -= old.nbytes
+            self.evictions += 1
+
+    def hit_rate(self) -> float | None:
+        return round(self.hits / self.lookups, 3) if self.lookups else None
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "budget_bytes": self.budget_bytes,
+            "block_size": self.block_size,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hit_rate(),
+            "prefill_tokens_saved": self.tokens_saved,
+            "evictions": self.evictions,
+        }
+
+
+# --------------------------
+# ✅ Sampling
+# --------------------------
+def sample_next(logits: torch.Tensor, temps: torch.Tensor, top_ps: torch.Tensor) -> torch.Tensor:
+    """Per-row temperature / nucleus sampling; rows with temperature <= 0 are greedy."""
+    logits = logits.float()
+    greedy = logits.argmax(-1)
+    probs = torch.softmax(logits / temps.clamp(min=1e-5).unsqueeze(1), dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    outside = sorted_probs.cumsum(-1) - sorted_probs > top_ps.unsqueeze(1)
+    sorted_probs = sorted_probs.masked_fill(outside, 0.0)
+    sampled = sorted_idx.gather(1, torch.multinomial(sorted_probs, 1)).squeeze(1)
+    return torch.where(temps <= 0, greedy, sampled)
+
+
+def token_probs(logits: torch.Tensor, temps: torch.Tensor, top_ps: torch.Tensor) -> torch.Tensor:
+    """
+    The distribution sample_next draws from, per row: nucleus-filtered and
+    renormalized, or one-hot on the argmax for rows with temperature <= 0.
+    """
+    logits = logits.float()
+    probs = torch.softmax(logits / temps.clamp(min=1e-5).unsqueeze(1), dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    outside = sorted_probs.cumsum(-1) - sorted_probs > top_ps.unsqueeze(1)
+    probs = torch.zeros_like(probs).scatter(1, sorted_idx, sorted_probs.masked_fill(outside, 0.0))
+    probs = probs / probs.sum(-1, keepdim=True)
+    greedy = F.one_hot(logits.argmax(-1), logits.shape[-1]).to(probs.dtype)
+    return torch.where((temps <= 0).unsqueeze(1), greedy, probs)
+
+
+# --------------------------
+# ✅ Stopping criteria
+# --------------------------
+class StopCriteria:
+    """
+    Per-sequence stop checks applied after every decoded token:
+    - EOS ids, plus any stop string that is a single special token
+      (e.g. "<|eot_id|>"), end the sequence without emitting the token;
+    - other stop strings are matched on the token ids of the tail of the
+      output, with a text match on the newly decoded piece as a fallback for
+      stops that straddle token boundaries differently.
+    """
+
+    def __init__(self, tokenizer, eos_ids: set, stop: list):
+        added = tokenizer.get_added_vocab() if hasattr(tokenizer, "get_added_vocab") else {}
+        self.stop_ids = set(eos_ids)
+        self.stop_strings = []
+        for s in stop:
+            if s in added:
+                self.stop_ids.add(added[s])
+            else:
+                self.stop_strings.append(s)
+        self.stop_token_seqs = [
+            (s, ids) for s in self.stop_strings
+            if (ids := tokenizer.encode(s, add_special_tokens=False))
+        ]
+        # longest text that could be the start of a stop string
+        self.holdback = max((len(s) for s in self.stop_strings), default=1) - 1
+
+    def is_stop_token(self, token: int) -> bool:
+        return token in self.stop_ids
+
+    def find_stop(self, output_ids: list, text: str, new_chars: int) -> int:
+        """Returns the text index where a stop string begins, or -1."""
+        for s, ids in self.stop_token_seqs:
+            if output_ids[-len(ids):] == ids:
+                i = text.rfind(s)
+                if i != -1:
+                    return i
+        start = max(0, len(text) - new_chars)
+        hits = [i for i in (text.find(s, max(0, start - len(s) + 1)) for s in self.stop_strings) if i != -1]
+        return min(hits) if hits else -1
+
+
+# --------------------------
+# ✅ Sequence
+# --------------------------
+@dataclass
+class Sequence:
+    prompt_ids: list
+    loop: asyncio.AbstractEventLoop
+    temperature: float = 0.7
+    top_p: float = 1.0
+    max_new_tokens: int = 512
+    stop: list = field(default_factory=list)
+    adapter_name: str | None = None
+    speculative: bool = False
+    num_draft_tokens: int = 4
+
+    output_ids: list = field(default_factory=list)
+    text: str = ""
+    emitted: int = 0
+    criteria: StopCriteria | None = None
+    finish_reason: str | None = None
+    cached_tokens: int = 0
+    prefix_cache_hit_rate: float | None = None
+    created: float = field(default_factory=time.perf_counter)
+    first_token_at: float | None = None
+    drafted_tokens: int = 0
+    accepted_tokens: int = 0
+
+    def __post_init__(self):
+        self.events: asyncio.Queue = asyncio.Queue()
+        # set from the event loop (client gone); the engine drops the sequence at its next step
+        self.cancelled = False
+        self.stop = [s for s in (self.stop or []) if s]
+        # incremental detokenization offsets into output_ids
+        self._prefix_offset = 0
+        self._read_offset = 0
+        # speculative decoding: this sequence's own target / draft KV caches
+        # and how many tokens of prompt_ids + output_ids each one covers
+        self._target_cache = None
+        self._target_len = 0
+        self._draft_cache = None
+        self._draft_len = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def generated(self) -> int:
+        return len(self.output_ids)
+
+    # called from the engine thread
+    def _push(self, kind: str, payload):
+        self.loop.call_soon_threadsafe(self.events.put_nowait, (kind, payload))
+
+    def _detokenize(self, tokenizer) -> str:
+        """Decodes only the tokens since the last call and returns the new text."""
+        prefix = tokenizer.decode(self.output_ids[self._prefix_offset:self._read_offset], skip_special_tokens=True)
+        full = tokenizer.decode(self.output_ids[self._prefix_offset:], skip_special_tokens=True)
+        if len(full) <= len(prefix) or full.endswith("�"):  # wait for the rest of a multi-byte char
+            return ""
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.output_ids)
+        return full[len(prefix):]
+
+    def _emit_pending(self, final: bool):
+        holdback = self.criteria.holdback if self.criteria else 0
+        end = len(self.text) if final else max(self.emitted, len(self.text) - holdback)
+        if end > self.emitted:
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            self._push("text", self.text[self.emitted:end])
+            self.emitted = end
+
+    def _finish(self, reason: str):
+        self.finish_reason = reason
+        self._emit_pending(final=True)
+        self._target_cache = self._draft_cache = None
+        done = time.perf_counter()
+        usage = {
+            "prompt_tokens": len(self.prompt_ids),
+            "completion_tokens": len(self.output_ids),
+            "total_tokens": len(self.prompt_ids) + len(self.output_ids),
+            "prompt_tokens_details": {"cached_tokens": self.cached_tokens},
+            "prefix_cache_hit_rate": self.prefix_cache_hit_rate,
+        }
+        if self.speculative:
+            usage["speculative"] = {
+                "drafted_tokens": self.drafted_tokens,
+                "accepted_tokens": self.accepted_tokens,
+                "acceptance_rate": round(self.accepted_tokens / self.drafted_tokens, 3) if self.drafted_tokens else None,
+            }
+        decode_s = done - self.first_token_at if self.first_token_at else 0
+        self._push("done", {
+            "finish_reason": reason,
+            "usage": usage,
+            "timings": {
+                "ttft_ms": round((self.first_token_at - self.created) * 1000, 1) if self.first_token_at else None,
+                "total_ms": round((done - self.created) * 1000, 1),
+                "decode_tokens_per_s": round((len(self.output_ids) - 1) / decode_s, 2) if decode_s > 0 else None,
+            },
+        })
+
+    def _fail(self, err: Exception):
+        self.finish_reason = "error"
+        self._target_cache = self._draft_cache = None
+        self._push("error", str(err))
+
+    # called from the handler's event loop
+    async def results(self):
+        """Yields ("text", delta), then ("done", info) or ("error", message)."""
+        while True:
+            kind, payload = await self.events.get()
+            yield kind, payload
+            if kind in ("done", "error"):
+                return
+
+
+# --------------------------
+# ✅ LoRA adapters
+# --------------------------
+BASE_ADAPTER = "__base__"  # PEFT's adapter name for plain base-model rows in a mixed batch
+
+
+class LoraAdapterPool:
+    """
+    One PeftModel over the shared base model, with LoRA adapters hot-loaded
+    from adapters_dir/<name>. Every forward call carries per-row adapter
+    names, so sequences for different adapters (and the bare base model)
+    decode in the same batch. Adapters not pinned by a running sequence are
+    evicted least-recently-used once the byte or count budget is exceeded.
+    """
+
+    def __init__(self, base_model, adapters_dir: str = "adapters",
+                 budget_bytes: int = 256 * 1024 * 1024, max_adapters: int = 8):
+        self.base_model = base_model
+        self.adapters_dir = adapters_dir
+        self.budget_bytes = budget_bytes
+        self.max_adapters = max(1, max_adapters)
+        self.peft_model = None
+        self._loaded: OrderedDict[str, int] = OrderedDict()  # name -> bytes
+        self._versions: dict[str, int] = {}  # name -> newest file mtime when loaded
+        self._pins: dict[str, int] = {}
+        # counters
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_s = 0.0
+
+    def exists(self, name: str) -> bool:
+        return name in self._loaded or os.path.isdir(os.path.join(self.adapters_dir, name))
+
+    def acquire(self, name: str | None):
+        """Ensures the adapter is loaded and pins it until release()."""
+        if not name:
+            return
+        if name in self._loaded and not self._pins.get(name) and self._version(name) != self._versions.get(name):
+            # retrained under the same name (/finetune): drop the stale weights once nothing uses them
+            logger.info(f"🔁 Adapter changed on disk, reloading: {name}")
+            self._delete(name)
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            self.hits += 1
+        else:
+            self._load(name)
+        self._pins[name] = self._pins.get(name, 0) + 1
+
+    def release(self, name: str | None):
+        if not name or name not in self._pins:
+            return
+        self._pins[name] -= 1
+        if self._pins[name] <= 0:
+            del self._pins[name]
+
+    def forward(self, adapter_names: list, **inputs):
+        if self.peft_model is None:
+            return self.base_model(**inputs)
+        return self.peft_model(**inputs, adapter_names=[n or BASE_ADAPTER for n in adapter_names])
+
+    def _load(self, name: str):
+        from peft import PeftModel
+
+        self._evict(reserve=1)
+        path = os.path.join(self.adapters_dir, name)
+        logger.info(f"🧩 Loading adapter: {path}")
+        start = time.perf_counter()
+        if self.peft_model is None:
+            self.peft_model = PeftModel.from_pretrained(self.base_model, path, adapter_name=name)
+        else:
+            self.peft_model.load_adapter(path, adapter_name=name)
+        self.peft_model.to(self.base_model.device).eval()
+        self._versions[name] = self._version(name)
+        self._loaded[name] = sum(
+            p.numel() * p.element_size()
+            for n, p in self.peft_model.named_parameters() if f".{name}." in n
+        )
+        self.loads += 1
+        self.load_s += time.perf_counter() - start
+        self._evict()
+
+    def _evict(self, reserve: int = 0):
+        while self._loaded and (
+            len(self._loaded) + reserve > self.max_adapters
+            or sum(self._loaded.values()) > self.budget_bytes
+        ):
+            victim = next((n for n in self._loaded if not self._pins.get(n)), None)
+            if victim is None:
+                logger.warning("⚠️ Adapter budget exceeded but every loaded adapter is in use")
+                return
+            self._delete(victim)
+            self.evictions += 1
+            logger.info(f"♻️ Evicted adapter: {victim}")
+
+    def _delete(self, name: str):
+        delete = getattr(self.peft_model, "delete_adapter", None) or self.peft_model.base_model.delete_adapter
+        delete(name)
+        del self._loaded[name]
+        self._versions.pop(name, None)
+
+    def _version(self, name: str) -> int | None:
+        try:
+            with os.scandir(os.path.join(self.adapters_dir, name)) as entries:
+                return max((e.stat().st_mtime_ns for e in entries if e.is_file()), default=0)
+        except OSError:
+            return None
+
+    def stats(self) -> dict:
+        return {
+            "loaded": list(self._loaded),
+            "in_use": dict(self._pins),
+            "bytes": sum(self._loaded.values()),
+            "budget_bytes": self.budget_bytes,
+            "max_adapters": self.max_adapters,
+            "hits": self.hits,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "avg_load_ms": round(self.load_s / self.loads * 1000, 1) if self.loads else None,
+        }
+
+
+# --------------------------
+# ✅ Speculative decoding
+# --------------------------
+def _crop_cache(cache, length: int):
+    if hasattr(cache, "crop"):
+        cache.crop(length)
+        return cache
+    return tuples_to_cache(tuple((k[:, :, :length], v[:, :, :length]) for k, v in cache_to_tuples(cache)))
+
+
+def _shallow_module(module):
+    clone = copy.copy(module)
+    clone._modules = dict(module._modules)
+    return clone
+
+
+def self_draft_model(model, num_layers: int):
+    """
+    A draft view of a decoder-only model that runs only its first num_layers
+    layers (then the final norm and LM head). Shares all weights with model.
+    """
+    draft = _shallow_module(model)
+    draft.model = _shallow_module(model.model)
+    draft.model.layers = torch.nn.ModuleList(list(model.model.layers)[:num_layers])
+    config = copy.copy(model.config)
+    config.num_hidden_layers = num_layers
+    if getattr(config, "layer_types", None):
+        config.layer_types = config.layer_types[:num_layers]
+    draft.config = draft.model.config = config
+    return draft
+
+
+class Drafter:
+    """
+    Proposes tokens for speculative decoding with a cheap draft model: a
+    small model sharing the tokenizer, or a self_draft_model() view of the
+    base. The base model then verifies all proposals in one forward pass.
+    """
+
+    def __init__(self, model, device: str, num_tokens: int = 4, name: str = "draft"):
+        self.model = model
+        self.device = device
+        self.num_tokens = max(1, num_tokens)
+        self.name = name
+        # counters
+        self.rounds = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.tokens = 0
+        self.spec_s = 0.0
+
+    def propose(self, seq: Sequence, ids: list, k: int):
+        """Samples k draft tokens after ids; returns (tokens, draft probs [k, V])."""
+        temps = torch.tensor([seq.temperature], device=self.device)
+        top_ps = torch.tensor([seq.top_p], device=self.device)
+        feed, tokens, probs = ids[seq._draft_len:], [], []
+        for _ in range(k):
+            out = self.model(
+                input_ids=torch.tensor([feed], device=self.device),
+                past_key_values=seq._draft_cache,
+                cache_position=torch.arange(seq._draft_len, seq._draft_len + len(feed), device=self.device),
+                use_cache=True,
+            )
+            seq._draft_cache = out.past_key_values
+            seq._draft_len += len(feed)
+            p = token_probs(out.logits[:, -1, :], temps, top_ps)[0]
+            token = int(torch.multinomial(p, 1))
+            tokens.append(token)
+            probs.append(p)
+            feed = [token]
+        return tokens, torch.stack(probs)
+
+    def stats(self) -> dict:
+        return {
+            "draft_model": self.name,
+            "num_draft_tokens": self.num_tokens,
+            "rounds": self.rounds,
+            "drafted_tokens": self.drafted,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": round(self.accepted / self.drafted, 3) if self.drafted else None,
+            "tokens_per_round": round(self.tokens / self.rounds, 2) if self.rounds else None,
+            "tokens_per_s": round(self.tokens / self.spec_s, 2) if self.spec_s else None,
+        }
+
+
+# --------------------------
+# ✅ Running batch
+# --------------------------
+class _Batch:
+    def __init__(self):
+        self.seqs: list[Sequence] = []
+        self.cache = None
+        self.mask: torch.Tensor | None = None  # [B, T] 1 = real token, 0 = left pad
+
+    def merge(self, seq: Sequence, cache, mask: torch.Tensor):
+        if not self.seqs:
+            self.seqs, self.cache, self.mask = [seq], cache, mask
+            return
+        old, new = cache_to_tuples(self.cache), cache_to_tuples(cache)
+        length = max(self.mask.shape[1], mask.shape[1])
+        self.cache = tuples_to_cache(tuple(
+            (torch.cat([_left_pad(ok, length, 2), _left_pad(nk, length, 2)], 0),
+             torch.cat([_left_pad(ov, length, 2), _left_pad(nv, length, 2)], 0))
+            for (ok, ov), (nk, nv) in zip(old, new)
+        ))
+        self.mask = torch.cat([_left_pad(self.mask, length, 1), _left_pad(mask, length, 1)], 0)
+        self.seqs.append(seq)
+
+    def keep(self, rows: list[int]):
+        if len(rows) == len(self.seqs):
+            return
+        self.seqs = [self.seqs[i] for i in rows]
+        if not rows:
+            self.cache, self.mask = None, None
+            return
+        idx = torch.tensor(rows, device=self.mask.device)
+        mask = self.mask.index_select(0, idx)
+        # drop columns that are now padding for every remaining row
+        first = int((mask.sum(0) > 0).nonzero()[0])
+        self.mask = mask[:, first:]
+        self.cache = tuples_to_cache(tuple(
+            (k.index_select(0, idx)[:, :, first:], v.index_select(0, idx)[:, :, first:])
+            for k, v in cache_to_tuples(self.cache)
+        ))
+
+
+# --------------------------
+# ✅ Engine
+# --------------------------
+class BatchEngine:
+    def __init__(self, tokenizer, adapters: LoraAdapterPool, device: str, max_batch_size: int = 8,
+                 prefix_cache: PrefixCache | None = None, drafter: Drafter | None = None):
+        """
+        adapters runs the model forward with per-row LoRA adapters, so all
+        sequences share one running batch. prefix_cache, if given, lets
+        prefill skip prompt prefixes seen before (per adapter). drafter, if
+        given, decodes sequences that ask for it speculatively, one at a time
+        between batch steps.
+        """
+        self.tokenizer = tokenizer
+        self.adapters = adapters
+        self.prefix_cache = prefix_cache
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self._pending: queue.Queue = queue.Queue()
+        self._batch = _Batch()
+        self._spec: list[Sequence] = []
+        self.drafter = drafter
+        self._thread: threading.Thread | None = None
+        self.eos_ids: set[int] = set()
+        self._add_eos(tokenizer.eos_token_id)
+        # counters
+        self.steps = 0
+        self.step_rows = 0
+        self.tokens_generated = 0
+        self.prefill_tokens = 0
+        self.decode_s = 0.0
+        self.cancelled = 0
+
+    def _add_eos(self, ids):
+        if ids is None:
+            return
+        self.eos_ids.update(ids if isinstance(ids, (list, tuple, set)) else [ids])
+
+    def add_eos_from(self, model):
+        """Picks up EOS ids from the model's generation config (e.g. <|eot_id|>)."""
+        self._add_eos(getattr(getattr(model, "generation_config", None), "eos_token_id", None))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="llama-batch-engine", daemon=True)
+            self._thread.start()
+
+    def submit(self, seq: Sequence):
+        self._pending.put(seq)
+
+    def active(self) -> int:
+        return len(self._batch.seqs) + len(self._spec)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active(),
+            "pending": self._pending.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "decode_steps": self.steps,
+            "avg_batch_size": round(self.step_rows / self.steps, 2) if self.steps else None,
+            "tokens_generated": self.tokens_generated,
+            "prefill_tokens": self.prefill_tokens,
+            "cancelled": self.cancelled,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache else None,
+            "adapters": self.adapters.stats(),
+            "decode_tokens_per_s": round(self.step_rows / self.decode_s, 2) if self.decode_s else None,
+            "speculative": self._spec_stats(),
+        }
+
+    def _spec_stats(self) -> dict | None:
+        if self.drafter is None:
+            return None
+        stats = self.drafter.stats()
+        # a batched row gets one token per step, so steps/s is its per-sequence rate
+        baseline = self.steps / self.decode_s if self.decode_s else None
+        stats["baseline_tokens_per_s"] = round(baseline, 2) if baseline else None
+        stats["speedup"] = (
+            round(stats["tokens_per_s"] / baseline, 2) if baseline and stats["tokens_per_s"] else None
+        )
+        return stats
+
+    # ---------- loop ----------
+    def _run(self):
+        with torch.inference_mode():
+            while True:
+                self._admit()
+                for seq in list(self._spec):
+                    try:
+                        self._spec_step(seq)
+                    except Exception as e:
+                        logger.error("❌ ERROR in speculative step:")
+                        logger.error(traceback.format_exc())
+                        self._spec.remove(seq)
+                        self._fail(seq, e)
+                if not self._batch.seqs:
+                    continue
+                try:
+                    self._step(self._batch)
+                except Exception as e:
+                    # a failed step poisons the batch; fail those sequences, keep serving
+                    logger.error("❌ ERROR in batch engine step:")
+                    logger.error(traceback.format_exc())
+                    for seq in self._batch.seqs:
+                        self._fail(seq, e)
+                    self._batch = _Batch()
+
+    def _admit(self):
+        # block only when idle; otherwise join whatever arrived since the last step
+        new = []
+        if not self.active():
+            new.append(self._pending.get())
+        while self.active() + len(new) < self.max_batch_size:
+            try:
+                new.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        for seq in new:
+            if seq.cancelled:
+                # gone before it was scheduled: skip prefill entirely
+                self.cancelled += 1
+                seq._finish("cancelled")
+                continue
+            try:
+                self._prefill(seq)
+            except Exception as e:
+                logger.error(traceback.format_exc())
+                self._fail(seq, e)
+
+    def _fail(self, seq: Sequence, err: Exception):
+        seq._fail(err)
+        self.adapters.release(seq.adapter_name)
+
+    def _prefill(self, seq: Sequence):
+        seq.criteria = StopCriteria(self.tokenizer, self.eos_ids, seq.stop)
+        self.adapters.acquire(seq.adapter_name)
+        cached, kv = 0, None
+        if self.prefix_cache is not None:
+            cached, kv = self.prefix_cache.lookup(seq.adapter_name, seq.prompt_ids)
+            seq.cached_tokens = cached
+            seq.prefix_cache_hit_rate = self.prefix_cache.hit_rate()
+
+        prompt_len = len(seq.prompt_ids)
+        input_ids = torch.tensor([seq.prompt_ids[cached:]], device=self.device)
+        mask = torch.ones((1, prompt_len), dtype=torch.long, device=self.device)
+        kwargs = {}
+        if kv is not None:
+            kwargs["past_key_values"] = tuples_to_cache(kv)
+            kwargs["cache_position"] = torch.arange(cached, prompt_len, device=self.device)
+        out = self.adapters.forward(
+            [seq.adapter_name], input_ids=input_ids, attention_mask=mask, use_cache=True, **kwargs
+        )
+        self.prefill_tokens += prompt_len - cached
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(seq.adapter_name, seq.prompt_ids, out.past_key_values)
+        token = sample_next(
+            out.logits[:, -1, :],
+            torch.tensor([seq.temperature], device=self.device),
+            torch.tensor([seq.top_p], device=self.device),
+        )
+        if self._accept(seq, int(token[0])):
+            return
+        if seq.speculative and self.drafter is not None:
+            seq._target_cache, seq._target_len = out.past_key_values, prompt_len
+            self._spec.append(seq)
+            return
+        self._batch.merge(seq, out.past_key_values, mask)
+
+    def _spec_step(self, seq: Sequence):
+        """
+        One speculative round: the drafter proposes k tokens, the model scores
+        them in a single forward pass, and each is accepted with probability
+        min(1, p/q); the first rejection is resampled from the residual
+        max(0, p - q), and if all are accepted a bonus token comes from the
+        model's last position. Output follows the model's own distribution.
+        """
+        start = time.perf_counter()
+        ids = seq.prompt_ids + seq.output_ids
+        k = max(1, min(seq.num_draft_tokens, seq.max_new_tokens - len(seq.output_ids)))
+        drafts, q = self.drafter.propose(seq, ids, k)
+
+        feed = ids[seq._target_len:] + drafts
+        out = self.adapters.forward(
+            [seq.adapter_name],
+            input_ids=torch.tensor([feed], device=self.device),
+            past_key_values=seq._target_cache,
+            cache_position=torch.arange(seq._target_len, seq._target_len + len(feed), device=self.device),
+            use_cache=True,
+        )
+        p = token_probs(
+            out.logits[0, -(k + 1):, :],
+            torch.full((k + 1,), seq.temperature, device=self.device),
+            torch.full((k + 1,), seq.top_p, device=self.device),
+        )
+        vocab = min(p.shape[-1], q.shape[-1])
+        accepted, token = [], None
+        for i, draft in enumerate(drafts):
+            if draft < vocab and float(torch.rand(())) < min(1.0, float(p[i, draft] / q[i, draft])):
+                accepted.append(draft)
+                continue
+            residual = (p[i, :vocab] - q[i, :vocab]).clamp(min=0)
+            token = int(torch.multinomial(residual, 1)) if residual.sum() > 0 else int(p[i].argmax())
+            break
+        if token is None:
+            token = int(torch.multinomial(p[k], 1))
+
+        # keep only KV for context the model agrees with; the new token is fed next round
+        valid = len(ids) + len(accepted)
+        seq._target_cache, seq._target_len = _crop_cache(out.past_key_values, valid), valid
+        if seq._draft_len > valid:
+            seq._draft_cache, seq._draft_len = _crop_cache(seq._draft_cache, valid), valid
+
+        seq.drafted_tokens += k
+        seq.accepted_tokens += len(accepted)
+        d = self.drafter
+        d.rounds += 1
+        d.drafted += k
+        d.accepted += len(accepted)
+        for tok in accepted + [token]:
+            d.tokens += 1
+            if self._accept(seq, tok):
+                self._spec.remove(seq)
+                break
+        d.spec_s += time.perf_counter() - start
+
+    def _step(self, batch: _Batch):
+        start = time.perf_counter()
+        rows = len(batch.seqs)
+        input_ids = torch.tensor([[s.output_ids[-1]] for s in batch.seqs], device=self.device)
+        past_len = batch.mask.shape[1]
+        position_ids = batch.mask.sum(1, keepdim=True)
+        mask = torch.cat([batch.mask, torch.ones((rows, 1), dtype=batch.mask.dtype, device=self.device)], 1)
+        out = self.adapters.forward(
+            [s.adapter_name for s in batch.seqs],
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=batch.cache,
+            cache_position=torch.tensor([past_len], device=self.device),
+            use_cache=True,
+        )
+        batch.cache, batch.mask = out.past_key_values, mask
+        tokens = sample_next(
+            out.logits[:, -1, :],
+            torch.tensor([s.temperature for s in batch.seqs], device=self.device),
+            torch.tensor([s.top_p for s in batch.seqs], device=self.device),
+        ).tolist()
+        keep = [i for i, (seq, tok) in enumerate(zip(batch.seqs, tokens)) if not self._accept(seq, tok)]
+        batch.keep(keep)
+        self.steps += 1
+        self.step_rows += rows
+        self.decode_s += time.perf_counter() - start
+
+    def _accept(self, seq: Sequence, token: int) -> bool:
+        """Appends a sampled token; returns True (and unpins the adapter) if the sequence is finished."""
+        finished = self._append_token(seq, token)
+        if finished:
+            self.adapters.release(seq.adapter_name)
+        return finished
+
+    def _append_token(self, seq: Sequence, token: int) -> bool:
+        if seq.cancelled:
+            # checked between decode steps; finishing frees the batch row right away
+            self.cancelled += 1
+            seq._finish("cancelled")
+            return True
+        if seq.criteria.is_stop_token(token):
+            seq._finish("stop")
+            return True
+        seq.output_ids.append(token)
+        self.tokens_generated += 1
+        delta = seq._detokenize(self.tokenizer)
+        if delta:
+            seq.text += delta
+            cut = seq.criteria.find_stop(seq.output_ids, seq.text, len(delta))
+            if cut != -1:
+                seq.text = seq.text[:cut]
+                seq._finish("stop")
+                return True
+            seq._emit_pending(final=False)
+        if len(seq.output_ids) >= seq.max_new_tokens:
+            seq._finish("length")
+            return True
+        return False
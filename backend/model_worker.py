@@ -1,12 +1,15 @@
 import os
-import re
+import json
 import torch
+import asyncio
 import logging
 import traceback
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
+from fastapi.responses import JSONResponse, StreamingResponse
+from transformers import AutoTokenizer
+from inference_profile import load_model, model_bytes
+from llama_engine import BatchEngine, Drafter, LoraAdapterPool, PrefixCache, Sequence, self_draft_model
+from cancellation import CancelRegistry
 
 # --------------------------
 # ✅ Configure Logging
@@ -18,70 +21,110 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# --------------------------
-# ✅ Prompt Extractor
-# --------------------------
-def extract_last_assistant_block(text: str) -> str:
-    matches = list(re.finditer(r"\|assistant\|\n(.*?)(?=(\n\|user\||\Z))", text, flags=re.DOTALL))
-    if matches:
-        return matches[-1].group(1).strip()
-    return text.strip()
-
 # --------------------------
 # ✅ Model Setup
 # --------------------------
 BASE_MODEL_NAME = "meta-llama/Llama-3.2-1B-Instruct"
+# Replicas launched by the gateway each get their own port
+PORT = int(os.environ.get("WORKER_PORT", "21002"))
 DEVICE = "mps" if torch.backends.mps.is_available() else "cpu"
-
-logger.info(f"📦 Loading base model: {BASE_MODEL_NAME}")
-base_model = AutoModelForCausalLM.from_pretrained(BASE_MODEL_NAME)
+# fp32 | bf16 | int8 (dynamic int8 linears, CPU only); see inference_profile.py
+INFERENCE_PROFILE = os.environ.get("LLAMA_INFERENCE_PROFILE", "fp32")
+# Max sequences decoded together; keep in sync with max_concurrency in api.MODEL_WORKERS
+MAX_BATCH_SIZE = int(os.environ.get("LLAMA_MAX_BATCH_SIZE", "8"))
+# Memory budget for reusable prompt-prefix KV tensors (0 disables the cache)
+PREFIX_CACHE_MB = int(os.environ.get("LLAMA_PREFIX_CACHE_MB", "256"))
+PREFIX_BLOCK_TOKENS = int(os.environ.get("LLAMA_PREFIX_BLOCK_TOKENS", "32"))
+# LoRA adapters kept resident at once; least recently used idle ones are unloaded
+ADAPTER_CACHE_MB = int(os.environ.get("LLAMA_ADAPTER_CACHE_MB", "256"))
+MAX_ADAPTERS = int(os.environ.get("LLAMA_MAX_ADAPTERS", "8"))
+# Speculative decoding: a small draft model sharing the tokenizer, or (if unset)
+# the first LLAMA_SELF_DRAFT_LAYERS layers of the base model. Off when neither is set.
+DRAFT_MODEL_NAME = os.environ.get("LLAMA_DRAFT_MODEL", "")
+SELF_DRAFT_LAYERS = int(os.environ.get("LLAMA_SELF_DRAFT_LAYERS", "0"))
+NUM_DRAFT_TOKENS = int(os.environ.get("LLAMA_NUM_DRAFT_TOKENS", "4"))
+# Whether requests that don't say otherwise decode speculatively
+SPECULATIVE_DEFAULT = os.environ.get("LLAMA_SPECULATIVE", "0") == "1"
+
+logger.info(f"📦 Loading base model: {BASE_MODEL_NAME} ({INFERENCE_PROFILE})")
+base_model, DEVICE = load_model(BASE_MODEL_NAME, INFERENCE_PROFILE, DEVICE)
+WEIGHTS_MB = round(model_bytes(base_model) / 1024 / 1024, 1)
+logger.info(f"✅ Base model on {DEVICE}, {WEIGHTS_MB} MB of weights")
 tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_NAME)
 
-ADAPTER_CACHE = {}
+adapter_pool = LoraAdapterPool(
+    base_model, "adapters",
+    budget_bytes=ADAPTER_CACHE_MB * 1024 * 1024, max_adapters=MAX_ADAPTERS,
+)
 
-def get_pipeline_with_adapter(adapter_name: str | None):
+def resolve_adapter_name(adapter_name: str | None) -> str | None:
+    """Returns the adapter name if it exists on disk, else None (base model)."""
     if not adapter_name:
-        logger.info("⚙️ Using base model (no adapter)")
-        return pipeline(
-            "text-generation",
-            model=base_model,
-            tokenizer=tokenizer,
-            device=DEVICE,
-            max_new_tokens=512,
-        )
-
-    if adapter_name in ADAPTER_CACHE:
-        logger.info(f"✅ Using cached adapter: {adapter_name}")
-        return ADAPTER_CACHE[adapter_name]
-
-    adapter_path = os.path.join("adapters", adapter_name)
-    if not os.path.exists(adapter_path):
-        logger.warning(f"⚠️ Adapter not found: {adapter_path}. Using base model.")
-        return pipeline(
-            "text-generation",
-            model=base_model,
-            tokenizer=tokenizer,
-            device=DEVICE,
-            max_new_tokens=512,
-        )
-
-    logger.info(f"🧩 Loading adapter: {adapter_path}")
-    adapted_model = PeftModel.from_pretrained(base_model, adapter_path)
-    pipe = pipeline(
-        "text-generation",
-        model=adapted_model,
-        tokenizer=tokenizer,
-        device=DEVICE,
-        max_new_tokens=512,
+        return None
+    if not adapter_pool.exists(adapter_name):
+        logger.warning(f"⚠️ Adapter not found: {os.path.join('adapters', adapter_name)}. Using base model.")
+        return None
+    return adapter_name
+
+def format_instruction_prompt(prompt: str) -> str:
+    return f"### Instruction:\n{prompt.strip()}\n\n### Response:\n"
+
+# --------------------------
+# ✅ Batch Engine
+# --------------------------
+prefix_cache = (
+    PrefixCache(PREFIX_CACHE_MB * 1024 * 1024, block_size=PREFIX_BLOCK_TOKENS)
+    if PREFIX_CACHE_MB > 0 else None
+)
+drafter = None
+if DRAFT_MODEL_NAME:
+    logger.info(f"📦 Loading draft model: {DRAFT_MODEL_NAME}")
+    draft_model, _ = load_model(DRAFT_MODEL_NAME, INFERENCE_PROFILE, DEVICE)
+    drafter = Drafter(draft_model, DEVICE, num_tokens=NUM_DRAFT_TOKENS, name=DRAFT_MODEL_NAME)
+elif SELF_DRAFT_LAYERS > 0:
+    logger.info(f"✂️ Self-drafting with the first {SELF_DRAFT_LAYERS} layers of {BASE_MODEL_NAME}")
+    drafter = Drafter(
+        self_draft_model(base_model, SELF_DRAFT_LAYERS), DEVICE,
+        num_tokens=NUM_DRAFT_TOKENS, name=f"self:{SELF_DRAFT_LAYERS}",
     )
-    ADAPTER_CACHE[adapter_name] = pipe
-    return pipe
+
+engine = BatchEngine(
+    tokenizer, adapter_pool, DEVICE,
+    max_batch_size=MAX_BATCH_SIZE, prefix_cache=prefix_cache, drafter=drafter,
+)
+engine.add_eos_from(base_model)
 
 # --------------------------
 # ✅ App Setup
 # --------------------------
 app = FastAPI()
 
+# Text after this marker belongs to a new turn and is never sent to the client
+STOP_MARKER = "###"
+
+# In-flight sequences by the gateway's request_id, for /worker_cancel
+cancels = CancelRegistry()
+
+@app.on_event("startup")
+def _start_engine():
+    engine.start()
+
+def build_sequence(data: dict) -> Sequence:
+    prompt = data.get("prompt", "")
+    logger.info(f"💬 Received prompt: {prompt}")
+    formatted_prompt = format_instruction_prompt(prompt)
+    return Sequence(
+        prompt_ids=tokenizer.encode(formatted_prompt),
+        loop=asyncio.get_running_loop(),
+        temperature=float(data.get("temperature", 0.7)),
+        top_p=float(data.get("top_p", 1.0)),
+        max_new_tokens=int(data.get("max_new_tokens", 512)),
+        stop=list(data.get("stop") or []) + [STOP_MARKER],
+        adapter_name=resolve_adapter_name(data.get("adapter_name")),
+        speculative=bool(data.get("speculative", SPECULATIVE_DEFAULT)) and drafter is not None,
+        num_draft_tokens=int(data.get("num_draft_tokens") or NUM_DRAFT_TOKENS),
+    )
+
 # --------------------------
 # ✅ Main Handler
 # --------------------------
@@ -89,49 +132,29 @@ app = FastAPI()
 async def worker_generate(request: Request):
     try:
         data = await request.json()
-        logger.info(f"💬 Received prompt: {data.get('prompt', '')}")
-        prompt = data.get("prompt", "")
-        temperature = data.get("temperature", 0.7)
-        top_p = data.get("top_p", 1.0)
-        max_tokens = data.get("max_new_tokens", 512)
-        adapter_name = data.get("adapter_name")
-
-        formatted_prompt = f"### Instruction:\n{prompt.strip()}\n\n### Response:\n"
-
-        pipe = get_pipeline_with_adapter(adapter_name)
-
-        output = pipe(
-            formatted_prompt,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_tokens,
-        )[0]["generated_text"]
-
-        output = extract_last_assistant_block(output)
-
-        if "<|assistant|>" in output:
-            parts = output.split("<|assistant|>")
-            result_text = parts[1].strip() if len(parts) > 1 else output.strip()
-        else:
-            result_text = output.strip()
-
-        if output.startswith(formatted_prompt):
-            result_text = output[len(formatted_prompt):].strip()
-        else:
-            result_text = output.strip()
-
-        if "###" in result_text:
-            result_text = result_text.split("###")[0].strip()
+        seq = build_sequence(data)
+        request_id = cancels.register(data.get("request_id"), seq)
+        engine.submit(seq)
+
+        result_text, info = "", {}
+        try:
+            async for kind, payload in seq.results():
+                if kind == "text":
+                    result_text += payload
+                elif kind == "error":
+                    raise RuntimeError(payload)
+                else:
+                    info = payload
+        finally:
+            cancels.done(request_id)
 
         logger.info(f"🧠 Response: {result_text.strip()}")
 
         return JSONResponse({
             "text": result_text.strip(),
-            "usage": {
-                "prompt_tokens": len(data["prompt"].split()),
-                "completion_tokens": len(result_text.split()),
-                "total_tokens": len(data["prompt"].split()) + len(result_text.split()),
-            }
+            "finish_reason": info.get("finish_reason"),
+            "usage": info.get("usage", {}),
+            "timings": info.get("timings", {}),
         })
 
     except Exception as e:
@@ -139,10 +162,64 @@ async def worker_generate(request: Request):
         logger.error(traceback.format_exc())
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+# --------------------------
+# ✅ Streaming Handler
+# --------------------------
+@app.post("/worker_generate_stream")
+async def worker_generate_stream(request: Request):
+    """
+    Same inputs as /worker_generate, but streams newline-delimited JSON events:
+    {"text": "<delta>"} for each decoded piece, then a final
+    {"text": "", "finish_reason": ..., "usage": {...}, "timings": {...}}.
+    """
+    data = await request.json()
+    seq = build_sequence(data)
+    request_id = cancels.register(data.get("request_id"), seq)
+    engine.submit(seq)
+
+    async def _events():
+        try:
+            async for kind, payload in seq.results():
+                if kind == "text":
+                    yield json.dumps({"text": payload}) + "\n"
+                elif kind == "error":
+                    logger.error(f"❌ ERROR in worker_generate_stream: {payload}")
+                    yield json.dumps({"error": payload}) + "\n"
+                else:
+                    logger.info(f"🧠 Streamed response: {payload}")
+                    yield json.dumps({"text": "", **payload}) + "\n"
+        finally:
+            if seq.finish_reason is None:
+                # the gateway closed the stream early: stop decoding this sequence
+                cancels.cancel(request_id)
+            cancels.done(request_id)
+
+    return StreamingResponse(_events(), media_type="application/x-ndjson")
+
+@app.post("/worker_cancel")
+async def worker_cancel(request: Request):
+    """Stops a request's sequence at the engine's next decode step."""
+    data = await request.json()
+    return cancels.cancel(data.get("request_id") or "")
+
+@app.get("/health")
+def health():
+    return {"ok": True, "model_id": BASE_MODEL_NAME, "active": engine.active()}
+
+@app.get("/engine_stats")
+def engine_stats():
+    return {
+        "inference_profile": INFERENCE_PROFILE,
+        "device": DEVICE,
+        "weights_mb": WEIGHTS_MB,
+        **engine.stats(),
+        "cancellation": cancels.stats(),
+    }
+
 # --------------------------
 # ✅ Startup
 # --------------------------
 if __name__ == "__main__":
-    import uvicorn
-    logger.info("🚀 Starting model_worker on http://localhost:21002 ...")
-    uvicorn.run(app, host="0.0.0.0", port=21002)
\ No newline at end of file
+    from worker_transport import serve
+    logger.info(f"🚀 Starting model_worker on {os.environ.get('WORKER_SOCKET') or f'http://localhost:{PORT}'} ...")
+    serve(app, PORT)
\ No newline at end of file
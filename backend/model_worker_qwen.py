@@ -1,17 +1,26 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from mlx_vlm import load, generate
+from fastapi.responses import JSONResponse, StreamingResponse
+from mlx_vlm import load, stream_generate
 from mlx_vlm.prompt_utils import apply_chat_template
 from mlx_vlm.utils import load_tokenizer
 from mlx_vlm.utils import get_model_path
-import uvicorn
 import requests
 import io
 from PIL import Image
 import logging
 import traceback
 import base64
+import os
+import json
+import time
+import asyncio
 
+import hashlib
+
+import blob_store
+import vision_cache
+from blob_store import BlobNotFound
+from cancellation import CancelRegistry, CancelToken
 
 
 # --------------------------
@@ -35,6 +44,169 @@ config = {"chat_template": getattr(processor.tokenizer, "chat_template", "chatml
 
 app = FastAPI()
 
+# Replicas launched by the gateway each get their own port
+PORT = int(os.environ.get("WORKER_PORT", "21003"))
+
+MAX_MODEL_TOKENS = 32768
+
+# Visual-token budget. Qwen2-VL turns each 28x28 pixel block (14px patches,
+# merged 2x2) into one visual token, so images are downsized to at most
+# budget * 28 * 28 pixels. Callers pick a tier ("image_quality") or pass
+# max_image_tokens / max_image_pixels; "full" keeps the original resolution.
+IMAGE_PATCH = 28
+IMAGE_QUALITY_TIERS = {"low": 256, "medium": 1024, "high": 4096, "full": None}
+DEFAULT_IMAGE_TOKENS = int(os.environ.get("QWEN_IMAGE_TOKEN_BUDGET", "1024"))
+MIN_IMAGE_TOKENS = 4
+
+# Vision feature cache (see vision_cache.py): decoded images by content hash,
+# and vision-encoder outputs by pixel-tensor fingerprint
+IMAGE_CACHE_MB = float(os.environ.get("QWEN_IMAGE_CACHE_MB", "256"))
+ENCODER_CACHE_MB = float(os.environ.get("QWEN_ENCODER_CACHE_MB", "512"))
+image_cache = vision_cache.FeatureCache("images", int(IMAGE_CACHE_MB * 1024 * 1024))
+encoder_cache = vision_cache.FeatureCache("encoder", int(ENCODER_CACHE_MB * 1024 * 1024))
+ENCODER_CACHED = vision_cache.wrap_vision_tower(model, encoder_cache)
+logger.info(f"🗃️ Vision encoder cache {'enabled' if ENCODER_CACHED else 'unavailable'}")
+
+
+# In-flight generations by the gateway's request_id, for /worker_cancel
+cancels = CancelRegistry()
+
+
+class PromptTooLong(Exception):
+    pass
+
+
+class BadImageRequest(Exception):
+    pass
+
+
+def _decode_image(raw: bytes):
+    return Image.open(io.BytesIO(raw)).convert("RGB")
+
+
+def image_token_budget(data: dict) -> int | None:
+    """Max visual tokens for a request (None = full resolution)."""
+    if data.get("max_image_tokens"):
+        return max(MIN_IMAGE_TOKENS, int(data["max_image_tokens"]))
+    if data.get("max_image_pixels"):
+        return max(MIN_IMAGE_TOKENS, int(data["max_image_pixels"]) // (IMAGE_PATCH * IMAGE_PATCH))
+    quality = data.get("image_quality")
+    if quality:
+        if quality not in IMAGE_QUALITY_TIERS:
+            raise BadImageRequest(f"Unknown image_quality '{quality}'. Expected one of {list(IMAGE_QUALITY_TIERS)}.")
+        return IMAGE_QUALITY_TIERS[quality]
+    return DEFAULT_IMAGE_TOKENS
+
+
+def fit_image(image, max_tokens: int | None):
+    """Downsizes image to max_tokens visual tokens (keeping aspect ratio) and snaps it
+    to the 28px grid. Returns (image, visual_token_count)."""
+    w, h = image.size
+    if max_tokens is not None and (w // IMAGE_PATCH) * (h // IMAGE_PATCH) > max_tokens:
+        scale = (max_tokens * IMAGE_PATCH * IMAGE_PATCH / (w * h)) ** 0.5
+        w, h = w * scale, h * scale
+    new_w = max(IMAGE_PATCH, int(w // IMAGE_PATCH) * IMAGE_PATCH)
+    new_h = max(IMAGE_PATCH, int(h // IMAGE_PATCH) * IMAGE_PATCH)
+    if (new_w, new_h) != image.size:
+        image = image.resize((new_w, new_h), Image.BICUBIC)
+    return image, max(MIN_IMAGE_TOKENS, (new_w // IMAGE_PATCH) * (new_h // IMAGE_PATCH))
+
+
+def load_image(image_url: str, max_tokens: int | None):
+    """Loads and fits an image, cached by (content hash, token budget).
+    Returns (image, visual_token_count)."""
+    start = time.perf_counter()
+    if blob_store.is_ref(image_url):
+        digest, raw = blob_store.digest_of(image_url), None  # already content-addressed
+    else:
+        if image_url.startswith("data:image"):
+            header, encoded = image_url.split(",", 1)
+            raw = base64.b64decode(encoded)
+        else:
+            # normally the gateway has already fetched URLs into the blob store
+            raw = requests.get(image_url, timeout=30).content
+        digest = hashlib.sha256(raw).hexdigest()
+
+    key = (digest, max_tokens)
+    hit = image_cache.get(key)
+    if hit is not None:
+        vision_cache.record("image", True, hit[1])
+        return hit[0]
+    if raw is None:
+        # shared blob store: open the file directly, no base64 round trip
+        image = Image.open(blob_store.open_path(image_url)).convert("RGB")
+    else:
+        image = _decode_image(raw)
+    original = image.size
+    image, image_tokens = fit_image(image, max_tokens)
+    if image.size != original:
+        logger.info(f"🖼️ Resized image {original[0]}x{original[1]} → {image.width}x{image.height} ({image_tokens} visual tokens)")
+    cost_s = time.perf_counter() - start
+    image_cache.put(key, (image, image_tokens), image.width * image.height * 3, cost_s)
+    vision_cache.record("image", False)
+    return image, image_tokens
+
+
+def vision_usage(record: dict) -> dict:
+    """Per-request cache outcome plus overall hit rates, for the response usage."""
+    return {
+        **record,
+        "image_hit_rate": image_cache.hit_rate(),
+        "encoder_hit_rate": encoder_cache.hit_rate() if ENCODER_CACHED else None,
+        "total_saved_ms": round((image_cache.saved_s + encoder_cache.saved_s) * 1000, 1),
+    }
+
+
+def prepare_inputs(data: dict):
+    """Loads the image, truncates the prompt and applies the chat template.
+    Returns (formatted_prompt, image_or_None, prompt_token_count, image_token_count);
+    prompt_token_count includes the image's visual tokens."""
+    prompt = data.get("prompt", "")
+    image_url = data.get("image", None)
+
+    logger.info(f"📨 Prompt: {prompt}")
+    logger.info(f"🖼️ Image URL: {image_url[:80] + '…' if image_url and len(image_url) > 80 else image_url}")
+
+    # --------------------------
+    # ✅ Load image
+    # --------------------------
+    image, image_tokens = None, 0
+    if image_url:
+        image, image_tokens = load_image(image_url, image_token_budget(data))
+
+    # --------------------------
+    # ✅ Truncate raw prompt BEFORE formatting
+    # --------------------------
+    max_text_tokens = MAX_MODEL_TOKENS - image_tokens
+    raw_input_ids = tokenizer.encode(prompt, return_tensors="pt")
+    if raw_input_ids.shape[-1] > max_text_tokens:
+        logger.warning(f"⚠️ Truncating prompt from {raw_input_ids.shape[-1]} to {max_text_tokens}")
+        raw_input_ids = raw_input_ids[:, -max_text_tokens:]
+        prompt = tokenizer.decode(raw_input_ids[0], skip_special_tokens=False)
+
+    # --------------------------
+    # ✅ Apply template
+    # --------------------------
+    formatted_prompt = apply_chat_template(
+        processor,
+        config,
+        [{"role": "user", "content": prompt}],
+        num_images=1 if image else 0
+    )
+
+    input_ids = tokenizer.encode(formatted_prompt, return_tensors="pt")
+    if input_ids.shape[-1] > MAX_MODEL_TOKENS:
+        logger.error(f"❌ Final formatted prompt too long: {input_ids.shape[-1]} tokens")
+        raise PromptTooLong(f"Final formatted prompt exceeds model token limit ({MAX_MODEL_TOKENS})")
+
+    prompt_tokens = input_ids.shape[-1] + image_tokens
+    if prompt_tokens > MAX_MODEL_TOKENS:
+        raise PromptTooLong(f"Prompt plus {image_tokens} visual tokens exceeds model token limit ({MAX_MODEL_TOKENS})")
+
+    logger.info(f"🧮 Final prompt token count: {prompt_tokens} ({image_tokens} visual)")
+    return formatted_prompt, image, prompt_tokens, image_tokens
+
+
 # --------------------------
 # ✅ Inference Route
 # --------------------------
@@ -43,83 +215,67 @@ async def worker_generate(request: Request):
     try:
         data = await request.json()
 
-        prompt = data.get("prompt", "")
-        image_url = data.get("image", None)
         temperature = data.get("temperature", 0.7)
         top_p = data.get("top_p", 1.0)
         max_tokens = data.get("max_new_tokens", 512)
 
-        logger.info(f"📨 Prompt: {prompt}")
-        logger.info(f"🖼️ Image URL: {image_url}")
-
-        # --------------------------
-        # ✅ Load image
-        # --------------------------
-        image = None
-        if image_url:
-            if image_url.startswith("data:image"):
-                header, encoded = image_url.split(",", 1)
-                image_bytes = base64.b64decode(encoded)
-                image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-            else:
-                response = requests.get(image_url)
-                image = Image.open(io.BytesIO(response.content)).convert("RGB")
+        cache_record = vision_cache.begin_request()
+        try:
+            # decoding / resizing / tokenizing runs off the event loop
+            formatted_prompt, image, prompt_tokens, image_tokens = await asyncio.to_thread(prepare_inputs, data)
+        except (PromptTooLong, BadImageRequest, BlobNotFound) as e:
+            return JSONResponse(status_code=400, content={"error": str(e.args[0])})
 
         # --------------------------
-        # ✅ Truncate raw prompt BEFORE formatting
+        # ✅ Generate
         # --------------------------
-        MAX_MODEL_TOKENS = 32768
-        EST_IMAGE_TOKENS = 1024
-        MAX_TEXT_TOKENS = MAX_MODEL_TOKENS - EST_IMAGE_TOKENS
-
-        raw_input_ids = tokenizer.encode(prompt, return_tensors="pt")
-        if raw_input_ids.shape[-1] > MAX_TEXT_TOKENS:
-            logger.warning(f"⚠️ Truncating prompt from {raw_input_ids.shape[-1]} to {MAX_TEXT_TOKENS}")
-            raw_input_ids = raw_input_ids[:, -MAX_TEXT_TOKENS:]
-            prompt = tokenizer.decode(raw_input_ids[0], skip_special_tokens=False)
+        # token by token in a thread, so /worker_cancel can stop it between steps
+        token = CancelToken(max_tokens)
+        request_id = cancels.register(data.get("request_id"), token)
 
-        # --------------------------
-        # ✅ Apply template
-        # --------------------------
-        formatted_prompt = apply_chat_template(
-            processor,
-            config,
-            [{"role": "user", "content": prompt}],
-            num_images=1 if image else 0
-        )
-
-        input_ids = tokenizer.encode(formatted_prompt, return_tensors="pt")
-        if input_ids.shape[-1] > MAX_MODEL_TOKENS:
-            logger.error(f"❌ Final formatted prompt too long: {input_ids.shape[-1]} tokens")
-            return JSONResponse(status_code=400, content={
-                "error": f"Final formatted prompt exceeds model token limit ({MAX_MODEL_TOKENS})"
-            })
-
-        logger.info(f"🧮 Final prompt token count: {input_ids.shape[-1]}")
+        def _generate():
+            pieces = []
+            for chunk in stream_generate(
+                model,
+                processor,
+                formatted_prompt,
+                [image] if image else None,
+                temperature=temperature,
+                top_p=top_p,
+                max_tokens=max_tokens,
+            ):
+                token.generated += 1
+                if token.cancelled:
+                    break
+                # older mlx_vlm versions yield plain strings
+                pieces.append(getattr(chunk, "text", chunk) or "")
+            return "".join(pieces)
 
-        # --------------------------
-        # ✅ Generate
-        # --------------------------
-        response = generate(
-            model,
-            processor,
-            formatted_prompt,
-            [image] if image else None,
-            temperature=temperature,
-            top_p=top_p,
-            max_tokens=max_tokens,
-        )
-        response_text = response.text.strip()
+        try:
+            response_text = (await asyncio.to_thread(_generate)).strip()
+        finally:
+            cancels.done(request_id)
+        if token.cancelled:
+            finish_reason = "cancelled"
+        else:
+            finish_reason = "length" if token.generated >= max_tokens else "stop"
 
         logger.info(f"🧠 Response: {response_text}")
 
+        completion_tokens = token.generated
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        if image is not None:
+            usage["image_tokens"] = image_tokens
+            usage["image_size"] = list(image.size)
+            usage["vision_cache"] = vision_usage(cache_record)
         return JSONResponse({
             "text": response_text,
-            "usage": {
-                "prompt_tokens": input_ids.shape[-1],
-                "completion_tokens": len(response_text.split()),
-                "total_tokens": input_ids.shape[-1] + len(response_text.split()),
-            }
+            "finish_reason": finish_reason,
+            "usage": usage,
         })
 
     except Exception as e:
@@ -128,9 +284,131 @@ async def worker_generate(request: Request):
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 
+# --------------------------
+# ✅ Streaming Route
+# --------------------------
+@app.post("/worker_generate_stream")
+async def worker_generate_stream(request: Request):
+    """
+    Streams newline-delimited JSON events: {"text": "<delta>"} per decoded
+    piece, then a final event with finish_reason, usage and timings.
+    """
+    data = await request.json()
+    temperature = data.get("temperature", 0.7)
+    top_p = data.get("top_p", 1.0)
+    max_tokens = data.get("max_new_tokens", 512)
+
+    cache_record = vision_cache.begin_request()
+    try:
+        formatted_prompt, image, prompt_tokens, image_tokens = await asyncio.to_thread(prepare_inputs, data)
+    except (PromptTooLong, BadImageRequest, BlobNotFound) as e:
+        return JSONResponse(status_code=400, content={"error": str(e.args[0])})
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    token = CancelToken(max_tokens)
+    request_id = cancels.register(data.get("request_id"), token)
+
+    def _events():
+        finished = False
+        try:
+            for event in _decode_events():
+                finished = finished or '"finish_reason"' in event or '"error"' in event
+                yield event
+        finally:
+            if not finished:
+                cancels.cancel(request_id)  # the client went away mid-stream
+            cancels.done(request_id)
+
+    def _decode_events():
+        vision_cache.begin_request(cache_record)  # the generator runs in a threadpool
+        start = time.perf_counter()
+        ttft = None
+        completion_tokens = 0
+        try:
+            for chunk in stream_generate(
+                model,
+                processor,
+                formatted_prompt,
+                [image] if image else None,
+                temperature=temperature,
+                top_p=top_p,
+                max_tokens=max_tokens,
+            ):
+                # older mlx_vlm versions yield plain strings
+                delta = getattr(chunk, "text", chunk)
+                completion_tokens += 1
+                token.generated = completion_tokens
+                if token.cancelled:
+                    break
+                if not delta:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                yield json.dumps({"text": delta}) + "\n"
+        except Exception as e:
+            logger.error("❌ ERROR in worker_generate_stream:")
+            logger.error(traceback.format_exc())
+            yield json.dumps({"error": str(e)}) + "\n"
+            return
+
+        total = time.perf_counter() - start
+        if token.cancelled:
+            finish_reason = "cancelled"
+        else:
+            finish_reason = "length" if completion_tokens >= max_tokens else "stop"
+        logger.info(f"🧠 Streamed {completion_tokens} tokens (ttft={ttft}, total={total:.3f}s)")
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        if image is not None:
+            usage["image_tokens"] = image_tokens
+            usage["image_size"] = list(image.size)
+            usage["vision_cache"] = vision_usage(cache_record)
+        yield json.dumps({
+            "text": "",
+            "finish_reason": finish_reason,
+            "usage": usage,
+            "timings": {
+                "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+                "total_ms": round(total * 1000, 1),
+            },
+        }) + "\n"
+
+    return StreamingResponse(_events(), media_type="application/x-ndjson")
+
+
+@app.get("/health")
+def health():
+    return {"ok": True, "model_id": model_id}
+
+
+@app.post("/worker_cancel")
+async def worker_cancel(request: Request):
+    """Stops the generation the gateway tagged with request_id (client disconnected)."""
+    data = await request.json()
+    return cancels.cancel(data.get("request_id") or "")
+
+
+@app.get("/engine_stats")
+def engine_stats():
+    return {
+        "model_id": model_id,
+        "cancellation": cancels.stats(),
+        "vision_cache": {
+            "images": image_cache.stats(),
+            "encoder": {**encoder_cache.stats(), "enabled": ENCODER_CACHED},
+        },
+    }
+
+
 # --------------------------
 # ✅ Startup
 # --------------------------
 if __name__ == "__main__":
-    logger.info("🚀 Starting model_worker_vlm on http://localhost:21003 ...")
-    uvicorn.run(app, host="0.0.0.0", port=21003)
\ No newline at end of file
+    from worker_transport import serve
+    logger.info(f"🚀 Starting model_worker_vlm on {os.environ.get('WORKER_SOCKET') or f'http://localhost:{PORT}'} ...")
+    serve(app, PORT)
\ No newline at end of file
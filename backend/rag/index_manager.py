@@ -0,0 +1,322 @@
+"""
+Process-wide cache of loaded FaissStores.
+
+retrieve() used to build a FaissStore per query (faiss.read_index + json.load
+of the whole .meta.json every time). The manager keeps loaded stores in
+memory, keyed by index name, and checks a version stamp (mtime/size of the
+index files) on every lookup, so an index rewritten on disk by
+another process is reloaded on next use.
+
+Writers (/rag/index, delete_doc) go through writing(): they mutate a copy of
+the cached store (appending rows / tombstones) and swap it in, so concurrent
+searches keep using the old copy and the next query is still warm. The
+per-index write lock is only held for those short appends.
+
+Deletes only tombstone chunks; once tombstones pass RAG_COMPACT_RATIO of an
+index, compact_async() rewrites it without them on a background thread.
+rebuild_async() likewise checkpoints the tail or (re)builds the index as
+IVF/HNSW/compressed when its type calls for it (FaissStore.needs_rebuild).
+Both build on a snapshot outside the write lock and take it only to swap
+the result in, so uploads and deletes never wait for a build.
+
+Memory is bounded by RAG_INDEX_CACHE_MB (LRU across indexes; only vectors
+and IDs are resident, chunk text stays in SQLite). Cold-load vs warm-query latency is in
+stats().
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .meta_store import ChunkMetaStore
+from .store_faiss import DEFAULT_INDEX_TYPE, FaissStore
+
+INDEX_ROOT = "indices"
+CACHE_MB = float(os.environ.get("RAG_INDEX_CACHE_MB", "1024"))
+DEFAULT_DIM = 384  # MiniLM
+# every file an index may have on disk (current layout and not-yet-migrated legacy files)
+INDEX_FILES = (".faiss", ".emb.f32", ".ids.i64", ".meta.db", ".meta.db-wal", ".manifest.json",
+               ".meta.json", ".emb.npy")
+
+
+def _stat(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class IndexManager:
+    def __init__(self, root: str = INDEX_ROOT, budget_bytes: int = int(CACHE_MB * 1024 * 1024)):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self._entries: "OrderedDict[str, Tuple[FaissStore, tuple, int]]" = OrderedDict()  # name -> (store, stamp, bytes)
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._name_locks: Dict[str, threading.RLock] = defaultdict(threading.RLock)
+        # counters
+        self.evictions = 0
+        self.invalidations = 0
+        self.compactions = 0
+        self.rebuilds = 0
+        self._maintaining = set()  # names with a background compaction/rebuild running
+        self._latency = defaultdict(lambda: {
+            "cold_loads": 0, "load_ms": 0.0, "last_load_ms": None,
+            "cold_queries": 0, "cold_query_ms": 0.0,
+            "warm_queries": 0, "warm_query_ms": 0.0,
+        })
+
+    def _paths(self, name: str) -> Tuple[str, ...]:
+        # .ids.i64 grows on every add, the WAL on every tombstone, .faiss on every checkpoint
+        exts = (".faiss", ".ids.i64", ".meta.db", ".meta.db-wal")
+        return tuple(os.path.join(self.root, f"{name}{ext}") for ext in exts)
+
+    def version(self, name: str) -> tuple:
+        """Version stamp of an index on disk (changes on every persist)."""
+        return tuple(_stat(p) for p in self._paths(name))
+
+    def _cached(self, name: str):
+        """The cached store if its stamp still matches the files, else None."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            store, stamp, _ = entry
+            if stamp != self.version(name):
+                self._drop(name)
+                self.invalidations += 1
+                return None
+            self._entries.move_to_end(name)
+            return store
+
+    def get(self, name: str, dim: int = DEFAULT_DIM) -> Tuple[FaissStore, bool]:
+        """Returns (store, cold): the loaded store for name, reading it from disk if needed."""
+        store = self._cached(name)
+        if store is not None:
+            return store, False
+        with self._name_locks[name]:  # concurrent cold queries share one load
+            store = self._cached(name)
+            if store is not None:
+                return store, False
+            start = time.perf_counter()
+            stamp = self.version(name)
+            store = FaissStore(root=self.root, name=name)
+            store.load(dim=dim)
+            ms = (time.perf_counter() - start) * 1000
+            self._put(name, store, stamp)
+            with self._lock:
+                lat = self._latency[name]
+                lat["cold_loads"] += 1
+                lat["load_ms"] += ms
+                lat["last_load_ms"] = round(ms, 1)
+            print(f"📂 Loaded index '{name}' ({store.size()} vectors) in {ms:.0f}ms")
+            return store, True
+
+    def describe(self, name: str) -> dict:
+        """
+        Listing info for an index from its files on disk (manifest, live chunk
+        count, bytes). Never loads it: listing must not evict the warm
+        indexes queries use; cache state is reported only if already resident.
+        """
+        manifest = {"type": "flat", "target": DEFAULT_INDEX_TYPE, "params": {}}
+        manifest_path = os.path.join(self.root, f"{name}.manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest.update(json.load(f))
+        store = self._cached(name)
+        if store is not None:
+            size = store.size()
+        else:
+            meta_path = os.path.join(self.root, f"{name}.meta.db")
+            size = None  # legacy .meta.json index: counted once it's loaded (and migrated)
+            with self._name_locks[name]:  # don't recreate a meta.db that rag_delete_index is removing
+                meta = ChunkMetaStore(meta_path) if os.path.exists(meta_path) else None
+            if meta is not None:
+                try:
+                    size = meta.count()
+                finally:
+                    meta.close()
+        stats = [_stat(os.path.join(self.root, f"{name}{ext}")) for ext in INDEX_FILES]
+        with self._lock:
+            entry = self._entries.get(name)
+        return {
+            "index_name": name,
+            "size": size,
+            "type": manifest["type"],
+            "target": manifest["target"],
+            "params": manifest["params"],
+            "quality": manifest.get("quality"),  # bytes/vector, recall@k vs exact search
+            "disk_bytes": sum(st[1] for st in stats if st),
+            "cached": entry is not None,
+            "resident_bytes": entry[2] if entry else None,
+        }
+
+    def search(self, name: str, query_vec: np.ndarray, k: int = 5, dim: int = DEFAULT_DIM,
+               nprobe: int | None = None, ef_search: int | None = None,
+               rerank: bool | None = None) -> List[Tuple[float, Dict]]:
+        start = time.perf_counter()
+        store, cold = self.get(name, dim=dim)
+        hits = store.search(query_vec, k=k, nprobe=nprobe, ef_search=ef_search, rerank=rerank)
+        ms = (time.perf_counter() - start) * 1000
+        kind = "cold" if cold else "warm"
+        with self._lock:
+            lat = self._latency[name]
+            lat[f"{kind}_queries"] += 1
+            lat[f"{kind}_query_ms"] += ms
+        return hits
+
+    @contextmanager
+    def writing(self, name: str, dim: int = DEFAULT_DIM, index_type: str | None = None):
+        """
+        Yields a private copy of the store to mutate (add / delete_doc persist
+        it); on exit the copy replaces the cached store under the new stamp.
+        index_type is only applied when the index is being created.
+        """
+        with self._name_locks[name]:
+            current, _ = self.get(name, dim=dim)
+            store = current.clone()
+            if index_type and not os.path.exists(store.manifest_path):
+                store.manifest["target"] = index_type
+            yield store
+            self._put(name, store, self.version(name))
+
+    def lock(self, name: str) -> threading.RLock:
+        """The index's write lock (e.g. to delete its files without racing a background swap)."""
+        return self._name_locks[name]
+
+    def compact_async(self, name: str) -> bool:
+        """Starts a background compaction of name unless one is running; returns whether it started."""
+        return self._background(name, self._compact)
+
+    def rebuild_async(self, name: str) -> bool:
+        """Starts a background rebuild of name as its desired index type; returns whether it started."""
+        return self._background(name, self._rebuild)
+
+    def _background(self, name: str, fn) -> bool:
+        with self._lock:
+            if name in self._maintaining:
+                return False
+            self._maintaining.add(name)
+        threading.Thread(target=fn, args=(name,), daemon=True).start()
+        return True
+
+    def _compact(self, name: str):
+        try:
+            start = time.perf_counter()
+            dropped = self._maintain(name, compact=True)
+            if dropped is not None:
+                with self._lock:
+                    self.compactions += 1
+                print(f"🧹 Compacted index '{name}': dropped {dropped} tombstoned chunks in {(time.perf_counter() - start) * 1000:.0f}ms")
+        except Exception as e:
+            print(f"⚠️ Compaction of index '{name}' failed: {e!r}")
+        finally:
+            with self._lock:
+                self._maintaining.discard(name)
+
+    def _rebuild(self, name: str):
+        try:
+            if self._maintain(name, compact=False) is not None:
+                with self._lock:
+                    self.rebuilds += 1
+        except Exception as e:
+            print(f"⚠️ Rebuild of index '{name}' failed: {e!r}")
+        finally:
+            with self._lock:
+                self._maintaining.discard(name)
+
+    def _maintain(self, name: str, compact: bool):
+        """
+        Snapshot under the write lock (cheap), build outside it, swap in under
+        it. Returns the number of chunks dropped, or None if there was
+        nothing to do or the index was deleted meanwhile.
+        """
+        with self._name_locks[name]:
+            snapshot = self.get(name)[0].clone()
+        if not (snapshot.needs_compaction() if compact else snapshot.needs_rebuild()):
+            return None
+        plan = snapshot.plan_rebuild(compact=compact)
+        with self._name_locks[name]:
+            if not os.path.exists(snapshot.manifest_path):
+                snapshot.discard_plan(plan)
+                return None
+            current, _ = self.get(name)
+            try:
+                store = current.apply_rebuild(plan)
+            except Exception:
+                snapshot.discard_plan(plan)
+                raise
+            self._put(name, store, self.version(name))
+        return len(plan["dropped"])
+
+    def invalidate(self, name: str):
+        """Forgets a cached index (e.g. after its files were deleted)."""
+        with self._lock:
+            if name in self._entries:
+                self._drop(name)
+                self.invalidations += 1
+
+    def _put(self, name: str, store: FaissStore, stamp: tuple):
+        size = store.nbytes()
+        with self._lock:
+            if name in self._entries:
+                self._drop(name, keep=store)
+            if size > self.budget_bytes:
+                return
+            self._entries[name] = (store, stamp, size)
+            self._bytes += size
+            while self._bytes > self.budget_bytes and len(self._entries) > 1:
+                old = next(iter(self._entries))
+                self._drop(old)
+                self.evictions += 1
+                print(f"♻️ Evicted index '{old}' from memory (budget {self.budget_bytes / 1024 / 1024:.0f}MB)")
+
+    def _drop(self, name: str, keep: FaissStore | None = None):
+        """Forgets name's entry and closes its SQLite connection (unless keep, its replacement, shares it)."""
+        store, _, size = self._entries.pop(name)
+        self._bytes -= size
+        if store.meta is not None and (keep is None or store.meta is not keep.meta):
+            store.meta.close()
+
+    def stats(self) -> dict:
+        def _avg(total, n):
+            return round(total / n, 1) if n else None
+
+        with self._lock:
+            indexes = {}
+            for name, lat in self._latency.items():
+                entry = self._entries.get(name)
+                indexes[name] = {
+                    "cached": entry is not None,
+                    "vectors": entry[0].size() if entry else None,
+                    "tombstones": len(entry[0].tombstones) if entry else None,
+                    "type": entry[0].manifest["type"] if entry else None,
+                    "maintaining": name in self._maintaining,
+                    "bytes": entry[2] if entry else None,
+                    "cold_loads": lat["cold_loads"],
+                    "load_ms_avg": _avg(lat["load_ms"], lat["cold_loads"]),
+                    "last_load_ms": lat["last_load_ms"],
+                    "cold_queries": lat["cold_queries"],
+                    "cold_query_ms_avg": _avg(lat["cold_query_ms"], lat["cold_queries"]),
+                    "warm_queries": lat["warm_queries"],
+                    "warm_query_ms_avg": _avg(lat["warm_query_ms"], lat["warm_queries"]),
+                }
+            return {
+                "cached_indexes": len(self._entries),
+                "bytes": self._bytes,
+                "budget_bytes": self.budget_bytes,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "compactions": self.compactions,
+                "rebuilds": self.rebuilds,
+                "indexes": indexes,
+            }
+
+
+manager = IndexManager()
@@ -0,0 +1,114 @@
+import os, json, sqlite3, threading
+from typing import Dict, Iterable, List, Set
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id       INTEGER PRIMARY KEY,   -- the chunk's FAISS ID
+    chunk_id TEXT,
+    doc_id   TEXT,
+    text     TEXT,
+    metadata TEXT,                  -- JSON
+    deleted  INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS chunks_doc ON chunks (doc_id);
+"""
+
+class ChunkMetaStore:
+    """
+    Append-only chunk metadata/text for one index, in SQLite (<name>.meta.db).
+
+    Adding chunks inserts only the new rows (no rewrite of existing ones) and
+    nothing is held in memory: search fetches text/metadata for just the
+    top-k hits by primary key. Deletes set a tombstone flag; compaction
+    removes the rows.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # a store evicted from the index cache is closed, but an in-flight
+        # search may still hold it: reopen (never create) the database for it
+        if self._conn is None:
+            self._conn = sqlite3.connect(f"file:{self.path}?mode=rw", uri=True, check_same_thread=False)
+        return self._conn
+
+    def append(self, rows: Iterable[Dict]):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO chunks (id, chunk_id, doc_id, text, metadata, deleted) VALUES (?, ?, ?, ?, ?, ?)",
+                [(r["id"], r["chunk_id"], r["doc_id"], r["text"], json.dumps(r.get("metadata") or {}),
+                  int(bool(r.get("deleted")))) for r in rows],
+            )
+
+    def get(self, ids: List[int]) -> Dict[int, Dict]:
+        """Rows by chunk ID (missing IDs are left out)."""
+        if not ids:
+            return {}
+        marks = ",".join("?" * len(ids))
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT id, chunk_id, doc_id, text, metadata FROM chunks WHERE id IN ({marks})",
+                [int(i) for i in ids],
+            ).fetchall()
+        return {r[0]: {"id": r[0], "chunk_id": r[1], "doc_id": r[2], "text": r[3],
+                       "metadata": json.loads(r[4] or "{}")} for r in rows}
+
+    def live_ids(self, doc_id: str) -> List[int]:
+        with self._lock:
+            return [r[0] for r in self._db.execute(
+                "SELECT id FROM chunks WHERE doc_id = ? AND deleted = 0", (doc_id,))]
+
+    def tombstone(self, ids: List[int]):
+        with self._lock, self._db:
+            self._db.executemany("UPDATE chunks SET deleted = 1 WHERE id = ?", [(int(i),) for i in ids])
+
+    def tombstoned(self) -> Set[int]:
+        with self._lock:
+            return {r[0] for r in self._db.execute("SELECT id FROM chunks WHERE deleted = 1")}
+
+    def remove(self, ids: Iterable[int]):
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM chunks WHERE id = ?", [(int(i),) for i in ids])
+
+    def count(self) -> int:
+        """Live (not tombstoned) chunks."""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chunks WHERE deleted = 0").fetchone()[0]
+
+    def max_id(self) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT MAX(id) FROM chunks").fetchone()
+        return row[0] if row[0] is not None else -1
+
+    def metadata(self) -> List[Dict]:
+        """Metadata of every chunk (e.g. to find source files)."""
+        with self._lock:
+            return [json.loads(r[0] or "{}") for r in self._db.execute("SELECT metadata FROM chunks")]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+def migrate_json(json_path: str, db_path: str) -> int:
+    """
+    Imports a legacy <name>.meta.json (a list whose i-th entry is the chunk
+    at ID i, or carries its "id") into <name>.meta.db and renames the JSON
+    to .migrated. Returns the number of chunks imported.
+    """
+    with open(json_path, "r") as f:
+        meta = json.load(f)
+    store = ChunkMetaStore(db_path)
+    try:
+        store.append({**m, "id": m.get("id", i)} for i, m in enumerate(meta))
+    finally:
+        store.close()
+    os.replace(json_path, json_path + ".migrated")
+    print(f"🔁 Migrated {len(meta)} chunks from {os.path.basename(json_path)} to SQLite")
+    return len(meta)
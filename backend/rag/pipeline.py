@@ -1,6 +1,12 @@
-import httpx
 from typing import Dict, Any, List
+from fastapi.concurrency import run_in_threadpool
 from .retriever import retrieve
+import worker_client
+import scheduler
+from response_cache import cache as response_cache
+import single_flight
+
+LLAMA_MODEL_NAME = "meta-llama/Llama-3.2-1B-Instruct"
 
 RAG_PROMPT = """You are a helpful assistant. Answer the user using ONLY the provided context.
 If the answer is not in the context, say you don't know.
@@ -31,7 +37,8 @@ def build_context(chunks: List[Dict], max_chars=3500):
         })
     return ctx, used
 
-async def call_llama_worker(prompt: str, port: int = 21002, temperature=0.2, top_p=0.95, max_new_tokens=400):
+async def call_llama_worker(prompt: str, port: int = 21002, temperature=0.2, top_p=0.95, max_new_tokens=400,
+                            cache: bool | None = None):
     # Calls your existing /worker_generate on the LLaMA worker
     payload = {
         "prompt": prompt,
@@ -39,16 +46,28 @@ async def call_llama_worker(prompt: str, port: int = 21002, temperature=0.2, top
         "top_p": top_p,
         "max_new_tokens": max_new_tokens
     }
-    url = f"http://127.0.0.1:{port}/worker_generate"
-    async with httpx.AsyncClient(timeout=60) as client:
-        r = await client.post(url, json=payload)
-        r.raise_for_status()
-        data = r.json()
-        # Expect { "text": "..." } per your worker; adjust if needed
-        return data.get("text") or data.get("output") or str(data)
-
-async def answer_with_rag(query: str, index_name="default", top_k=5):
-    hits = retrieve(index_name, query, top_k=top_k)
+    use_cache = response_cache.enabled_for(payload, cache)
+    data = response_cache.get(LLAMA_MODEL_NAME, payload) if use_cache else None
+    if data is None:
+        async def _generate():
+            # Share the chat endpoint's admission queue so RAG can't overrun the worker
+            async with scheduler.get(LLAMA_MODEL_NAME).slot():
+                async with worker_client.route(LLAMA_MODEL_NAME, port) as lease:
+                    r = await lease.pool.post("/worker_generate", json=payload, timeout=60)
+                    r.raise_for_status()
+            return r.json()
+
+        # identical concurrent calls share one generation
+        data = await single_flight.run(LLAMA_MODEL_NAME, payload, _generate)
+        if use_cache:
+            response_cache.put(LLAMA_MODEL_NAME, payload, data)
+    # Expect { "text": "..." } per your worker; adjust if needed
+    return data.get("text") or data.get("output") or str(data)
+
+async def answer_with_rag(query: str, index_name="default", top_k=5, nprobe=None, ef_search=None, rerank=None):
+    # embedding, a cold index load and the index's (threading) lock all block: keep them off the event loop
+    hits = await run_in_threadpool(retrieve, index_name, query, top_k=top_k, nprobe=nprobe,
+                                   ef_search=ef_search, rerank=rerank)
     ctx, used = build_context(hits)
     prompt = RAG_PROMPT.format(question=query, context=ctx if ctx.strip() else "No context.")
     reply = await call_llama_worker(prompt)
@@ -1,11 +1,13 @@
 import numpy as np
 from typing import List, Dict
 from .embeddings import embed_texts
-from .store_faiss import FaissStore
+from .index_manager import manager
 
-def retrieve(index_name: str, query: str, top_k=5) -> List[Dict]:
-    store = FaissStore(name=index_name)
-    store.load(dim=384)
+def retrieve(index_name: str, query: str, top_k=5, nprobe=None, ef_search=None, rerank=None) -> List[Dict]:
+    # loaded indexes stay in memory across queries; reloaded only when the files change
     qv = embed_texts([query])
-    hits = store.search(np.array(qv), k=top_k)
+    # nprobe / ef_search tune IVF / HNSW indexes (ignored for flat ones);
+    # rerank re-scores candidates exactly (default: on for compressed indexes)
+    hits = manager.search(index_name, np.array(qv), k=top_k, dim=384,
+                          nprobe=nprobe, ef_search=ef_search, rerank=rerank)
     return [{"score": s, **m} for s, m in hits]
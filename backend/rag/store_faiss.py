@@ -1,69 +1,455 @@
-import os, json, faiss, numpy as np
+import os, json, time, faiss, numpy as np
 from typing import List, Dict, Tuple
 from .schema import Chunk
-from .embeddings import embed_texts
+from .meta_store import ChunkMetaStore, migrate_json
+
+# Compact once this share of the stored chunks are tombstones
+COMPACT_RATIO = float(os.environ.get("RAG_COMPACT_RATIO", "0.2"))
+
+# Index types: "flat" (exact), "ivf" (IVF-Flat), "hnsw", compressed "sq8" /
+# "fp16" (scalar quantization) and "pq" (product quantization); "auto" = flat
+# until RAG_ANN_THRESHOLD vectors, then RAG_ANN_TYPE
+INDEX_TYPES = ("flat", "ivf", "hnsw", "sq8", "fp16", "pq", "auto")
+COMPRESSED_TYPES = ("sq8", "fp16", "pq")
+DEFAULT_INDEX_TYPE = os.environ.get("RAG_INDEX_TYPE", "auto")
+ANN_TYPE = os.environ.get("RAG_ANN_TYPE", "hnsw")
+ANN_THRESHOLD = int(os.environ.get("RAG_ANN_THRESHOLD", "50000"))
+IVF_NPROBE = int(os.environ.get("RAG_IVF_NPROBE", "16"))
+IVF_TRAIN_PER_LIST = 39  # faiss warns below this many training points per centroid
+HNSW_M = int(os.environ.get("RAG_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("RAG_HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.environ.get("RAG_HNSW_EF_SEARCH", "64"))
+PQ_M = int(os.environ.get("RAG_PQ_M", "48"))  # sub-quantizers = bytes per vector (8-bit codes)
+PQ_MIN_TRAIN = 1024
+# Compressed indexes fetch RERANK_FACTOR x candidates and re-score them exactly
+# against the full-precision rows in .emb.f32 (memory-mapped, not resident)
+RERANK_FACTOR = int(os.environ.get("RAG_RERANK_FACTOR", "4"))
+RECALL_K = int(os.environ.get("RAG_RECALL_K", "10"))
+RECALL_QUERIES = int(os.environ.get("RAG_RECALL_QUERIES", "200"))
+# Vectors added since the last checkpoint sit in an in-memory flat "tail"
+# index; past this many the tail is folded into the .faiss file in the background
+TAIL_ROWS = int(os.environ.get("RAG_TAIL_ROWS", "20000"))
+
+def _ivf_nlist(n: int) -> int:
+    return max(1, min(int(4 * np.sqrt(n)), n // IVF_TRAIN_PER_LIST))
+
+def _pq_m(dim: int) -> int:
+    # sub-quantizers must divide the dimension
+    return max(m for m in range(1, min(PQ_M, dim) + 1) if dim % m == 0)
+
+def _min_vectors(kind: str) -> int:
+    """Vectors needed before an index of this type can be trained."""
+    return {"ivf": IVF_TRAIN_PER_LIST * 4, "pq": PQ_MIN_TRAIN}.get(kind, 0)
+
+def _train_sample(vecs: np.ndarray, n: int) -> np.ndarray:
+    return np.ascontiguousarray(vecs[np.sort(np.random.default_rng(0).permutation(len(vecs))[:n])])
+
+def _search_params(kind: str, params: Dict, nprobe: int | None = None, ef_search: int | None = None, sel=None):
+    # per-call parameters: the cached index is shared by concurrent queries.
+    # sel (the tombstone filter) is applied inside faiss; IndexPQ doesn't support selectors
+    if kind == "ivf":
+        search = faiss.SearchParametersIVF(nprobe=max(1, nprobe or params["nprobe"]))
+    elif kind == "hnsw":
+        search = faiss.SearchParametersHNSW(efSearch=ef_search or params["efSearch"])
+    elif sel is not None and kind != "pq":
+        search = faiss.SearchParameters()
+    else:
+        return None
+    if sel is not None:
+        search.sel = sel  # the caller keeps the selector alive
+    return search
+
+def _rerank(query: np.ndarray, cand: List[int], ids: np.ndarray, vecs: np.ndarray) -> List[Tuple[float, int]]:
+    """Exact inner products of the candidate IDs from the full-precision rows (ids ascending, rows aligned)."""
+    # sorted rows read the mmap sequentially
+    rows = np.sort(np.searchsorted(ids, cand))
+    scores = np.asarray(vecs[rows], dtype="float32") @ query
+    return [(float(scores[i]), int(ids[rows[i]])) for i in np.argsort(-scores)]
+
+def _write_rows(path_vecs: str, path_ids: str, vecs: np.ndarray, ids: np.ndarray, mode: str = "ab"):
+    # vectors first: on a crash the shorter of the two files bounds the valid rows
+    with open(path_vecs, mode) as f:
+        f.write(np.ascontiguousarray(vecs, dtype="float32").tobytes())
+    with open(path_ids, mode) as f:
+        f.write(np.ascontiguousarray(ids, dtype="int64").tobytes())
+
+def build_index(kind: str, dim: int, vecs: np.ndarray, ids: np.ndarray) -> Tuple[faiss.Index, Dict]:
+    """An ID-mapped index of the given type holding vecs under ids, and its parameters."""
+    if kind == "ivf":
+        nlist = _ivf_nlist(len(vecs))
+        inner = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        sample = _train_sample(vecs, nlist * 256)
+        inner.train(sample)
+        params = {"nlist": nlist, "nprobe": min(IVF_NPROBE, nlist), "trained_on": len(sample),
+                  "bytes_per_vector": 4 * dim}
+    elif kind == "hnsw":
+        inner = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        inner.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        params = {"M": HNSW_M, "efConstruction": HNSW_EF_CONSTRUCTION, "efSearch": HNSW_EF_SEARCH,
+                  "bytes_per_vector": 4 * dim + 2 * HNSW_M * 4}  # vector + ~2M graph links on level 0
+    elif kind in ("sq8", "fp16"):
+        qtype = faiss.ScalarQuantizer.QT_8bit if kind == "sq8" else faiss.ScalarQuantizer.QT_fp16
+        inner = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+        sample = _train_sample(vecs, 65536)
+        inner.train(sample)  # per-dimension ranges (a no-op for fp16)
+        params = {"trained_on": len(sample), "rerank_factor": RERANK_FACTOR,
+                  "bytes_per_vector": inner.code_size}
+    elif kind == "pq":
+        m = _pq_m(dim)
+        inner = faiss.IndexPQ(dim, m, 8, faiss.METRIC_INNER_PRODUCT)
+        sample = _train_sample(vecs, 256 * 256)
+        inner.train(sample)
+        params = {"M": m, "nbits": 8, "trained_on": len(sample), "rerank_factor": RERANK_FACTOR,
+                  "bytes_per_vector": inner.code_size}
+    else:
+        inner = faiss.IndexFlatIP(dim)  # inner product (cosine if normalized)
+        params = {"bytes_per_vector": 4 * dim}
+    index = faiss.IndexIDMap2(inner)
+    if len(vecs):
+        index.add_with_ids(vecs, ids)
+    return index, params
 
 class FaissStore:
+    """
+    Chunks have stable int64 IDs. Their embeddings are an append-only row log:
+    <name>.emb.f32 (raw float32 rows, memory-mapped) and <name>.ids.i64 (the
+    row's ID; IDs ascend), so nothing ever has to be re-embedded. Chunk
+    text/metadata is in an append-only SQLite store (<name>.meta.db) and only
+    fetched for search hits.
+
+    Search covers two ID-mapped indexes: `index`, the checkpoint in
+    <name>.faiss holding the first index.ntotal rows, and `tail`, an
+    in-memory flat index of the rows added since (rebuilt from the row log on
+    load). add() only appends rows and grows the tail, so ingestion cost is
+    per batch; the .faiss file is written by rebuilds only (plan_rebuild /
+    apply_rebuild): when the tail passes TAIL_ROWS, on compaction, and when
+    the index type changes. delete_doc only tombstones chunks (filtered at
+    search time); compaction drops them from the row log and the index.
+
+    The index type (flat / ivf / hnsw / sq8 / fp16 / pq) and its parameters
+    are recorded in <name>.manifest.json. Each non-flat build records bytes
+    per vector and recall@k against exact search in the manifest. A
+    compressed index keeps only its codes resident; the full-precision rows
+    are paged in from the mmap for re-ranking candidates.
+    """
     def __init__(self, root="indices", name="default"):
         os.makedirs(root, exist_ok=True)
         self.root = root
         self.name = name
         self.index_path = os.path.join(root, f"{name}.faiss")
-        self.meta_path  = os.path.join(root, f"{name}.meta.json")
+        self.meta_path  = os.path.join(root, f"{name}.meta.db")
+        self.vecs_path  = os.path.join(root, f"{name}.emb.f32")
+        self.ids_path   = os.path.join(root, f"{name}.ids.i64")
+        self.legacy_meta_path = os.path.join(root, f"{name}.meta.json")
+        self.legacy_emb_path  = os.path.join(root, f"{name}.emb.npy")
+        self.manifest_path = os.path.join(root, f"{name}.manifest.json")
+        self.manifest: Dict = {"type": "flat", "target": DEFAULT_INDEX_TYPE, "params": {}}
         self.index = None
-        self.meta: List[Dict] = []
+        self.tail = None
+        self.meta: ChunkMetaStore | None = None
+        self.embeddings = None
+        self.ids = np.zeros(0, dtype="int64")
         self.dim: int = 384  # MiniLM default
+        self.tombstones = set()
+        self._selector = None  # (tombstone count, IDSelectorBatch, IDSelectorNot), built on first search
+        self.next_id = 0
 
     def load(self, dim: int = 384):
         self.dim = dim
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+            self.dim = self.manifest.get("dim", dim)
+        if os.path.exists(self.legacy_meta_path) and not os.path.exists(self.meta_path):
+            migrate_json(self.legacy_meta_path, self.meta_path)
+        self.meta = ChunkMetaStore(self.meta_path)
         if os.path.exists(self.index_path):
             self.index = faiss.read_index(self.index_path)
-            self.meta = json.load(open(self.meta_path, "r"))
+            self.dim = self.index.d
+            if not isinstance(self.index, faiss.IndexIDMap2):
+                self._migrate()
+            elif not os.path.exists(self.ids_path):
+                self._migrate_rows()
         else:
-            self.index = faiss.IndexFlatIP(dim)  # inner product (cosine if normalized)
-            self.meta = []
+            self.index, _ = build_index("flat", self.dim, np.zeros((0, self.dim), dtype="float32"), self.ids)
+        self._open_rows()
+        base_ids = faiss.vector_to_array(self.index.id_map).astype("int64")
+        if not np.array_equal(base_ids, self.ids[:len(base_ids)]):
+            # crash between writing the row log and the checkpoint: rebuild it from the rows
+            print(f"⚠️ Index '{self.name}' checkpoint doesn't match its row log; rebuilding")
+            self.index, _ = build_index(self.manifest["type"], self.dim, np.asarray(self.embeddings), self.ids)
+        self._reset_tail()
+        self._reindex()
+        if len(self.ids) and not os.path.exists(self.manifest_path):
+            self._write_manifest()
 
-    def persist(self):
+    def _migrate(self):
+        # Pre-ID index: row i was chunk i; keep its vectors, give them IDs 0..n-1
+        vecs = self.index.reconstruct_n(0, self.index.ntotal)
+        ids = np.arange(len(vecs), dtype="int64")
+        self.index, _ = build_index("flat", self.dim, vecs, ids)
+        _write_rows(self.vecs_path, self.ids_path, vecs, ids, mode="wb")
         faiss.write_index(self.index, self.index_path)
-        with open(self.meta_path, "w") as f:
-            json.dump(self.meta, f)
+        self._write_manifest()
+        print(f"🔁 Migrated index '{self.name}' to stable chunk IDs ({len(ids)} vectors)")
+
+    def _migrate_rows(self):
+        # ID-mapped index without a row log: take rows from <name>.emb.npy, or the flat index itself
+        ids = faiss.vector_to_array(self.index.id_map).astype("int64")
+        if os.path.exists(self.legacy_emb_path):
+            vecs = np.load(self.legacy_emb_path)
+        else:
+            vecs = self.index.index.reconstruct_n(0, self.index.ntotal) if len(ids) else np.zeros((0, self.dim), "float32")
+        _write_rows(self.vecs_path, self.ids_path, vecs, ids, mode="wb")
+        if os.path.exists(self.legacy_emb_path):
+            os.remove(self.legacy_emb_path)
+        print(f"🔁 Moved embeddings of index '{self.name}' to an append-only row log ({len(ids)} rows)")
+
+    def _open_rows(self):
+        """Maps the row log (read-only); rows past the shorter file are a torn append and ignored."""
+        ids = np.fromfile(self.ids_path, dtype="int64") if os.path.exists(self.ids_path) else np.zeros(0, "int64")
+        vec_rows = os.path.getsize(self.vecs_path) // (4 * self.dim) if os.path.exists(self.vecs_path) else 0
+        n = min(len(ids), vec_rows)
+        self.ids = ids[:n]
+        self.embeddings = np.memmap(self.vecs_path, dtype="float32", mode="r", shape=(n, self.dim)) \
+            if n else np.zeros((0, self.dim), dtype="float32")
+
+    def _reset_tail(self):
+        """Flat index over the rows the checkpoint doesn't cover."""
+        start = self.index.ntotal
+        self.tail, _ = build_index("flat", self.dim, np.asarray(self.embeddings[start:]), self.ids[start:])
+
+    def _reindex(self):
+        self.tombstones = self.meta.tombstoned()
+        # never reuse an ID (rows may outlive their vectors after a crash mid-add)
+        self.next_id = max(self.next_id, int(self.ids.max()) + 1 if len(self.ids) else 0, self.meta.max_id() + 1)
+
+    def _write_manifest(self):
+        self.manifest.update({"dim": self.dim, "metric": "inner_product"})
+        tmp = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, self.manifest_path)
+
+    def clone(self) -> "FaissStore":
+        """Copy to mutate while readers keep using this one (the checkpoint index and row log are shared)."""
+        other = FaissStore(root=self.root, name=self.name)
+        other.dim = self.dim
+        other.manifest = json.loads(json.dumps(self.manifest))
+        other.index = self.index  # never modified once published
+        other.tail = faiss.clone_index(self.tail)  # small: rows since the last checkpoint
+        other.meta = self.meta  # append-only on disk: shared
+        other.embeddings = self.embeddings  # read-only map of the first len(ids) rows
+        other.ids = self.ids
+        other.next_id = self.next_id
+        other._reindex()
+        return other
 
     def add(self, embeddings: np.ndarray, chunks: List[Chunk]):
         if self.index is None:
             self.load(embeddings.shape[1])
-        self.index.add(embeddings.astype("float32"))
-        for c in chunks:
-            self.meta.append({
-                "chunk_id": c.chunk_id, "doc_id": c.doc_id,
-                "text": c.text, "metadata": c.metadata
-            })
-        self.persist()
-
-    def search(self, query_vec: np.ndarray, k=5) -> List[Tuple[float, Dict]]:
-        D, I = self.index.search(query_vec.astype("float32"), k)
-        out = []
-        for score, idx in zip(D[0], I[0]):
-            if idx == -1: continue
-            m = self.meta[idx]
-            out.append((float(score), m))
-        return out
+        embeddings = embeddings.astype("float32")
+        ids = np.arange(self.next_id, self.next_id + len(chunks), dtype="int64")
+        self.meta.append({
+            "id": int(i), "chunk_id": c.chunk_id, "doc_id": c.doc_id,
+            "text": c.text, "metadata": c.metadata
+        } for i, c in zip(ids, chunks))
+        _write_rows(self.vecs_path, self.ids_path, embeddings, ids)
+        self.tail.add_with_ids(embeddings, ids)
+        self.next_id += len(chunks)
+        self._open_rows()
+        if not os.path.exists(self.manifest_path):
+            self._write_manifest()
+
+    def search(self, query_vec: np.ndarray, k=5, nprobe: int | None = None,
+               ef_search: int | None = None, rerank: bool | None = None) -> List[Tuple[float, Dict]]:
+        query_vec = query_vec.astype("float32")
+        if rerank is None:
+            rerank = self.manifest["type"] in COMPRESSED_TYPES
+        want = k * RERANK_FACTOR if rerank else k
+        found = []
+        for index, kind in ((self.index, self.manifest["type"]), (self.tail, "flat")):
+            found.extend(self._search_live(index, kind, query_vec, want, nprobe, ef_search))
+        found.sort(key=lambda hit: -hit[0])
+        hits = found[:want]
+        if rerank and hits:
+            hits = _rerank(query_vec[0], [idx for _, idx in hits], self.ids, self.embeddings)
+        hits = hits[:k]
+        # text/metadata for the top-k only
+        rows = self.meta.get([idx for _, idx in hits])
+        return [(score, rows[idx]) for score, idx in hits if idx in rows]
+
+    def _search_live(self, index, kind: str, query_vec: np.ndarray, want: int,
+                     nprobe: int | None, ef_search: int | None) -> List[Tuple[float, int]]:
+        """Top `want` (score, ID) hits of one index, skipping tombstoned IDs."""
+        sel = self._tombstone_selector() if kind != "pq" else None
+        fetch = min(want, index.ntotal)
+        while fetch:
+            D, I = index.search(query_vec, fetch, params=_search_params(kind, self.manifest["params"], nprobe, ef_search, sel))
+            hits = [(float(score), int(idx)) for score, idx in zip(D[0], I[0])
+                    if idx != -1 and idx not in self.tombstones]
+            # a selector already excludes tombstones; without one (pq), widen the search until enough live hits
+            if sel is not None or len(hits) >= want or fetch >= index.ntotal:
+                return hits[:want]
+            fetch = min(2 * fetch, index.ntotal)
+        return []
+
+    def _tombstone_selector(self):
+        """Faiss ID selector excluding the tombstones (None without any); rebuilt when tombstones grow."""
+        if not self.tombstones:
+            return None
+        cached = self._selector
+        if cached is None or cached[0] != len(self.tombstones):
+            ids = np.fromiter(self.tombstones, dtype="int64", count=len(self.tombstones))
+            batch = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+            cached = self._selector = (len(ids), batch, faiss.IDSelectorNot(batch))  # batch must outlive the Not
+        return cached[2]
+
+    def desired_type(self) -> str:
+        kind, target = self.manifest["type"], self.manifest["target"]
+        n = len(self.ids) - len(self.tombstones)
+        if target == "auto":
+            if kind != "flat" or n < ANN_THRESHOLD:
+                return kind
+            target = ANN_TYPE
+        if n < _min_vectors(target):
+            return kind  # not enough vectors to train it yet
+        return target
+
+    def needs_rebuild(self) -> bool:
+        return self.desired_type() != self.manifest["type"] or self.tail.ntotal >= TAIL_ROWS
+
+    def needs_compaction(self) -> bool:
+        return bool(self.tombstones) and len(self.tombstones) >= COMPACT_RATIO * max(len(self.ids), 1)
+
+    def plan_rebuild(self, kind: str | None = None, compact: bool = False) -> Dict:
+        """
+        Builds a new checkpoint from this store's rows without touching the
+        live files (meant to run on a clone, outside any lock): as `kind`
+        (default desired_type()), dropping tombstoned rows if compact. With
+        the same type and nothing to drop, the tail is just folded into a
+        copy of the checkpoint. The new index (and the compacted row log) go
+        to temp files; apply_rebuild() swaps them in.
+        """
+        kind = kind or self.desired_type()
+        start = time.perf_counter()
+        dropped = set(self.tombstones) if compact else set()
+        rows = len(self.ids)
+        plan = {"kind": kind, "rows": rows, "dropped": dropped, "rewrite": bool(dropped),
+                "index_tmp": f"{self.index_path}.{os.getpid()}.{id(self)}.tmp",
+                "vecs_tmp": f"{self.vecs_path}.{os.getpid()}.{id(self)}.tmp",
+                "ids_tmp": f"{self.ids_path}.{os.getpid()}.{id(self)}.tmp"}
+        if kind == self.manifest["type"] and not dropped:
+            index = faiss.clone_index(self.index)
+            base = index.ntotal
+            if rows > base:
+                index.add_with_ids(np.asarray(self.embeddings[base:]), self.ids[base:])
+            params, quality = self.manifest["params"], self.manifest.get("quality")
+        else:
+            live = ~np.isin(self.ids, np.fromiter(dropped, dtype="int64"))
+            vecs, ids = np.asarray(self.embeddings[live]), self.ids[live]
+            index, params = build_index(kind, self.dim, vecs, ids)
+            quality = _measure(index, kind, params, vecs, ids) if kind != "flat" else None
+            if plan["rewrite"]:
+                _write_rows(plan["vecs_tmp"], plan["ids_tmp"], vecs, ids, mode="wb")
+        faiss.write_index(index, plan["index_tmp"])
+        plan.update({"index": index, "params": params, "quality": quality,
+                     "build_ms": round((time.perf_counter() - start) * 1000, 1)})
+        print(f"🏗️ Built {kind} index '{self.name}' over {index.ntotal} vectors in {plan['build_ms']:.0f}ms "
+              f"{params} {quality or {}}")
+        return plan
+
+    def apply_rebuild(self, plan: Dict) -> "FaissStore":
+        """
+        Swaps a plan's checkpoint in under this (current) store: rows added
+        after the plan's snapshot are appended to the compacted row log and
+        become the new tail. Call with the index's write lock held. Returns
+        the new store; self stays valid for in-flight readers.
+        """
+        extra = slice(plan["rows"], len(self.ids))
+        if plan["rewrite"]:
+            _write_rows(plan["vecs_tmp"], plan["ids_tmp"], np.asarray(self.embeddings[extra]), self.ids[extra])
+            # rename, not overwrite: readers keep their map of the old file
+            os.replace(plan["vecs_tmp"], self.vecs_path)
+            os.replace(plan["ids_tmp"], self.ids_path)
+        os.replace(plan["index_tmp"], self.index_path)
+        new = FaissStore(root=self.root, name=self.name)
+        new.dim = self.dim
+        new.manifest = json.loads(json.dumps(self.manifest))
+        new.manifest.update({"type": plan["kind"], "params": plan["params"], "built_at": time.time(),
+                             "build_ms": plan["build_ms"]})
+        if plan["quality"]:
+            new.manifest["quality"] = plan["quality"]
+        new.meta = self.meta
+        new.index = plan["index"]
+        new.next_id = self.next_id
+        new._open_rows()
+        new._reset_tail()
+        if plan["dropped"]:
+            self.meta.remove(sorted(plan["dropped"]))
+        new._reindex()
+        new._write_manifest()
+        return new
+
+    @staticmethod
+    def discard_plan(plan: Dict):
+        for key in ("index_tmp", "vecs_tmp", "ids_tmp"):
+            try:
+                os.remove(plan[key])
+            except FileNotFoundError:
+                pass
 
     def size(self) -> int:
-        return self.index.ntotal if self.index is not None else 0
-
-    def delete_doc(self, doc_id: str):
-        # Rebuild index without that doc (simple & robust for local)
-        remaining = [m for m in self.meta if m["doc_id"] != doc_id]
-        texts = [m["text"] for m in remaining]
-        if len(texts) == 0:
-            # reset
-            self.index = faiss.IndexFlatIP(self.dim)
-            self.meta = []
-            self.persist()
-            return
-
-        vecs = embed_texts(texts)
-        self.index = faiss.IndexFlatIP(vecs.shape[1])
-        self.index.add(np.array(vecs, dtype="float32"))
-        self.meta = remaining
-        self.persist()
+        return len(self.ids) - len(self.tombstones) if self.index is not None else 0
+
+    def nbytes(self) -> int:
+        """Approximate resident size: checkpoint codes/vectors, tail vectors and IDs (rows are memory-mapped)."""
+        bpv = self.manifest["params"].get("bytes_per_vector", 4 * self.dim)
+        return self.index.ntotal * bpv + self.tail.ntotal * 4 * self.dim + 3 * self.ids.nbytes
+
+    def delete_doc(self, doc_id: str) -> int:
+        # Tombstone the doc's chunks; vectors stay until compaction
+        ids = self.meta.live_ids(doc_id)
+        if ids:
+            self.meta.tombstone(ids)
+            self.tombstones.update(ids)
+        return len(ids)
+
+def _measure(index, kind: str, params: Dict, vecs: np.ndarray, ids: np.ndarray) -> Dict:
+    """
+    Memory per vector and recall@k of a new index against exact search over
+    vecs, using stored vectors as sample queries (plus recall with
+    re-ranking for compressed types).
+    """
+    n = index.ntotal
+    dim = vecs.shape[1]
+    k = min(RECALL_K, n)
+    queries = _train_sample(vecs, min(RECALL_QUERIES, n))
+    # exact top-k, chunked so the score matrix stays small
+    best = np.full((len(queries), 0), 0, dtype="int64")
+    best_scores = np.full((len(queries), 0), -np.inf, dtype="float32")
+    for start in range(0, n, 65536):
+        scores = queries @ np.asarray(vecs[start:start + 65536], dtype="float32").T
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        best = np.concatenate([best, np.broadcast_to(ids[start:start + 65536], scores.shape)], axis=1)
+        top = np.argsort(-best_scores, axis=1)[:, :k]
+        best_scores = np.take_along_axis(best_scores, top, axis=1)
+        best = np.take_along_axis(best, top, axis=1)
+
+    def _recall(found: List[List[int]]) -> float:
+        return round(float(np.mean([len(set(f[:k]) & set(b)) / k for f, b in zip(found, best)])), 4)
+
+    _, I = index.search(queries, k, params=_search_params(kind, params))
+    quality = {
+        f"recall@{k}": _recall(I.tolist()),
+        "bytes_per_vector": params["bytes_per_vector"],
+        "flat_bytes_per_vector": 4 * dim,
+        "compression": round(4 * dim / params["bytes_per_vector"], 1),
+        "queries": len(queries),
+    }
+    if kind in COMPRESSED_TYPES:
+        fetch = min(k * RERANK_FACTOR, n)
+        _, I = index.search(queries, fetch, params=_search_params(kind, params))
+        reranked = [[idx for _, idx in _rerank(q, [i for i in row if i != -1], ids, vecs)] for q, row in zip(queries, I)]
+        quality[f"recall@{k}_rerank"] = _recall(reranked)
+    return quality
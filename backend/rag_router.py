@@ -1,11 +1,14 @@
 import os
 from typing import List, Optional, Set
 from fastapi import APIRouter, UploadFile, File, Form, Query, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from rag.loaders import load_any
 from rag.chunker import chunk_doc
 from rag.embeddings import embed_texts
-from rag.store_faiss import FaissStore
+from rag.index_manager import manager as index_manager
+from rag.meta_store import ChunkMetaStore
+from rag.store_faiss import INDEX_TYPES
 from rag.pipeline import answer_with_rag
 from pathlib import Path
 from rag.legal_processing import resolve_legal_pdf_to_doc  # <-- NEW
@@ -17,6 +20,9 @@ class RagQueryBody(BaseModel):
     query: str
     top_k: int = 5
     use_reranker: bool = False
+    nprobe: Optional[int] = None       # IVF: inverted lists probed per query (default from the manifest)
+    ef_search: Optional[int] = None    # HNSW: search beam width (default from the manifest)
+    exact_rerank: Optional[bool] = None  # re-score candidates with full-precision vectors (default: compressed indexes)
 
 @router.post("/index")
 async def rag_index(
@@ -26,7 +32,10 @@ async def rag_index(
     chunk_overlap: int = Form(120),
     legal: bool = Form(False),                          # NEW
     effective_date: Optional[str] = Form(None),         # NEW (ISO string like "2025-09-09")
+    index_type: Optional[str] = Form(None),             # flat | ivf | hnsw | sq8 | fp16 | pq | auto (new indexes only)
 ):
+    if index_type and index_type not in INDEX_TYPES:
+        raise HTTPException(status_code=400, detail=f"index_type must be one of {', '.join(INDEX_TYPES)}")
     os.makedirs("uploads", exist_ok=True)
     saved_paths = []
     for f in files:
@@ -58,10 +67,16 @@ async def rag_index(
     if len(texts) == 0:
         raise HTTPException(status_code=400, detail="No text content found in uploaded files.")
 
-    vecs = embed_texts(texts)
-    store = FaissStore(name=index_name)
-    store.load(dim=vecs.shape[1])
-    store.add(vecs, all_chunks)
+    def _add():
+        vecs = embed_texts(texts)
+        with index_manager.writing(index_name, dim=vecs.shape[1], index_type=index_type) as store:
+            store.add(vecs, all_chunks)
+        return store
+
+    # embedding is CPU-bound and the write lock is a threading lock: keep both off the event loop
+    store = await run_in_threadpool(_add)
+    # training / graph building happens off the request path
+    rebuilding = store.needs_rebuild() and index_manager.rebuild_async(index_name)
 
     return {
         "index": index_name,
@@ -69,6 +84,8 @@ async def rag_index(
         "doc_ids": list(doc_ids),
         "chunks": len(all_chunks),
         "size": store.size(),
+        "index_type": store.manifest["type"],
+        "rebuilding": rebuilding,
         "legal_mode": legal,                 # echo back for client UI
         "effective_date": effective_date,    # echo back for audit
     }
@@ -78,34 +95,46 @@ async def rag_query(body: RagQueryBody):
     result = await answer_with_rag(
         query=body.query,
         index_name=body.index_name,
-        top_k=body.top_k
+        top_k=body.top_k,
+        nprobe=body.nprobe,
+        ef_search=body.ef_search,
+        rerank=body.exact_rerank,
     )
     return result
 
 @router.get("/indexes")
 async def rag_indexes():
     import glob
-    idx = []
-    for ipath in glob.glob("indices/*.faiss"):
-        name = os.path.splitext(os.path.basename(ipath))[0]
-        store = FaissStore(name=name)
-        store.load(dim=384)  # if you store the dim in metadata, prefer to read it instead of hardcoding
-        idx.append({"index_name": name, "size": store.size()})
+    # indexes that haven't been checkpointed yet have a manifest but no .faiss file
+    names = {os.path.basename(p)[:-len(".manifest.json")] for p in glob.glob("indices/*.manifest.json")}
+    names |= {os.path.splitext(os.path.basename(p))[0] for p in glob.glob("indices/*.faiss")}
+    # read from disk only: loading every index here would evict the warm ones
+    idx = await run_in_threadpool(lambda: [index_manager.describe(name) for name in sorted(names)])
     return {"indexes": idx}
 
+@router.get("/cache")
+async def rag_cache():
+    """Loaded indexes, memory budget, and cold-load vs warm-query latency."""
+    return index_manager.stats()
+
 @router.delete("/document/{doc_id}")
 async def rag_delete_document(doc_id: str, index_name: str = Query("default")):
-    store = FaissStore(name=index_name)
-    store.load(dim=384)
-    before = store.size()
-    store.delete_doc(doc_id)
+    # tombstones only (no re-embedding); vectors are dropped by background compaction
+    def _delete():
+        with index_manager.writing(index_name, dim=384) as store:
+            return store, store.size(), store.delete_doc(doc_id)
+
+    # the write lock is a threading lock: never wait for it on the event loop
+    store, before, removed = await run_in_threadpool(_delete)
     after = store.size()
-    return {"index": index_name, "doc_id": doc_id, "before": before, "after": after}
+    compacting = store.needs_compaction() and index_manager.compact_async(index_name)
+    return {"index": index_name, "doc_id": doc_id, "before": before, "after": after,
+            "removed_chunks": removed, "compacting": compacting}
 
 @router.delete("/index/{index_name}")
 async def rag_delete_index(index_name: str):
     """
-    Deletes the FAISS index + metadata JSON for this index,
+    Deletes the FAISS index + chunk metadata store for this index,
     and any uploaded source files referenced in that metadata
     (ONLY if they live under the local 'uploads/' dir).
     """
@@ -113,19 +142,27 @@ async def rag_delete_index(index_name: str):
     indices_dir = Path("indices").resolve()
 
     index_path = indices_dir / f"{index_name}.faiss"
-    meta_path  = indices_dir / f"{index_name}.meta.json"
+    meta_path  = indices_dir / f"{index_name}.meta.db"
+    legacy_meta_path = indices_dir / f"{index_name}.meta.json"
 
-    if not index_path.exists() and not meta_path.exists():
+    manifest_path = indices_dir / f"{index_name}.manifest.json"
+
+    if not any(p.exists() for p in (index_path, meta_path, legacy_meta_path, manifest_path)):
         raise HTTPException(status_code=404, detail=f"Index '{index_name}' not found.")
 
     # Collect source file paths from metadata (if present)
     source_files: Set[Path] = set()
-    if meta_path.exists():
-        import json
+    if meta_path.exists() or legacy_meta_path.exists():
         try:
-            meta = json.load(open(meta_path, "r"))
-            for m in meta:
-                p = m.get("metadata", {}).get("path")
+            if meta_path.exists():
+                meta_store = ChunkMetaStore(str(meta_path))
+                metadata = meta_store.metadata()
+                meta_store.close()
+            else:
+                import json
+                metadata = [m.get("metadata", {}) for m in json.load(open(legacy_meta_path, "r"))]
+            for md in metadata:
+                p = md.get("path")
                 if not p:
                     continue
                 candidate = Path(p).resolve()
@@ -135,14 +172,26 @@ async def rag_delete_index(index_name: str):
         except Exception:
             source_files = set()
 
-    # Delete index artifacts
+    # Delete index artifacts (under the index's write lock, off the event loop,
+    # so a background rebuild can't swap files back in)
     deleted = {"index": False, "meta": False, "uploads": []}
-    if index_path.exists():
-        index_path.unlink()
-        deleted["index"] = True
-    if meta_path.exists():
-        meta_path.unlink()
-        deleted["meta"] = True
+
+    def _remove_artifacts():
+        with index_manager.lock(index_name):
+            index_manager.invalidate(index_name)
+            if index_path.exists():
+                index_path.unlink()
+                deleted["index"] = True
+            for path in (meta_path, legacy_meta_path, indices_dir / f"{index_name}.meta.json.migrated"):
+                if path.exists():
+                    path.unlink()
+                    deleted["meta"] = True
+            for suffix in (".emb.f32", ".ids.i64", ".emb.npy", ".manifest.json", ".meta.db-wal", ".meta.db-shm"):
+                path = indices_dir / f"{index_name}{suffix}"
+                if path.exists():
+                    path.unlink()
+
+    await run_in_threadpool(_remove_artifacts)
 
     # Delete uploaded files (best-effort)
     for f in source_files:
@@ -0,0 +1,126 @@
+# response_cache.py
+"""
+Gateway-side exact-match cache of worker completions.
+
+Keyed on model + the full worker payload (adapter, rendered prompt, image,
+sampling params, stop strings, max tokens), so only byte-identical requests
+hit. The key also carries the adapter's weights version (newest mtime under
+adapters/<name>), so retraining an adapter under the same name via
+/finetune misses its old completions. Used for deterministic / near-deterministic requests (temperature at or
+below RESPONSE_CACHE_MAX_TEMPERATURE) or when the caller asks for it.
+Entries expire after a TTL and are evicted least-recently-used once the
+cache exceeds its byte budget.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+CACHE_MB = float(os.environ.get("RESPONSE_CACHE_MB", "64"))
+CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "600"))
+MAX_TEMPERATURE = float(os.environ.get("RESPONSE_CACHE_MAX_TEMPERATURE", "0.2"))
+ADAPTERS_DIR = "adapters"
+
+
+def _adapter_version(name: str | None) -> int | None:
+    """Newest mtime (ns) of the adapter's files, or None for the base model / a missing adapter."""
+    if not name:
+        return None
+    try:
+        with os.scandir(os.path.join(ADAPTERS_DIR, name)) as entries:
+            return max((e.stat().st_mtime_ns for e in entries if e.is_file()), default=0)
+    except OSError:
+        return None
+
+
+class ResponseCache:
+    def __init__(self, budget_bytes: int, ttl_s: float, max_temperature: float):
+        self.budget_bytes = budget_bytes
+        self.ttl_s = ttl_s
+        self.max_temperature = max_temperature
+        self._entries: OrderedDict[str, tuple[float, int, dict]] = OrderedDict()  # key -> (expires, bytes, value)
+        self._bytes = 0
+        self._lock = threading.RLock()
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.stores = 0
+
+    @staticmethod
+    def key(model: str, payload: dict) -> str:
+        blob = json.dumps({"model": model, **payload, "adapter_version": _adapter_version(payload.get("adapter_name"))},
+                          sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def enabled_for(self, payload: dict, requested: bool | None = None) -> bool:
+        """An explicit request wins; otherwise cache when sampling is (near) deterministic."""
+        if self.budget_bytes <= 0:
+            return False
+        if requested is not None:
+            return bool(requested)
+        return float(payload.get("temperature", 1.0)) <= self.max_temperature
+
+    def get(self, model: str, payload: dict) -> dict | None:
+        key = self.key(model, payload)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, size, value = entry
+            if expires < time.monotonic():
+                self._drop(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, model: str, payload: dict, value: dict):
+        key = self.key(model, payload)
+        size = len(key) + len(json.dumps(value, default=str))
+        if size > self.budget_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl_s, size, value)
+            self._bytes += size
+            self.stores += 1
+            while self._bytes > self.budget_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _drop(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "budget_bytes": self.budget_bytes,
+                "ttl_s": self.ttl_s,
+                "max_temperature": self.max_temperature,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "stores": self.stores,
+            }
+
+
+cache = ResponseCache(int(CACHE_MB * 1024 * 1024), CACHE_TTL, MAX_TEMPERATURE)
@@ -0,0 +1,178 @@
+# scheduler.py
+"""
+Per-model admission control in front of the model workers.
+
+Each model gets a ModelScheduler with a max-concurrency limit and a bounded
+FIFO wait queue. Requests beyond the queue are rejected immediately with 429,
+and requests that wait longer than the max queue wait get 503; both carry a
+Retry-After estimated from recent service times.
+"""
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("MODEL_MAX_CONCURRENCY", "2"))
+DEFAULT_MAX_QUEUE = int(os.environ.get("MODEL_MAX_QUEUE", "16"))
+DEFAULT_MAX_QUEUE_WAIT = float(os.environ.get("MODEL_MAX_QUEUE_WAIT", "30"))
+
+
+class AdmissionRejected(HTTPException):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(status_code=status_code, detail=detail, headers={"Retry-After": str(retry_after)})
+
+
+class ModelScheduler:
+    def __init__(self, model: str, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 max_queue: int = DEFAULT_MAX_QUEUE, max_queue_wait: float = DEFAULT_MAX_QUEUE_WAIT):
+        self.model = model
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.max_queue_wait = float(max_queue_wait)
+        self.in_flight = 0
+        self._waiters: deque = deque()
+        # counters
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self._wait_s: deque = deque(maxlen=256)  # (admitted_at, seconds waited)
+        self._service_ewma_s: float | None = None
+
+    # ---------- admission ----------
+    def queue_depth(self) -> int:
+        return sum(1 for f in self._waiters if not f.done())
+
+    def retry_after(self) -> int:
+        service = self._service_ewma_s or 1.0
+        backlog = self.queue_depth() + 1
+        return max(1, int(round(service * backlog / self.max_concurrency)))
+
+    async def acquire(self) -> float:
+        """Waits for a slot; returns seconds spent queued."""
+        start = time.perf_counter()
+        if self.in_flight < self.max_concurrency and not self.queue_depth():
+            self.in_flight += 1
+            return self._admit(start)
+
+        if self.queue_depth() >= self.max_queue:
+            self.rejected_full += 1
+            raise AdmissionRejected(429, f"Model '{self.model}' is at capacity; queue is full.", self.retry_after())
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout=self.max_queue_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                # the slot was handed over just as we gave up; pass it on
+                self.release()
+            elif fut in self._waiters:
+                self._waiters.remove(fut)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected_timeout += 1
+                raise AdmissionRejected(
+                    503, f"Model '{self.model}' queue wait exceeded {self.max_queue_wait:.0f}s.", self.retry_after()
+                )
+            raise
+        return self._admit(start)
+
+    def release(self, service_s: float | None = None):
+        if service_s is not None:
+            prev = self._service_ewma_s
+            self._service_ewma_s = service_s if prev is None else 0.8 * prev + 0.2 * service_s
+        # hand the slot straight to the next live waiter (in_flight unchanged)
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.in_flight = max(0, self.in_flight - 1)
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+    def _admit(self, start: float) -> float:
+        waited = time.perf_counter() - start
+        self.admitted += 1
+        self._wait_s.append((time.monotonic(), waited))
+        return waited
+
+    # ---------- metrics ----------
+    def recent_wait_p95(self, window_s: float) -> float | None:
+        """p95 queue wait (seconds) of requests admitted in the last window_s, or None."""
+        cutoff = time.monotonic() - window_s
+        waits = sorted(w for t, w in self._wait_s if t >= cutoff)
+        return waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else None
+
+    def stats(self) -> dict:
+        waits = sorted(w for _, w in self._wait_s)
+
+        def _pct(p):
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1) if waits else None
+
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "max_queue_wait_s": self.max_queue_wait,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth(),
+            "admitted": self.admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "wait_ms_p50": _pct(0.5),
+            "wait_ms_p95": _pct(0.95),
+            "wait_ms_max": round(waits[-1] * 1000, 1) if waits else None,
+            "service_ms_avg": round(self._service_ewma_s * 1000, 1) if self._service_ewma_s else None,
+        }
+
+
+# Model ID -> ModelScheduler
+_SCHEDULERS: dict[str, ModelScheduler] = {}
+_LOCK = threading.RLock()
+
+
+def configure(model: str, **limits) -> ModelScheduler:
+    """Creates or reconfigures the scheduler for a model. Unknown/None limits keep defaults."""
+    limits = {k: v for k, v in limits.items() if v is not None}
+    with _LOCK:
+        sched = _SCHEDULERS.get(model)
+        if sched is None:
+            sched = ModelScheduler(model, **limits)
+            _SCHEDULERS[model] = sched
+        else:
+            for k, v in limits.items():
+                setattr(sched, k, v)
+            # raised concurrency: admit queued requests into the new slots
+            while sched.in_flight < sched.max_concurrency and sched.queue_depth():
+                sched.in_flight += 1
+                sched.release()
+        return sched
+
+
+def get(model: str) -> ModelScheduler:
+    with _LOCK:
+        sched = _SCHEDULERS.get(model)
+        if sched is None:
+            sched = ModelScheduler(model)
+            _SCHEDULERS[model] = sched
+        return sched
+
+
+def remove(model: str):
+    with _LOCK:
+        _SCHEDULERS.pop(model, None)
+
+
+def stats() -> dict:
+    with _LOCK:
+        return {model: s.stats() for model, s in _SCHEDULERS.items()}
@@ -0,0 +1,166 @@
+# single_flight.py
+"""
+Coalescing of identical in-flight worker requests.
+
+Requests with the same key (model + full worker payload, as in
+response_cache) that arrive while one is already running share that one
+upstream generation instead of each hitting the worker:
+
+- run(): the first caller's coroutine runs as a task and every concurrent
+  caller awaits its result (or exception);
+- streams: the first caller opens a flight and pumps the upstream SSE events
+  into it; later callers subscribe, get the events buffered so far, then
+  follow along live.
+
+The upstream work runs in its own task, so it is not cancelled when the
+client that started it disconnects while others are still waiting; it is
+cancelled once every caller / subscriber has gone away.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+from response_cache import ResponseCache
+from cancellation import wait_or_disconnect
+
+_LOCK = threading.RLock()
+_CALLS: dict[str, asyncio.Task] = {}
+_WAITERS: dict[str, int] = defaultdict(int)
+_STREAMS: dict[str, "StreamFlight"] = {}
+_COALESCED: dict[str, int] = defaultdict(int)
+_LEADERS: dict[str, int] = defaultdict(int)
+
+
+def key(model: str, payload: dict) -> str:
+    return ResponseCache.key(model, payload)
+
+
+def _count(model: str, coalesced: bool):
+    with _LOCK:
+        (_COALESCED if coalesced else _LEADERS)[model] += 1
+
+
+async def run(model: str, payload: dict, fn, disconnected=None):
+    """
+    Returns await fn(), shared with any identical call already in flight.
+    With disconnected (e.g. Request.is_disconnected), raises
+    ClientDisconnected when the caller goes away; the shared call is
+    cancelled when no caller is left waiting for it.
+    """
+    k = key(model, payload)
+    with _LOCK:
+        task = _CALLS.get(k)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            _CALLS[k] = task
+            task.add_done_callback(lambda _t: _CALLS.pop(k, None))
+            leader = True
+        else:
+            leader = False
+        _WAITERS[k] += 1
+    _count(model, coalesced=not leader)
+    try:
+        if disconnected is None:
+            return await asyncio.shield(task)
+        return await wait_or_disconnect(task, disconnected)
+    finally:
+        with _LOCK:
+            _WAITERS[k] -= 1
+            abandoned = _WAITERS[k] <= 0
+            if abandoned:
+                del _WAITERS[k]
+        if abandoned and not task.done():
+            with _LOCK:
+                if _CALLS.get(k) is task:
+                    del _CALLS[k]
+            task.cancel()
+
+
+class StreamFlight:
+    """A buffered fan-out of one upstream event stream to many subscribers."""
+
+    def __init__(self, k: str):
+        self.key = k
+        self.events: list = []
+        self.done = False
+        self.subscribers = 0
+        self._cond = asyncio.Condition()
+        self._task: asyncio.Task | None = None
+
+    async def _push(self, event):
+        async with self._cond:
+            self.events.append(event)
+            self._cond.notify_all()
+
+    async def _close(self):
+        async with self._cond:
+            self.done = True
+            self._cond.notify_all()
+        self._forget()
+
+    def _forget(self):
+        with _LOCK:
+            if _STREAMS.get(self.key) is self:
+                del _STREAMS[self.key]
+
+    async def _pump(self, source):
+        try:
+            async for event in source:
+                await self._push(event)
+        finally:
+            await self._close()
+
+    def start(self, source):
+        """Starts consuming the upstream async iterator in the background."""
+        self._task = asyncio.ensure_future(self._pump(source))
+
+    async def abort(self, *events):
+        """Ends the flight without an upstream (e.g. admission rejected), sending events to subscribers."""
+        for event in events:
+            await self._push(event)
+        await self._close()
+
+    async def subscribe(self):
+        i = 0
+        self.subscribers += 1
+        try:
+            while True:
+                async with self._cond:
+                    await self._cond.wait_for(lambda: i < len(self.events) or self.done)
+                    batch = self.events[i:]
+                if not batch:
+                    return
+                i += len(batch)
+                for event in batch:
+                    yield event
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done and self._task is not None:
+                # last client disconnected: stop the upstream generation
+                self._forget()  # identical requests from now on start a fresh flight
+                self._task.cancel()
+
+
+def open_stream(model: str, payload: dict) -> tuple[StreamFlight, bool]:
+    """Returns (flight, is_leader). The leader must start() or abort() the flight."""
+    k = key(model, payload)
+    with _LOCK:
+        flight = _STREAMS.get(k)
+        leader = flight is None
+        if leader:
+            flight = StreamFlight(k)
+            _STREAMS[k] = flight
+    _count(model, coalesced=not leader)
+    return flight, leader
+
+
+def stats() -> dict:
+    with _LOCK:
+        models = set(_COALESCED) | set(_LEADERS)
+        return {
+            "in_flight": {"calls": len(_CALLS), "streams": len(_STREAMS)},
+            "models": {
+                m: {"upstream": _LEADERS[m], "coalesced": _COALESCED[m]}
+                for m in sorted(models)
+            },
+        }
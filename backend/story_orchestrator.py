@@ -7,7 +7,6 @@ import asyncio
 import tempfile
 import re
 
-import httpx
 from langgraph.graph import StateGraph, END
 
 # RAG internals (same modules used by rag_router.py)
@@ -20,10 +19,15 @@ from rag.pipeline import answer_with_rag
 # Your local helpers
 from diffusion_worker import generate_image
 from tts_wrapper import generate_audio
+import worker_client
+from response_cache import cache as response_cache
+import single_flight
+import blob_store
 
-LLAMA_WORKER_URL = "http://localhost:21002/worker_generate"
-QWEN_WORKER_URL  = "http://localhost:21003/worker_generate"
+LLAMA_WORKER_PORT = 21002
+QWEN_WORKER_PORT  = 21003
 BASE_MODEL_NAME  = "meta-llama/Llama-3.2-1B-Instruct"
+QWEN_MODEL_NAME  = "mlx-community/Qwen2-VL-2B-Instruct-4bit"
 _TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]+(?:'[A-Za-z0-9]+)?|[^\sA-Za-z0-9]")
 
 # ---------- LangGraph State ----------
@@ -31,7 +35,7 @@ _TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]+(?:'[A-Za-z0-9]+)?|[^\sA-Za-z0-9]")
 class StoryState(TypedDict, total=False):
     # Inputs
     narrative: str                          # high-level instruction for style/tone/POV
-    image: Optional[str]                    # base64 data URL or http(s) URL
+    image: Optional[str]                    # blob:<sha256> ref, base64 data URL or http(s) URL
     rag_docs: List[str]                     # local file paths to index (optional)
     rag_index_name: Optional[str]           # name for FAISS index (optional)
     build_index: bool                       # force building index from rag_docs
@@ -47,6 +51,7 @@ class StoryState(TypedDict, total=False):
     # Orchestration options
     num_illustrations: int                  # 1..N
     illustration_prompt_hint: Optional[str] # optional style hint for SDXL
+    image_quality: Optional[str]            # Qwen visual-token tier: low | medium | high | full
 
     # Intermediates / Outputs
     scene_summary: str
@@ -92,6 +97,16 @@ def _final_token_clamp_by_chunks(text: str, max_tokens: int) -> str:
         cur = _truncate_to_token_budget(cur, max_tokens)
     return cur.strip()
 
+async def _worker_generate(model: str, port: int, payload: dict, timeout: float) -> dict:
+    """POSTs to a worker's /worker_generate; identical concurrent calls (e.g. story runs
+    from the same image) share one generation."""
+    async def _post():
+        async with worker_client.route(model, port) as lease:
+            resp = await lease.pool.post("/worker_generate", json=payload, timeout=timeout)
+            resp.raise_for_status()
+        return resp.json()
+    return await single_flight.run(model, payload, _post)
+
 async def _compress_to_keywords(state, source_text: str, n_terms: int = 16) -> str:
     if not source_text.strip():
         return ""
@@ -100,22 +115,25 @@ async def _compress_to_keywords(state, source_text: str, n_terms: int = 16) -> s
         f"Return {n_terms} items, comma-separated, no numbering, no extra words.\n\n"
         f"{source_text.strip()}\n"
     )
-    async with httpx.AsyncClient(timeout=60) as client:
-        resp = await client.post(LLAMA_WORKER_URL, json={
-            "prompt": prompt,
-            "temperature": 0.1,
-            "top_p": 0.9,
-            "max_new_tokens": 120,
-        })
-        resp.raise_for_status()
-        data = resp.json()
-        kw = (data.get("text") or "").strip()
-        # normalize commas/spaces
-        kw = re.sub(r"\s*,\s*", ", ", kw)
-        kw = re.sub(r"\s+", " ", kw)
-        # preliminary cap (tighter than final): aim small to avoid surprises
-        kw = _truncate_to_token_budget(kw, max_tokens=60)
-        return kw
+    payload = {
+        "prompt": prompt,
+        "temperature": 0.1,
+        "top_p": 0.9,
+        "max_new_tokens": 120,
+    }
+    use_cache = response_cache.enabled_for(payload)
+    data = response_cache.get(BASE_MODEL_NAME, payload) if use_cache else None
+    if data is None:
+        data = await _worker_generate(BASE_MODEL_NAME, LLAMA_WORKER_PORT, payload, timeout=60)
+        if use_cache:
+            response_cache.put(BASE_MODEL_NAME, payload, data)
+    kw = (data.get("text") or "").strip()
+    # normalize commas/spaces
+    kw = re.sub(r"\s*,\s*", ", ", kw)
+    kw = re.sub(r"\s+", " ", kw)
+    # preliminary cap (tighter than final): aim small to avoid surprises
+    kw = _truncate_to_token_budget(kw, max_tokens=60)
+    return kw
 
 
 async def _run_finetune_if_needed(state: StoryState) -> dict:
@@ -190,6 +208,8 @@ async def _describe_image_with_qwen(state: StoryState) -> dict:
     image = state.get("image")
     if not image:
         return {"scene_summary": ""}
+    # send a blob ref, not the base64 image or a URL, to the worker
+    image = await blob_store.store.ingest_async(image)
 
     prompt = (
         "You are a visual analyst. Describe this image in 6–10 sentences. "
@@ -197,17 +217,16 @@ async def _describe_image_with_qwen(state: StoryState) -> dict:
         "End with a short bullet list of evocative visual motifs."
     )
 
-    async with httpx.AsyncClient(timeout=120) as client:
-        resp = await client.post(QWEN_WORKER_URL, json={
-            "prompt": prompt,
-            "image": image,
-            "temperature": 0.2,
-            "top_p": 0.9,
-            "max_new_tokens": 320,
-        })
-        resp.raise_for_status()
-        data = resp.json()
-        return {"scene_summary": data.get("text", "").strip()}
+    data = await _worker_generate(QWEN_MODEL_NAME, QWEN_WORKER_PORT, {
+        "prompt": prompt,
+        "image": image,
+        # a scene summary doesn't need fine detail; "medium" caps the image at ~1024 visual tokens
+        "image_quality": state.get("image_quality") or "medium",
+        "temperature": 0.2,
+        "top_p": 0.9,
+        "max_new_tokens": 320,
+    }, timeout=120)
+    return {"scene_summary": data.get("text", "").strip()}
 
 async def _retrieve_kb_snippet(state: StoryState) -> dict:
     """
@@ -255,11 +274,8 @@ async def _write_story_with_llama(state: StoryState) -> dict:
     if state.get("adapter_name"):
         payload["adapter_name"] = state["adapter_name"]
 
-    async with httpx.AsyncClient(timeout=180) as client:
-        resp = await client.post(LLAMA_WORKER_URL, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        return {"story_text": data.get("text", "").strip()}
+    data = await _worker_generate(BASE_MODEL_NAME, LLAMA_WORKER_PORT, payload, timeout=180)
+    return {"story_text": data.get("text", "").strip()}
 
 # --- generate illustrations (replace your whole _generate_illustrations) ---
 async def _generate_illustrations(state: StoryState) -> dict:
@@ -0,0 +1,124 @@
+# transport_bench.py
+"""
+Micro-benchmark of gateway -> worker per-request overhead, TCP vs Unix
+domain socket.
+
+Starts a trivial worker app twice (once per transport) and times requests
+through the gateway's own WorkerPool client, sequentially and with
+concurrency, so only transport + HTTP overhead is measured:
+
+    python transport_bench.py --requests 2000 --concurrency 16
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+from fastapi import FastAPI, Request
+
+import worker_client
+
+app = FastAPI()
+
+
+@app.get("/health")
+def health():
+    return {"ok": True}
+
+
+@app.post("/echo")
+async def echo(request: Request):
+    return await request.json()
+
+
+def _start(port: int, uds: str | None):
+    args = [sys.executable, "-m", "uvicorn", "transport_bench:app", "--log-level", "warning"]
+    args += ["--uds", uds] if uds else ["--host", "127.0.0.1", "--port", str(port)]
+    return subprocess.Popen(args, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+async def _wait_ready(pool, timeout_s: float = 30.0):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        try:
+            if (await pool.get("/health", timeout=1.0)).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"bench worker at {pool.uds or pool.base_url} did not start")
+
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def _measure(pool, n: int, concurrency: int, payload_bytes: int) -> dict:
+    body = {"prompt": "x" * payload_bytes}
+    for _ in range(50):  # warm-up, opens keep-alive connections
+        await pool.post("/echo", json=body)
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        await pool.post("/echo", json=body)
+        latencies.append(time.perf_counter() - t)
+    sequential_s = time.perf_counter() - start
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _one():
+        async with sem:
+            await pool.post("/echo", json=body)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_one() for _ in range(n)))
+    concurrent_s = time.perf_counter() - start
+
+    return {
+        "mean_us": round(sum(latencies) / n * 1e6, 1),
+        "p50_us": round(_percentile(latencies, 0.50) * 1e6, 1),
+        "p99_us": round(_percentile(latencies, 0.99) * 1e6, 1),
+        "sequential_rps": round(n / sequential_s, 1),
+        f"concurrent_rps@{concurrency}": round(n / concurrent_s, 1),
+    }
+
+
+async def run_bench(n: int = 2000, concurrency: int = 16, payload_bytes: int = 512, port: int = 21999) -> dict:
+    uds = os.path.join(tempfile.gettempdir(), f"transport-bench-{os.getpid()}.sock")
+    procs = [_start(port, None), _start(port, uds)]
+    pools = {
+        "tcp": worker_client.WorkerPool(worker_client.worker_base_url(port)),
+        "uds": worker_client.WorkerPool("http://localhost", uds),
+    }
+    try:
+        results = {}
+        for name, pool in pools.items():
+            await _wait_ready(pool)
+            results[name] = await _measure(pool, n, concurrency, payload_bytes)
+        results["uds_vs_tcp_mean"] = round(results["tcp"]["mean_us"] / results["uds"]["mean_us"], 2)
+        return {"requests": n, "concurrency": concurrency, "payload_bytes": payload_bytes, **results}
+    finally:
+        for pool in pools.values():
+            await pool.aclose()
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+        if os.path.exists(uds):
+            os.unlink(uds)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Compare TCP and Unix socket gateway -> worker overhead.")
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--payload_bytes", type=int, default=512)
+    p.add_argument("--port", type=int, default=21999)
+    args = p.parse_args()
+    print(json.dumps(asyncio.run(run_bench(args.requests, args.concurrency, args.payload_bytes, args.port)), indent=2))
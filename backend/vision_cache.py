@@ -0,0 +1,172 @@
+# vision_cache.py
+"""
+Vision feature cache for the Qwen2-VL worker (model_worker_qwen.py).
+
+Multi-turn image chats send the same image every turn. Two byte-bounded
+LRU tiers avoid redoing the image work:
+
+- images:  decoded RGB images keyed by the image's content hash (skips the
+  base64 / file decode and PIL decode);
+- encoder: vision-tower outputs keyed by a fingerprint of the preprocessed
+  pixel tensor (skips the vision encoder). mlx_vlm has no public hook for
+  this, so CachedVisionTower wraps model.vision_tower when present.
+
+Each tier records the time a miss cost, so a hit reports the time it saved.
+Per-request results are collected through a context variable and reported
+in the response usage.
+"""
+import time
+import hashlib
+import threading
+import contextvars
+from collections import OrderedDict
+
+
+class FeatureCache:
+    """LRU cache bounded by bytes; values are (value, size, cost_s)."""
+
+    def __init__(self, name: str, budget_bytes: int):
+        self.name = name
+        self.budget_bytes = budget_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_s = 0.0
+
+    def get(self, key):
+        """Returns (value, cost_s) on a hit, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            value, _, cost_s = entry
+            self.saved_s += cost_s
+            return value, cost_s
+
+    def put(self, key, value, size: int, cost_s: float):
+        if self.budget_bytes <= 0 or size > self.budget_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size, cost_s)
+            self._bytes += size
+            while self._bytes > self.budget_bytes and self._entries:
+                _, (_, old_size, _) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+
+    def hit_rate(self) -> float | None:
+        lookups = self.hits + self.misses
+        return round(self.hits / lookups, 3) if lookups else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate(),
+                "evictions": self.evictions,
+                "saved_ms": round(self.saved_s * 1000, 1),
+            }
+
+
+# Per-request record: {"image": "hit"|"miss", "encoder": "hit"|"miss", "saved_ms": float}
+_request: contextvars.ContextVar[dict | None] = contextvars.ContextVar("vision_cache_request", default=None)
+
+
+def begin_request(record: dict | None = None) -> dict:
+    """Starts collecting cache outcomes for the current request (or re-binds record,
+    e.g. inside a streaming generator that runs in another thread)."""
+    if record is None:
+        record = {"image": None, "encoder": None, "saved_ms": 0.0}
+    _request.set(record)
+    return record
+
+
+def record(tier: str, hit: bool, cost_s: float = 0.0):
+    rec = _request.get()
+    if rec is None:
+        return
+    rec[tier] = "hit" if hit else "miss"
+    if hit:
+        rec["saved_ms"] = round(rec["saved_ms"] + cost_s * 1000, 1)
+
+
+def _fingerprint(value) -> str:
+    """Content hash of an mlx/numpy array (plus shape/dtype), or repr for plain values."""
+    import numpy as np
+
+    if hasattr(value, "shape") and hasattr(value, "dtype"):
+        try:
+            arr = np.asarray(value)
+        except (TypeError, ValueError, RuntimeError):
+            import mlx.core as mx
+            arr = np.asarray(value.astype(mx.float32))  # e.g. bfloat16 has no numpy dtype
+        h = hashlib.sha1(arr.tobytes())
+        h.update(f"{arr.shape}{value.dtype}".encode())
+        return h.hexdigest()
+    return repr(value)
+
+
+def _nbytes(value) -> int:
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return int(getattr(value, "nbytes", 0))
+
+
+class CachedVisionTower:
+    """Callable stand-in for model.vision_tower that memoizes its outputs."""
+
+    def __init__(self, tower, cache: FeatureCache):
+        self.tower = tower
+        self.cache = cache
+
+    def __call__(self, pixel_values, *args, **kwargs):
+        import mlx.core as mx
+
+        key = (
+            _fingerprint(pixel_values),
+            tuple(_fingerprint(a) for a in args),
+            tuple(sorted((k, _fingerprint(v)) for k, v in kwargs.items())),
+        )
+        hit = self.cache.get(key)
+        if hit is not None:
+            record("encoder", True, hit[1])
+            return hit[0]
+        start = time.perf_counter()
+        out = self.tower(pixel_values, *args, **kwargs)
+        mx.eval(out)
+        cost_s = time.perf_counter() - start
+        self.cache.put(key, out, _nbytes(out), cost_s)
+        record("encoder", False)
+        return out
+
+    def __getattr__(self, name):
+        return getattr(self.tower, name)
+
+
+def wrap_vision_tower(model, cache: FeatureCache) -> bool:
+    """Installs CachedVisionTower on model if it has a vision tower; returns whether it did."""
+    tower = getattr(model, "vision_tower", None)
+    if tower is None or cache.budget_bytes <= 0:
+        return False
+    if isinstance(tower, CachedVisionTower):
+        return True
+    try:
+        # mlx Modules keep submodules as dict items; a plain attribute shadows the lookup
+        object.__setattr__(model, "vision_tower", CachedVisionTower(tower, cache))
+    except (AttributeError, TypeError):
+        return False
+    return True
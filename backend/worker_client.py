@@ -0,0 +1,212 @@
+# worker_client.py
+"""
+Shared, pooled HTTP clients for gateway -> model worker traffic.
+
+One httpx.AsyncClient per worker base URL, so requests reuse keep-alive
+connections instead of paying a TCP connect each time. Pools are opened at
+app startup, created lazily for workers that appear later (dynamic MLX), and
+closed at shutdown.
+
+route() picks the least-loaded replica of a model (dynamic_registry) and
+reports the outcome back so failing replicas get ejected.
+
+Workers the gateway launched with a Unix domain socket (see
+worker_transport.py) are reached over that socket; everything else over TCP.
+"""
+import os
+import threading
+from contextlib import asynccontextmanager
+
+import httpx
+
+import dynamic_registry
+import worker_transport
+
+MAX_CONNECTIONS = int(os.environ.get("WORKER_MAX_CONNECTIONS", "32"))
+MAX_KEEPALIVE = int(os.environ.get("WORKER_MAX_KEEPALIVE", "16"))
+KEEPALIVE_EXPIRY = float(os.environ.get("WORKER_KEEPALIVE_EXPIRY", "60"))
+CONNECT_TIMEOUT = float(os.environ.get("WORKER_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("WORKER_READ_TIMEOUT", "60"))
+
+
+def worker_base_url(port: int, host: str = "127.0.0.1") -> str:
+    return f"http://{host}:{port}"
+
+
+class WorkerPool:
+    def __init__(self, base_url: str, uds: str | None = None):
+        self.base_url = base_url
+        self.uds = uds
+        limits = httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            # a custom transport ignores the client's limits, so pass them to it
+            transport=httpx.AsyncHTTPTransport(uds=uds, limits=limits) if uds else None,
+            limits=limits,
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+        )
+        self.requests_total = 0
+        self.in_flight = 0
+        self.errors = 0
+        self.connections_opened = 0
+
+    async def _trace(self, event_name: str, info: dict):
+        # httpcore emits one connect_*.complete per new connection; reused
+        # keep-alive connections emit none.
+        if event_name.startswith("connection.connect_") and event_name.endswith(".complete"):
+            self.connections_opened += 1
+
+    def _request_kwargs(self, timeout, **kwargs) -> dict:
+        kwargs["extensions"] = {"trace": self._trace}
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(timeout, connect=CONNECT_TIMEOUT)
+        return kwargs
+
+    async def request(self, method: str, path: str, *, timeout: float | None = None, **kwargs) -> httpx.Response:
+        self.requests_total += 1
+        self.in_flight += 1
+        try:
+            return await self.client.request(method, path, **self._request_kwargs(timeout, **kwargs))
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    async def post(self, path: str, *, timeout: float | None = None, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, timeout=timeout, **kwargs)
+
+    async def get(self, path: str, *, timeout: float | None = None, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, timeout=timeout, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, path: str, *, timeout: float | None = None, **kwargs):
+        self.requests_total += 1
+        self.in_flight += 1
+        try:
+            async with self.client.stream(method, path, **self._request_kwargs(timeout, **kwargs)) as response:
+                yield response
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def open_connections(self) -> int | None:
+        # httpx does not expose the pool publicly; best effort for visibility
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        conns = getattr(pool, "connections", None)
+        return len(conns) if conns is not None else None
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "transport": "uds" if self.uds else "tcp",
+            "socket": self.uds,
+            "requests_total": self.requests_total,
+            "in_flight": self.in_flight,
+            "errors": self.errors,
+            "connections_opened": self.connections_opened,
+            "connections_open": self.open_connections(),
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# base_url -> WorkerPool
+_POOLS: dict[str, WorkerPool] = {}
+# port -> Unix socket path of local workers launched with one
+_SOCKETS: dict[int, str] = {}
+_LOCK = threading.RLock()
+
+
+def use_socket(port: int) -> dict:
+    """
+    Routes traffic for port over its Unix socket (if enabled) and returns the
+    env vars the worker process needs to listen on it.
+    """
+    env = worker_transport.worker_env(port)
+    if env:
+        with _LOCK:
+            _SOCKETS[port] = env["WORKER_SOCKET"]
+    return env
+
+
+def get_pool(port: int | None = None, base_url: str | None = None) -> WorkerPool:
+    uds = _SOCKETS.get(port) if base_url is None else None
+    base_url = base_url or worker_base_url(port)
+    with _LOCK:
+        pool = _POOLS.get(base_url)
+        if pool is None:
+            pool = WorkerPool(base_url, uds)
+            _POOLS[base_url] = pool
+        return pool
+
+
+async def close_pool(port: int | None = None, base_url: str | None = None):
+    if base_url is None:
+        with _LOCK:
+            _SOCKETS.pop(port, None)
+    base_url = base_url or worker_base_url(port)
+    with _LOCK:
+        pool = _POOLS.pop(base_url, None)
+    if pool is not None:
+        await pool.aclose()
+
+
+class Lease:
+    """A routed request's replica and pool; call fail() for error responses."""
+
+    def __init__(self, replica, port: int):
+        self.replica = replica
+        self.port = port
+        self.pool = get_pool(port)
+        self.ok = True
+
+    def fail(self):
+        self.ok = False
+
+
+@asynccontextmanager
+async def route(model: str, port: int | None = None):
+    """
+    Leases the least-loaded replica of model; falls back to port when the
+    model has no registered replicas (e.g. a worker started by hand).
+    Exceptions inside the block (other than 4xx statuses) count as a
+    failure of that replica.
+    """
+    replica = dynamic_registry.acquire(model)
+    if replica is None and port is None:
+        raise RuntimeError(f"No ready worker replicas for model '{model}'")
+    lease = Lease(replica, replica.port if replica else port)
+    try:
+        yield lease
+    except Exception as e:
+        if not (isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500):
+            lease.fail()
+        raise
+    finally:
+        dynamic_registry.release(replica, lease.ok)
+
+
+async def startup(ports):
+    for port in ports:
+        get_pool(port)
+
+
+async def shutdown():
+    with _LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        await pool.aclose()
+
+
+def stats() -> dict:
+    with _LOCK:
+        return {url: pool.stats() for url, pool in _POOLS.items()}
@@ -0,0 +1,47 @@
+# worker_transport.py
+"""
+Gateway <-> local worker transport.
+
+Workers the gateway launches on this host listen on a Unix domain socket
+(WORKER_SOCKET_DIR/worker-<port>.sock; the port stays the worker's ID)
+instead of TCP, which skips the loopback TCP stack on every request.
+Workers started by hand, remote workers, and WORKER_TRANSPORT=tcp keep
+using TCP.
+
+The gateway passes WORKER_SOCKET to the worker process; the worker calls
+serve(), which binds the socket if it is set and falls back to TCP.
+"""
+import os
+import tempfile
+
+TRANSPORT = os.environ.get("WORKER_TRANSPORT", "uds").lower()  # uds | tcp
+SOCKET_DIR = os.environ.get("WORKER_SOCKET_DIR", os.path.join(tempfile.gettempdir(), "model_workers"))
+
+
+def uds_enabled() -> bool:
+    return TRANSPORT == "uds" and hasattr(os, "fork")  # no AF_UNIX serving on Windows
+
+
+def socket_path(port: int) -> str:
+    return os.path.join(SOCKET_DIR, f"worker-{port}.sock")
+
+
+def worker_env(port: int) -> dict:
+    """Env vars that make a launched worker listen on its Unix socket."""
+    if not uds_enabled():
+        return {}
+    os.makedirs(SOCKET_DIR, exist_ok=True)
+    return {"WORKER_SOCKET": socket_path(port)}
+
+
+def serve(app, port: int, host: str = "0.0.0.0"):
+    """uvicorn.run on WORKER_SOCKET if the gateway set one, else on host:port."""
+    import uvicorn
+
+    path = os.environ.get("WORKER_SOCKET")
+    if path:
+        if os.path.exists(path):
+            os.unlink(path)  # stale socket from a previous run
+        uvicorn.run(app, uds=path)
+    else:
+        uvicorn.run(app, host=host, port=port)
@@ -245,18 +245,29 @@ export default function MainTabs({ supports }) {
         } else {
           messages.push({ role: 'user', content: fullPrompt });
         }
-        const responseText = await sendToBackend(
+        // Add an empty bot bubble and grow it as tokens stream in
+        const botKey = Math.random().toString(36).substring(2);
+        let started = false;
+        await sendToBackend(
           messages,
           selectedModel || model,
           image,
-          selectedAdapter ?? null
+          selectedAdapter ?? null,
+          (delta) => {
+            if (!started) {
+              started = true;
+              setIsThinking(false);
+              setChats((prev) => [...prev, { t: delta, user: 'bot', key: botKey }]);
+              return;
+            }
+            setChats((prev) =>
+              prev.map((c) => (c.key === botKey ? { ...c, t: c.t + delta } : c))
+            );
+          }
         );
-        const botMessage = {
-          t: responseText,
-          user: 'bot',
-          key: Math.random().toString(36).substring(2),
-        };
-        setChats((prev) => [...prev, botMessage]);
+        if (!started) {
+          setChats((prev) => [...prev, { t: '', user: 'bot', key: botKey }]);
+        }
       }
     } catch (e: any) {
       const botMessage = {
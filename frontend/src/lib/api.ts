@@ -6,7 +6,8 @@ export async function sendToBackend(
   messages: any[],
   model: string,
   image?: string | null,
-  adapter?: string | null
+  adapter?: string | null,
+  onDelta?: (delta: string) => void
 ) {
   const res = await fetch('http://localhost:8000/v1/chat/completions', {
     method: 'POST',
@@ -14,7 +15,8 @@ export async function sendToBackend(
     body: JSON.stringify({
       model,
       messages,
-      stream: false,
+      // stream tokens as SSE when the caller wants incremental updates
+      stream: !!onDelta,
       // optional extras your backend can read
       adapter: adapter || null,
       // if you also want to forward an inline image url/dataURI for VL models:
@@ -27,8 +29,37 @@ export async function sendToBackend(
     throw new Error(`Backend error ${res.status}: ${t}`);
   }
 
-  const data = await res.json();
-  return data?.choices?.[0]?.message?.content ?? '';
+  if (!onDelta || !res.body) {
+    const data = await res.json();
+    return data?.choices?.[0]?.message?.content ?? '';
+  }
+
+  // Parse OpenAI-style SSE: "data: {...}\n\n" ... "data: [DONE]"
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let text = '';
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) !== -1) {
+      const event = buffer.slice(0, sep).trim();
+      buffer = buffer.slice(sep + 2);
+      if (!event.startsWith('data:')) continue;
+      const data = event.slice(5).trim();
+      if (data === '[DONE]') return text;
+      const chunk = JSON.parse(data);
+      if (chunk.error) throw new Error(typeof chunk.error === 'string' ? chunk.error : JSON.stringify(chunk.error));
+      const delta = chunk?.choices?.[0]?.delta?.content;
+      if (delta) {
+        text += delta;
+        onDelta(delta);
+      }
+    }
+  }
+  return text;
 }
 
 